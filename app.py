@@ -6,17 +6,23 @@ import sys
 import time
 
 from channel import channel_factory
-from common import const
+from common import const, tokenizer
 from config import load_config
 from plugins import *
 import threading
 
+channel = None  # 当前运行的channel，退出时用于排空消息队列
+
 
 def sigterm_handler_wrap(_signo):
     old_handler = signal.getsignal(_signo)
 
     def func(_signo, _stack_frame):
         logger.info("signal {} received, exiting...".format(_signo))
+        from channel.chat_channel import ChatChannel
+
+        if isinstance(channel, ChatChannel) and not ChatChannel.draining:  # 再次收到信号时直接退出
+            channel.drain()
         conf().save_user_datas()
         if callable(old_handler):  #  check old_handler
             return old_handler(_signo, _stack_frame)
@@ -26,6 +32,7 @@ def sigterm_handler_wrap(_signo):
 
 
 def start_channel(channel_name: str):
+    global channel
     channel = channel_factory.create_channel(channel_name)
     if channel_name in ["wx", "wxy", "terminal", "wechatmp","web", "wechatmp_service", "wechatcom_app", "wework",
                         const.FEISHU, const.DINGTALK]:
@@ -44,6 +51,8 @@ def run():
     try:
         # load config
         load_config()
+        # 后台预加载token编码，避免第一条消息等待
+        threading.Thread(target=tokenizer.warm_up, args=(conf().get("model") or "gpt-3.5-turbo",), daemon=True).start()
         # ctrl + c
         sigterm_handler_wrap(signal.SIGINT)
         # kill signal
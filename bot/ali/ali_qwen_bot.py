@@ -14,6 +14,7 @@ from bot.ali.ali_qwen_session import AliQwenSession
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common.circuit_breaker import backoff_delay, get_circuit_breaker, open_reply
 from common.log import logger
 from common import const
 from config import conf, load_config
@@ -82,6 +83,7 @@ class AliQwenBot(Bot):
             if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
                 reply = Reply(ReplyType.ERROR, reply_content["content"])
             elif reply_content["completion_tokens"] > 0:
+                self.report_usage(context, reply_content["total_tokens"], reply_content["completion_tokens"])
                 self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
                 reply = Reply(ReplyType.TEXT, reply_content["content"])
             else:
@@ -100,12 +102,16 @@ class AliQwenBot(Bot):
         :param retry_count: retry count
         :return: {}
         """
+        breaker = get_circuit_breaker("qwen")
+        if not breaker.allow():
+            return {"completion_tokens": 0, "content": open_reply()}
         try:
             prompt, history = self.convert_messages_format(session.messages)
             self.update_api_key_if_expired()
             # NOTE 阿里百炼的call()函数未提供temperature参数，考虑到temperature和top_p参数作用相同，取两者较小的值作为top_p参数传入，详情见文档 https://help.aliyun.com/document_detail/2587502.htm
             response = broadscope_bailian.Completions().call(app_id=self.app_id(), prompt=prompt, history=history, top_p=min(self.temperature(), self.top_p()))
             completion_content = self.get_completion_content(response, self.node_id())
+            breaker.record_success()
             completion_tokens, total_tokens = self.calc_tokens(session.messages, completion_content)
             return {
                 "total_tokens": total_tokens,
@@ -115,21 +121,22 @@ class AliQwenBot(Bot):
         except Exception as e:
             need_retry = retry_count < 2
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+            # 百炼SDK的异常不带http状态码，按异常类型判断上游是否可用
+            if isinstance(e, (openai.error.Timeout, openai.error.APIConnectionError, openai.error.APIError)):
+                breaker.record_failure()
+            delay = 0
             if isinstance(e, openai.error.RateLimitError):
                 logger.warn("[QWEN] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
+                delay = backoff_delay(retry_count)
             elif isinstance(e, openai.error.Timeout):
                 logger.warn("[QWEN] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
+                delay = backoff_delay(retry_count)
             elif isinstance(e, openai.error.APIError):
                 logger.warn("[QWEN] Bad Gateway: {}".format(e))
                 result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
+                delay = backoff_delay(retry_count)
             elif isinstance(e, openai.error.APIConnectionError):
                 logger.warn("[QWEN] APIConnectionError: {}".format(e))
                 need_retry = False
@@ -139,6 +146,8 @@ class AliQwenBot(Bot):
                 need_retry = False
                 self.sessions.clear_session(session.session_id)
 
+            if need_retry and delay:
+                time.sleep(delay)
             if need_retry:
                 logger.warn("[QWEN] 第{}次重试".format(retry_count + 1))
                 return self.reply_text(session, retry_count + 1)
@@ -2,12 +2,15 @@
 Auto-replay chat robot abstract class
 """
 
+import asyncio
 
 from bridge.context import Context
 from bridge.reply import Reply
 
 
 class Bot(object):
+    REPLY_CACHE = True  # whether replies of this bot can be served from the reply cache, bots with side effects should disable it
+
     def reply(self, query, context: Context = None) -> Reply:
         """
         bot auto-reply content
@@ -15,3 +18,21 @@ class Bot(object):
         :return: reply content
         """
         raise NotImplementedError
+
+    async def reply_async(self, query, context: Context = None) -> Reply:
+        """
+        coroutine version of reply, used by the asyncio message pipeline
+        bots with native async clients should override it, the default runs reply in the loop's executor
+        :param req: received message
+        :return: reply content
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.reply, query, context)
+
+    @staticmethod
+    def report_usage(context, total_tokens, completion_tokens):
+        """
+        report the tokens used by this call, usage_ledger reads it from context after reply returns
+        """
+        if context is not None and total_tokens:
+            context["usage"] = {"prompt_tokens": total_tokens - completion_tokens, "completion_tokens": completion_tokens}
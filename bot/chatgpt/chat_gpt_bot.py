@@ -5,20 +5,25 @@ import time
 import openai
 import openai.error
 import requests
-from common import const
+from common import const, http_client
 from bot.bot import Bot
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
 from bot.openai.open_ai_image import OpenAIImage
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
-from bridge.reply import Reply, ReplyType
+from bridge.reply import Reply, ReplyType, TextStream
+from common.circuit_breaker import backoff_delay, get_circuit_breaker, get_retry_after, is_server_failure, open_reply
+from common.key_pool import get_key_pool
 from common.log import logger
-from common.token_bucket import TokenBucket
+from common.tokenizer import get_tokenizer
+from common.token_bucket import TokenBucketGroup
 from config import conf, load_config
 from bot.baidu.baidu_wenxin_session import BaiduWenxinSession
 
 # OpenAI对话模型API (可用)
 class ChatGPTBot(Bot, OpenAIImage):
+    PROVIDER = "openai"  # 熔断器按服务区分
+
     def __init__(self):
         super().__init__()
         # set the default api_key
@@ -29,7 +34,9 @@ class ChatGPTBot(Bot, OpenAIImage):
         if proxy:
             openai.proxy = proxy
         if conf().get("rate_limit_chatgpt"):
-            self.tb4chatgpt = TokenBucket(conf().get("rate_limit_chatgpt", 20))
+            self.tb4chatgpt = TokenBucketGroup(conf().get("rate_limit_chatgpt", 20))
+        if conf().get("rate_limit_chatgpt_tpm"):
+            self.tpm4chatgpt = TokenBucketGroup(conf().get("rate_limit_chatgpt_tpm", 0))
         conf_model = conf().get("model") or "gpt-3.5-turbo"
         self.sessions = SessionManager(ChatGPTSession, model=conf().get("model") or "gpt-3.5-turbo")
         # o1相关模型不支持system prompt，暂时用文心模型的session
@@ -79,9 +86,11 @@ class ChatGPTBot(Bot, OpenAIImage):
             if model:
                 new_args = self.args.copy()
                 new_args["model"] = model
-            # if context.get('stream'):
-            #     # reply in stream
-            #     return self.reply_text_stream(query, new_query, session_id)
+            if context.get("stream"):
+                # reply in stream, fall back to a normal request if the stream can't be opened
+                reply = self.reply_stream(session, context, api_key, args=new_args)
+                if reply:
+                    return reply
 
             reply_content = self.reply_text(session, api_key, args=new_args)
             logger.debug(
@@ -95,6 +104,7 @@ class ChatGPTBot(Bot, OpenAIImage):
             if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
                 reply = Reply(ReplyType.ERROR, reply_content["content"])
             elif reply_content["completion_tokens"] > 0:
+                self.report_usage(context, reply_content["total_tokens"], reply_content["completion_tokens"])
                 self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
                 reply = Reply(ReplyType.TEXT, reply_content["content"])
             else:
@@ -122,56 +132,191 @@ class ChatGPTBot(Bot, OpenAIImage):
         :param retry_count: retry count
         :return: {}
         """
+        breaker = get_circuit_breaker(self.PROVIDER)
+        if not breaker.allow():
+            return {"completion_tokens": 0, "content": open_reply()}
+        # 用户没有指定api key时，配置了key池则从池中选择负载最低的健康key
+        pool = self._key_pool() if api_key is None else None
+        request_key = api_key
         try:
-            if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
-                raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
             # if api_key == None, the default openai.api_key will be used
             if args is None:
                 args = self.args
-            response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
-            # logger.debug("[CHATGPT] response={}".format(response))
-            # logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            return {
-                "total_tokens": response["usage"]["total_tokens"],
-                "completion_tokens": response["usage"]["completion_tokens"],
-                "content": response.choices[0]["message"]["content"],
-            }
+            if pool:
+                request_key = pool.acquire(session.calc_tokens())
+                if request_key is None:
+                    raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+            elif not self._acquire_rate_limit(session, api_key, args):
+                raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+            # 从key池取得的key在内层finally中按最终结果只归还一次，归还后外层再决定是否换key重试
+            release_status, latency_ms = 0, None
+            try:
+                start = time.monotonic()
+                response = openai.ChatCompletion.create(api_key=request_key, messages=session.request_messages(), **args)
+                release_status, latency_ms = None, (time.monotonic() - start) * 1000  # 已收到响应，之后解析出错不是key的问题
+                breaker.record_success()
+                # logger.debug("[CHATGPT] response={}".format(response))
+                # logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
+                return {
+                    "total_tokens": response["usage"]["total_tokens"],
+                    "completion_tokens": response["usage"]["completion_tokens"],
+                    "content": response.choices[0]["message"]["content"],
+                }
+            except Exception as e:
+                if release_status is not None:
+                    release_status = getattr(e, "http_status", None) or 0
+                raise
+            finally:
+                if pool:
+                    pool.release(request_key, latency_ms=latency_ms, status_code=release_status)
         except Exception as e:
             need_retry = retry_count < 2
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
+            status_code = getattr(e, "http_status", None)
+            retry_after = get_retry_after(e)
+            if isinstance(e, (openai.error.Timeout, openai.error.APIConnectionError)) or is_server_failure(status_code):
+                breaker.record_failure(retry_after)
+            elif status_code:
+                breaker.record_success()
+            delay = 0
+            if pool and status_code in (401, 403, 429) and pool.healthy_count():
+                # 出问题的key已冷却，直接换一个key重试
+                logger.warn("[CHATGPT] key pool request failed with status {}, retry with another key".format(status_code))
+            elif isinstance(e, openai.error.RateLimitError):
                 logger.warn("[CHATGPT] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
+                delay = backoff_delay(retry_count, retry_after)
             elif isinstance(e, openai.error.Timeout):
                 logger.warn("[CHATGPT] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIError):
+                delay = backoff_delay(retry_count)
+            elif isinstance(e, openai.error.APIError) or is_server_failure(status_code):
                 logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
                 result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
+                delay = backoff_delay(retry_count, retry_after)
             elif isinstance(e, openai.error.APIConnectionError):
                 logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
                 result["content"] = "我连接不到你的网络"
-                if need_retry:
-                    time.sleep(5)
+                delay = backoff_delay(retry_count)
             else:
                 logger.exception("[CHATGPT] Exception: {}".format(e))
                 need_retry = False
                 self.sessions.clear_session(session.session_id)
 
+            if delay is None:
+                logger.warn("[CHATGPT] Retry-After {}s is too long, give up retrying".format(retry_after))
+                need_retry = False
+            elif need_retry and delay:
+                time.sleep(delay)
             if need_retry:
                 logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
                 return self.reply_text(session, api_key, args, retry_count + 1)
             else:
                 return result
 
+    def reply_stream(self, session: ChatGPTSession, context, api_key=None, args=None):
+        """
+        call openai's ChatCompletion with stream=True
+        :return: a TEXT_STREAM reply, or None if the request can't be started
+        """
+        breaker = get_circuit_breaker(self.PROVIDER)
+        if not breaker.allow():
+            return None
+        pool = self._key_pool() if api_key is None else None
+        request_key = api_key
+        if args is None:
+            args = self.args
+        try:
+            if pool:
+                request_key = pool.acquire(session.calc_tokens())
+                if request_key is None:
+                    return None
+            elif not self._acquire_rate_limit(session, api_key, args):
+                return None
+            start = time.monotonic()
+            response = openai.ChatCompletion.create(api_key=request_key, messages=session.request_messages(), stream=True, **args)
+            breaker.record_success()
+        except Exception as e:
+            logger.warn("[CHATGPT] open stream failed, fall back to normal request: {}".format(e))
+            status_code = getattr(e, "http_status", None)
+            if pool and request_key:
+                pool.release(request_key, status_code=status_code or 0)
+            if isinstance(e, (openai.error.Timeout, openai.error.APIConnectionError)) or is_server_failure(status_code):
+                breaker.record_failure(get_retry_after(e))
+            return None
+        state = {"parts": [], "status_code": None}  # 已生成的回复和中途出错时的状态码，由on_close统一结算
+        return Reply(
+            ReplyType.TEXT_STREAM,
+            TextStream(
+                self._stream_chunks(response, state),
+                on_close=lambda: self._close_stream(response, state, session, context, pool, request_key, start),
+            ),
+        )
+
+    def _stream_chunks(self, response, state):
+        """逐段返回模型生成的文本"""
+        try:
+            for chunk in response:
+                delta = chunk["choices"][0].get("delta", {}).get("content") if chunk.get("choices") else None
+                if delta:
+                    state["parts"].append(delta)
+                    yield delta
+        except Exception as e:
+            logger.warn("[CHATGPT] stream interrupted: {}".format(e))
+            state["status_code"] = getattr(e, "http_status", None) or 0  # 中途出错时按失败归还key
+            if isinstance(e, (openai.error.Timeout, openai.error.APIConnectionError)) or is_server_failure(state["status_code"]):
+                get_circuit_breaker(self.PROVIDER).record_failure()
+            if not state["parts"]:
+                yield "我现在有点累了，等会再来吧"
+
+    def _close_stream(self, response, state, session, context, pool, request_key, start):
+        """
+        stream生成完毕、被提前关闭(如命中敏感词截断)或未经迭代就被丢弃时调用一次：
+        断开连接、归还key，并把已生成的回复写入会话
+        """
+        close = getattr(response, "close", None)
+        if close is not None:
+            close()
+        if pool:
+            pool.release(request_key, latency_ms=(time.monotonic() - start) * 1000, status_code=state["status_code"])
+        if state["parts"]:
+            self._finish_stream(session, context, "".join(state["parts"]))
+
+    def _finish_stream(self, session, context, content):
+        # 流式响应不返回用量，按tokenizer估算
+        completion_tokens = get_tokenizer(session.model).count(content)
+        total_tokens = session.calc_tokens() + completion_tokens
+        self.report_usage(context, total_tokens, completion_tokens)
+        self.sessions.session_reply(content, session.session_id, total_tokens)
+
+    def _key_pool(self):
+        return get_key_pool(
+            "openai",
+            conf().get("open_ai_api_key"),
+            conf().get("open_ai_api_keys", []),
+            rpm=conf().get("rate_limit_chatgpt", 0),
+            tpm=conf().get("rate_limit_chatgpt_tpm", 0),
+        )
+
+    def _acquire_rate_limit(self, session, api_key, args):
+        """
+        按(api key, 模型)分别限流，rate_limit_chatgpt限制每分钟请求数，rate_limit_chatgpt_tpm按预估的prompt token数限制每分钟token数
+        两个限额都取得才放行，token数超限时归还已取得的请求数额度，被拒绝的请求不占用请求数限额
+        """
+        key = (api_key or openai.api_key, args.get("model"))
+        rpm = conf().get("rate_limit_chatgpt")
+        if rpm and not self.tb4chatgpt.acquire(key):
+            return False
+        if conf().get("rate_limit_chatgpt_tpm") and not self.tpm4chatgpt.acquire(key, session.calc_tokens()):
+            if rpm:
+                self.tb4chatgpt.refund(key)
+            return False
+        return True
+
 
 class AzureChatGPTBot(ChatGPTBot):
+    PROVIDER = "azure"
+
     def __init__(self):
         super().__init__()
         openai.api_type = "azure"
@@ -191,13 +336,13 @@ class AzureChatGPTBot(ChatGPTBot):
             headers = {"api-key": api_key, "Content-Type": "application/json"}
             try:
                 body = {"prompt": query, "size": conf().get("image_create_size", "256x256"),"n": 1}
-                submission = requests.post(url, headers=headers, json=body)
+                submission = http_client.post(url, headers=headers, json=body)
                 operation_location = submission.headers['operation-location']
                 status = ""
                 while (status != "succeeded"):
                     if retry_count > 3:
                         return False, "图片生成失败"
-                    response = requests.get(operation_location, headers=headers)
+                    response = http_client.get(operation_location, headers=headers)
                     status = response.json()['status']
                     retry_count += 1
                 image_url = response.json()['result']['data'][0]['url']
@@ -216,7 +361,7 @@ class AzureChatGPTBot(ChatGPTBot):
             headers = {"api-key": api_key, "Content-Type": "application/json"}
             try:
                 body = {"prompt": query, "size": conf().get("image_create_size", "1024x1024"), "quality": conf().get("dalle3_image_quality", "standard")}
-                response = requests.post(url, headers=headers, json=body)
+                response = http_client.post(url, headers=headers, json=body)
                 response.raise_for_status()  # 检查请求是否成功
                 data = response.json()
 
@@ -1,6 +1,6 @@
 from bot.session_manager import Session
 from common.log import logger
-from common import const
+from common.tokenizer import get_tokenizer
 
 """
     e.g.  [
@@ -16,6 +16,8 @@ class ChatGPTSession(Session):
     def __init__(self, session_id, system_prompt=None, model="gpt-3.5-turbo"):
         super().__init__(session_id, system_prompt)
         self.model = model
+        self.token_counts = []  # 与messages一一对应的(message, content, tokens)，每条消息只计算一次token
+        self.message_tokens = 0  # token_counts中tokens的总和
         self.reset()
 
     def discard_exceeding(self, max_tokens, cur_tokens=None):
@@ -29,11 +31,11 @@ class ChatGPTSession(Session):
             logger.debug("Exception when counting tokens precisely for query: {}".format(e))
         while cur_tokens > max_tokens:
             if len(self.messages) > 2:
-                self.messages.pop(1)
+                self._pop_message(1, precise)
             elif len(self.messages) == 2 and self.messages[1]["role"] == "assistant":
-                self.messages.pop(1)
+                self._pop_message(1, precise)
                 if precise:
-                    cur_tokens = self.calc_tokens()
+                    cur_tokens = self.message_tokens + num_tokens_for_reply(self.model)
                 else:
                     cur_tokens = cur_tokens - max_tokens
                 break
@@ -44,56 +46,56 @@ class ChatGPTSession(Session):
                 logger.debug("max_tokens={}, total_tokens={}, len(messages)={}".format(max_tokens, cur_tokens, len(self.messages)))
                 break
             if precise:
-                cur_tokens = self.calc_tokens()
+                cur_tokens = self.message_tokens + num_tokens_for_reply(self.model)
             else:
                 cur_tokens = cur_tokens - max_tokens
         return cur_tokens
 
     def calc_tokens(self):
-        return num_tokens_from_messages(self.messages, self.model)
+        self._sync_token_counts()
+        return self.message_tokens + num_tokens_for_reply(self.model)
+
+    def _pop_message(self, index, precise=True):
+        """删除一条消息，calc_tokens成功后token_counts与messages保持同步，直接扣减总数"""
+        self.messages.pop(index)
+        if precise:
+            self.message_tokens -= self.token_counts.pop(index)[2]
+
+    def _sync_token_counts(self):
+        """
+        messages可能被外部直接修改(reset、替换列表等)，逐条比较对象是否一致，只为新增或内容变化的消息计算token
+        """
+        counts = self.token_counts
+        if len(counts) == len(self.messages) and all(
+            cached is message and content is message.get("content") for (cached, content, _), message in zip(counts, self.messages)
+        ):
+            return
+        known = {id(cached): (cached, content, tokens) for cached, content, tokens in counts}
+        new_counts = []
+        for message in self.messages:
+            item = known.get(id(message))
+            if item is None or item[0] is not message or item[1] is not message.get("content"):
+                item = (message, message.get("content"), num_tokens_from_message(message, self.model))
+            new_counts.append(item)
+        self.token_counts = new_counts
+        self.message_tokens = sum(tokens for _, _, tokens in new_counts)
 
 
 # refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
 def num_tokens_from_messages(messages, model):
     """Returns the number of tokens used by a list of messages."""
+    tokenizer = get_tokenizer(model)
+    return sum(tokenizer.count_message(message) for message in messages) + tokenizer.reply_tokens
+
 
-    if model in ["wenxin", "xunfei"] or model.startswith(const.GEMINI):
-        return num_tokens_by_character(messages)
+def num_tokens_from_message(message, model):
+    """Returns the number of tokens used by a single message, excluding the reply priming tokens."""
+    return get_tokenizer(model).count_message(message)
 
-    import tiktoken
 
-    if model in ["gpt-3.5-turbo-0301", "gpt-35-turbo", "gpt-3.5-turbo-1106", "moonshot", const.LINKAI_35]:
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    elif model in ["gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613",
-                   "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k", "gpt-4-turbo-preview",
-                   "gpt-4-1106-preview", const.GPT4_TURBO_PREVIEW, const.GPT4_VISION_PREVIEW, const.GPT4_TURBO_01_25,
-                   const.GPT_4o, const.GPT_4O_0806, const.GPT_4o_MINI, const.LINKAI_4o, const.LINKAI_4_TURBO]:
-        return num_tokens_from_messages(messages, model="gpt-4")
-    elif model.startswith("claude-3"):
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        logger.debug("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model == "gpt-3.5-turbo":
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
-    elif model == "gpt-4":
-        tokens_per_message = 3
-        tokens_per_name = 1
-    else:
-        logger.debug(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
-    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-    return num_tokens
+def num_tokens_for_reply(model):
+    """every reply is primed with <|start|>assistant<|message|>"""
+    return get_tokenizer(model).reply_tokens
 
 
 def num_tokens_by_character(messages):
@@ -9,6 +9,7 @@ from bot.openai.open_ai_image import OpenAIImage
 from bot.session_manager import SessionManager
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
+from common.circuit_breaker import backoff_delay, get_circuit_breaker, get_retry_after, is_server_failure, open_reply
 from common.log import logger
 from config import conf
 
@@ -130,6 +131,9 @@ class ClaudeAIBot(Bot, OpenAIImage):
             # exit from retry 2 times
             logger.warn("[CLAUDEAI] failed after maximum number of retry times")
             return Reply(ReplyType.ERROR, "请再问我一次吧")
+        breaker = get_circuit_breaker("claudeai")
+        if not breaker.allow():
+            return Reply(ReplyType.ERROR, open_reply())
 
         try:
             session_id = context["session_id"]
@@ -176,7 +180,15 @@ class ClaudeAIBot(Bot, OpenAIImage):
                 'TE': 'trailers'
             }
 
-            res = requests.post(base_url + "/api/append_message", headers=headers, data=payload,impersonate="chrome110",proxies= self.proxies,timeout=400)
+            try:
+                res = requests.post(base_url + "/api/append_message", headers=headers, data=payload,impersonate="chrome110",proxies= self.proxies,timeout=400)
+            except Exception:
+                breaker.record_failure()
+                raise
+            if is_server_failure(res.status_code):
+                breaker.record_failure(get_retry_after(res))
+            else:
+                breaker.record_success()
             if res.status_code == 200 or "pemission" in res.text:
                 # execute success
                 decoded_data = res.content.decode("utf-8")
@@ -209,14 +221,16 @@ class ClaudeAIBot(Bot, OpenAIImage):
 
                 if res.status_code >= 500:
                     # server error, need retry
-                    time.sleep(2)
-                    logger.warn(f"[CLAUDE] do retry, times={retry_count}")
-                    return self._chat(query, context, retry_count + 1)
+                    delay = backoff_delay(retry_count, get_retry_after(res))
+                    if delay is not None:
+                        time.sleep(delay)
+                        logger.warn(f"[CLAUDE] do retry, times={retry_count}")
+                        return self._chat(query, context, retry_count + 1)
                 return Reply(ReplyType.ERROR, "提问太快啦，请休息一下再问我吧")
 
         except Exception as e:
             logger.exception(e)
             # retry
-            time.sleep(2)
+            time.sleep(backoff_delay(retry_count))
             logger.warn(f"[CLAUDE] do retry, times={retry_count}")
             return self._chat(query, context, retry_count + 1)
@@ -12,6 +12,7 @@ from bot.baidu.baidu_wenxin_session import BaiduWenxinSession
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common.circuit_breaker import backoff_delay, get_circuit_breaker, get_retry_after, is_server_failure, open_reply
 from common.log import logger
 from common import const
 from config import conf
@@ -61,6 +62,7 @@ class ClaudeAPIBot(Bot, OpenAIImage):
                     if total_tokens == 0:
                         reply = Reply(ReplyType.ERROR, reply_content)
                     else:
+                        self.report_usage(context, total_tokens, completion_tokens)
                         self.sessions.session_reply(reply_content, session_id, total_tokens)
                         reply = Reply(ReplyType.TEXT, reply_content)
                 return reply
@@ -74,14 +76,18 @@ class ClaudeAPIBot(Bot, OpenAIImage):
                 return reply
 
     def reply_text(self, session: BaiduWenxinSession, retry_count=0):
+        breaker = get_circuit_breaker("claudeapi")
+        if not breaker.allow():
+            return {"total_tokens": 0, "completion_tokens": 0, "content": open_reply()}
         try:
             actual_model = self._model_mapping(conf().get("model"))
             response = self.claudeClient.messages.create(
                 model=actual_model,
                 max_tokens=4096,
                 system=conf().get("character_desc", ""),
-                messages=session.messages
+                messages=session.request_messages()
             )
+            breaker.record_success()
             # response = openai.Completion.create(prompt=str(session), **self.args)
             res_content = response.content[0].text.strip().replace("<|endoftext|>", "")
             total_tokens = response.usage.input_tokens+response.usage.output_tokens
@@ -95,17 +101,28 @@ class ClaudeAPIBot(Bot, OpenAIImage):
         except Exception as e:
             need_retry = retry_count < 2
             result = {"total_tokens": 0, "completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
+            status_code = getattr(e, "status_code", None)  # anthropic的APIStatusError带有http状态码
+            retry_after = get_retry_after(e)
+            timeout = isinstance(e, (openai.error.Timeout, anthropic.APITimeoutError))
+            connection_error = isinstance(e, (openai.error.APIConnectionError, anthropic.APIConnectionError)) and not timeout
+            if timeout or connection_error or is_server_failure(status_code):
+                breaker.record_failure(retry_after)
+            elif status_code:
+                breaker.record_success()
+            delay = 0
+            if isinstance(e, (openai.error.RateLimitError, anthropic.RateLimitError)):
                 logger.warn("[CLAUDE_API] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
+                delay = backoff_delay(retry_count, retry_after)
+            elif timeout:
                 logger.warn("[CLAUDE_API] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIConnectionError):
+                delay = backoff_delay(retry_count)
+            elif is_server_failure(status_code):
+                logger.warn("[CLAUDE_API] server error: {}".format(e))
+                result["content"] = "请再问我一次"
+                delay = backoff_delay(retry_count, retry_after)
+            elif connection_error:
                 logger.warn("[CLAUDE_API] APIConnectionError: {}".format(e))
                 need_retry = False
                 result["content"] = "我连接不到你的网络"
@@ -114,6 +131,10 @@ class ClaudeAPIBot(Bot, OpenAIImage):
                 need_retry = False
                 self.sessions.clear_session(session.session_id)
 
+            if delay is None:
+                need_retry = False
+            elif need_retry and delay:
+                time.sleep(delay)
             if need_retry:
                 logger.warn("[CLAUDE_API] 第{}次重试".format(retry_count + 1))
                 return self.reply_text(session, retry_count + 1)
@@ -36,6 +36,7 @@ class CoachSession:
 
 class CoachBot(Bot):
     """专属AI教练机器人"""
+    REPLY_CACHE = False  # 回复时会更新用户档案和学习记录，不能使用缓存的回复
     
     def __init__(self):
         super().__init__()
@@ -63,6 +63,7 @@ class DashscopeBot(Bot):
             if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
                 reply = Reply(ReplyType.ERROR, reply_content["content"])
             elif reply_content["completion_tokens"] > 0:
+                self.report_usage(context, reply_content["total_tokens"], reply_content["completion_tokens"])
                 self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
                 reply = Reply(ReplyType.TEXT, reply_content["content"])
             else:
@@ -85,7 +86,7 @@ class DashscopeBot(Bot):
             dashscope.api_key = self.api_key
             response = self.client.call(
                 dashscope_models[self.model_name],
-                messages=session.messages,
+                messages=session.request_messages(),
                 result_format="message"
             )
             if response.status_code == HTTPStatus.OK:
@@ -3,13 +3,15 @@
 
 import re
 import time
-import requests
+from common import http_client
 import config
 from bot.bot import Bot
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
+from bot.session_compactor import session_compactor
 from bot.session_manager import SessionManager
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
+from common.circuit_breaker import backoff_delay, get_circuit_breaker, get_retry_after, open_reply
 from common.log import logger
 from config import conf, pconf
 import threading
@@ -56,6 +58,8 @@ class LinkAIBot(Bot):
             # exit from retry 2 times
             logger.warn("[LINKAI] failed after maximum number of retry times")
             return Reply(ReplyType.TEXT, "请再问我一次吧")
+        if not get_circuit_breaker("linkai").allow():
+            return Reply(ReplyType.TEXT, open_reply())
 
         try:
             # load config
@@ -119,12 +123,10 @@ class LinkAIBot(Bot):
             if file_id:
                 body["file_id"] = file_id
             logger.info(f"[LINKAI] query={query}, app_code={app_code}, model={body.get('model')}, file_id={file_id}")
-            headers = {"Authorization": "Bearer " + linkai_api_key}
 
             # do http request
             base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
-                                timeout=conf().get("request_timeout", 180))
+            res = http_client.post_upstream("linkai", base_url + "/v1/chat/completions", linkai_api_key, json=body)
             if res.status_code == 200:
                 # execute success
                 response = res.json()
@@ -135,6 +137,7 @@ class LinkAIBot(Bot):
                 if res_code == 429:
                     logger.warn(f"[LINKAI] 用户访问超出限流配置，sender_id={body.get('sender_id')}")
                 else:
+                    self.report_usage(context, total_tokens, response["usage"].get("completion_tokens", 0))
                     self.sessions.session_reply(reply_content, session_id, total_tokens, query=query)
                 agent_suffix = self._fetch_agent_suffix(response)
                 if agent_suffix:
@@ -160,9 +163,11 @@ class LinkAIBot(Bot):
 
                 if res.status_code >= 500:
                     # server error, need retry
-                    time.sleep(2)
-                    logger.warn(f"[LINKAI] do retry, times={retry_count}")
-                    return self._chat(query, context, retry_count + 1)
+                    delay = backoff_delay(retry_count, get_retry_after(res))
+                    if delay is not None:
+                        time.sleep(delay)
+                        logger.warn(f"[LINKAI] do retry, times={retry_count}")
+                        return self._chat(query, context, retry_count + 1)
 
                 error_reply = "提问太快啦，请休息一下再问我吧"
                 if res.status_code == 409:
@@ -172,7 +177,7 @@ class LinkAIBot(Bot):
         except Exception as e:
             logger.exception(e)
             # retry
-            time.sleep(2)
+            time.sleep(backoff_delay(retry_count))
             logger.warn(f"[LINKAI] do retry, times={retry_count}")
             return self._chat(query, context, retry_count + 1)
 
@@ -245,11 +250,13 @@ class LinkAIBot(Bot):
                 "completion_tokens": 0,
                 "content": "请再问我一次吧"
             }
+        if not get_circuit_breaker("linkai").allow():
+            return {"total_tokens": 0, "completion_tokens": 0, "content": open_reply()}
 
         try:
             body = {
                 "app_code": app_code,
-                "messages": session.messages,
+                "messages": session.request_messages(),
                 "model": conf().get("model") or "gpt-3.5-turbo",  # 对话模型的名称, 支持 gpt-3.5-turbo, gpt-3.5-turbo-16k, gpt-4, wenxin, xunfei
                 "temperature": conf().get("temperature"),
                 "top_p": conf().get("top_p", 1),
@@ -258,12 +265,10 @@ class LinkAIBot(Bot):
             }
             if self.args.get("max_tokens"):
                 body["max_tokens"] = self.args.get("max_tokens")
-            headers = {"Authorization": "Bearer " + conf().get("linkai_api_key")}
 
             # do http request
             base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
-                                timeout=conf().get("request_timeout", 180))
+            res = http_client.post_upstream("linkai", base_url + "/v1/chat/completions", conf().get("linkai_api_key"), json=body)
             if res.status_code == 200:
                 # execute success
                 response = res.json()
@@ -284,9 +289,11 @@ class LinkAIBot(Bot):
 
                 if res.status_code >= 500:
                     # server error, need retry
-                    time.sleep(2)
-                    logger.warn(f"[LINKAI] do retry, times={retry_count}")
-                    return self.reply_text(session, app_code, retry_count + 1)
+                    delay = backoff_delay(retry_count, get_retry_after(res))
+                    if delay is not None:
+                        time.sleep(delay)
+                        logger.warn(f"[LINKAI] do retry, times={retry_count}")
+                        return self.reply_text(session, app_code, retry_count + 1)
 
                 return {
                     "total_tokens": 0,
@@ -297,7 +304,7 @@ class LinkAIBot(Bot):
         except Exception as e:
             logger.exception(e)
             # retry
-            time.sleep(2)
+            time.sleep(backoff_delay(retry_count))
             logger.warn(f"[LINKAI] do retry, times={retry_count}")
             return self.reply_text(session, app_code, retry_count + 1)
 
@@ -306,7 +313,7 @@ class LinkAIBot(Bot):
         # do http request
         base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
         params = {"app_code": app_code}
-        res = requests.get(url=base_url + "/v1/app/info", params=params, headers=headers, timeout=(5, 10))
+        res = http_client.get(url=base_url + "/v1/app/info", params=params, headers=headers, timeout=(5, 10))
         if res.status_code == 200:
             return res.json()
         else:
@@ -327,7 +334,7 @@ class LinkAIBot(Bot):
                 "img_proxy": conf().get("image_proxy")
             }
             url = conf().get("linkai_api_base", "https://api.link-ai.tech") + "/v1/images/generations"
-            res = requests.post(url, headers=headers, json=data, timeout=(5, 90))
+            res = http_client.post(url, headers=headers, json=data, timeout=(5, 90))
             t2 = time.time()
             image_url = res.json()["data"][0]["url"]
             logger.info("[OPEN_AI] image_url={}".format(image_url))
@@ -430,7 +437,7 @@ def _download_file(url: str):
             os.makedirs(file_path)
         file_name = url.split("/")[-1]  # 获取文件名
         file_path = os.path.join(file_path, file_name)
-        response = requests.get(url)
+        response = http_client.get(url)
         with open(file_path, "wb") as f:
             f.write(response.content)
         return file_path
@@ -441,20 +448,24 @@ def _download_file(url: str):
 class LinkAISessionManager(SessionManager):
     def session_msg_query(self, query, session_id):
         session = self.build_session(session_id)
-        messages = session.messages + [{"role": "user", "content": query}]
+        messages = session.request_messages() + [{"role": "user", "content": query}]
         return messages
 
     def session_reply(self, reply, session_id, total_tokens=None, query=None):
         session = self.build_session(session_id)
-        if query:
-            session.add_query(query)
-        session.add_reply(reply)
-        try:
-            max_tokens = conf().get("conversation_max_tokens", 2500)
-            tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
-            logger.debug(f"[LinkAI] chat history, before tokens={total_tokens}, now tokens={tokens_cnt}")
-        except Exception as e:
-            logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        tokens_cnt = None
+        with session.lock:
+            if query:
+                session.add_query(query)
+            session.add_reply(reply)
+            try:
+                max_tokens = conf().get("conversation_max_tokens", 2500)
+                tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
+                logger.debug(f"[LinkAI] chat history, before tokens={total_tokens}, now tokens={tokens_cnt}")
+            except Exception as e:
+                logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+            self.save_session(session)
+        session_compactor.maybe_compact(self, session, tokens_cnt)
         return session
 
 
@@ -9,10 +9,11 @@ from bot.minimax.minimax_session import MinimaxSession
 from bot.session_manager import SessionManager
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
+from common.circuit_breaker import backoff_delay, get_circuit_breaker, get_retry_after, open_reply
 from common.log import logger
 from config import conf, load_config
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
-import requests
+from common import http_client
 from common import const
 
 
@@ -84,6 +85,7 @@ class MinimaxBot(Bot):
             if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
                 reply = Reply(ReplyType.ERROR, reply_content["content"])
             elif reply_content["completion_tokens"] > 0:
+                self.report_usage(context, reply_content["total_tokens"], reply_content["completion_tokens"])
                 self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
                 reply = Reply(ReplyType.TEXT, reply_content["content"])
             else:
@@ -102,12 +104,14 @@ class MinimaxBot(Bot):
         :param retry_count: retry count
         :return: {}
         """
+        breaker = get_circuit_breaker("minimax")
+        if not breaker.allow():
+            return {"completion_tokens": 0, "content": open_reply()}
         try:
-            headers = {"Content-Type": "application/json", "Authorization": "Bearer " + self.api_key}
-            self.request_body["messages"].extend(session.messages)
+            self.request_body["messages"].extend(session.request_messages())
             logger.info("[Minimax_AI] request_body={}".format(self.request_body))
             # logger.info("[Minimax_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            res = requests.post(self.base_url, headers=headers, json=self.request_body)
+            res = http_client.post_upstream("minimax", self.base_url, self.api_key, json=self.request_body)
 
             # self.request_body["messages"].extend(response.json()["choices"][0]["messages"])
             if res.status_code == 200:
@@ -136,8 +140,9 @@ class MinimaxBot(Bot):
                 else:
                     need_retry = False
 
-                if need_retry:
-                    time.sleep(3)
+                delay = backoff_delay(retry_count, get_retry_after(res)) if need_retry else None
+                if delay is not None:
+                    time.sleep(delay)
                     return self.reply_text(session, args, retry_count + 1)
                 else:
                     return result
@@ -146,6 +151,7 @@ class MinimaxBot(Bot):
             need_retry = retry_count < 2
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             if need_retry:
+                time.sleep(backoff_delay(retry_count))
                 return self.reply_text(session, args, retry_count + 1)
             else:
                 return result
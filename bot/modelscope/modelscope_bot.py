@@ -8,10 +8,11 @@ from bot.bot import Bot
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common.circuit_breaker import backoff_delay, get_circuit_breaker, get_retry_after, open_reply
 from common.log import logger
 from config import conf, load_config
 from .modelscope_session import ModelScopeSession
-import requests
+from common import http_client
 
 
 # ModelScope对话模型API
@@ -81,6 +82,7 @@ class ModelScopeBot(Bot):
                 else:
                     reply = Reply(ReplyType.TEXT, reply_content["content"])
             elif reply_content["completion_tokens"] > 0:
+                self.report_usage(context, reply_content["total_tokens"], reply_content["completion_tokens"])
                 self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
                 reply = Reply(ReplyType.TEXT, reply_content["content"])
             else:
@@ -107,19 +109,12 @@ class ModelScopeBot(Bot):
         :param retry_count: retry count
         :return: {}
         """
+        if not get_circuit_breaker("modelscope").allow():
+            return {"completion_tokens": 0, "content": open_reply()}
         try:
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": "Bearer " + self.api_key
-            }
-            
             body = args
-            body["messages"] = session.messages
-            res = requests.post(
-                self.base_url,
-                headers=headers,
-                data=json.dumps(body)
-            )
+            body["messages"] = session.request_messages()
+            res = self._post(data=json.dumps(body))
 
             if res.status_code == 200:
                 response = res.json()
@@ -147,14 +142,16 @@ class ModelScopeBot(Bot):
                     need_retry = retry_count < 2
                 elif res.status_code == 401:
                     result["content"] = "授权失败，请检查API Key是否正确"
+                    need_retry = retry_count < 2 and bool(conf().get("modelscope_api_keys"))  # 配置了key池时换一个key重试
                 elif res.status_code == 429:
                     result["content"] = "请求过于频繁，请稍后再试"
                     need_retry = retry_count < 2
                 else:
                     need_retry = False
 
-                if need_retry:
-                    time.sleep(3)
+                delay = backoff_delay(retry_count, get_retry_after(res)) if need_retry else None
+                if delay is not None:
+                    time.sleep(delay)
                     return self.reply_text(session, args, retry_count + 1)
                 else:
                     return result
@@ -163,6 +160,7 @@ class ModelScopeBot(Bot):
             need_retry = retry_count < 2
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             if need_retry:
+                time.sleep(backoff_delay(retry_count))
                 return self.reply_text(session, args, retry_count + 1)
             else:
                 return result
@@ -175,22 +173,14 @@ class ModelScopeBot(Bot):
         :param retry_count: retry count
         :return: {}
         """
+        if not get_circuit_breaker("modelscope").allow():
+            return {"completion_tokens": 0, "content": open_reply()}
         try:
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": "Bearer " + self.api_key
-            }
-            
             body = args
-            body["messages"] = session.messages
+            body["messages"] = session.request_messages()
             body["stream"] = True  # 启用流式响应
 
-            res = requests.post(
-                self.base_url,
-                headers=headers,
-                data=json.dumps(body),
-                stream=True
-            )
+            res = self._post(data=json.dumps(body), stream=True)
             if res.status_code == 200:
                 content = ""
                 for line in res.iter_lines():
@@ -228,14 +218,16 @@ class ModelScopeBot(Bot):
                     need_retry = retry_count < 2
                 elif res.status_code == 401:
                     result["content"] = "授权失败，请检查API Key是否正确"
+                    need_retry = retry_count < 2 and bool(conf().get("modelscope_api_keys"))  # 配置了key池时换一个key重试
                 elif res.status_code == 429:
                     result["content"] = "请求过于频繁，请稍后再试"
                     need_retry = retry_count < 2
                 else:
                     need_retry = False
 
-                if need_retry:
-                    time.sleep(3)
+                delay = backoff_delay(retry_count, get_retry_after(res)) if need_retry else None
+                if delay is not None:
+                    time.sleep(delay)
                     return self.reply_text_stream(session, args, retry_count + 1)
                 else:
                     return result
@@ -244,9 +236,15 @@ class ModelScopeBot(Bot):
             need_retry = retry_count < 2
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             if need_retry:
+                time.sleep(backoff_delay(retry_count))
                 return self.reply_text_stream(session, args, retry_count + 1)
             else:
                 return result
+
+    def _post(self, **kwargs):
+        """发送对话请求，配置了modelscope_api_keys时使用key池"""
+        return http_client.post_upstream("modelscope", self.base_url, self.api_key, conf().get("modelscope_api_keys", []), **kwargs)
+
     def create_img(self, query, retry_count=0):
         try:
             logger.info("[ModelScopeImage] image_query={}".format(query))
@@ -265,7 +263,7 @@ class ModelScopeBot(Bot):
             json_payload = json.dumps(payload, ensure_ascii=False).encode('utf-8')
             
             # 使用 data 参数发送原始字符串（requests 会自动处理编码）
-            res = requests.post(url, headers=headers, data=json_payload)
+            res = http_client.post(url, headers=headers, data=json_payload)
             
             response_data = res.json()
             image_url = response_data['images'][0]['url']
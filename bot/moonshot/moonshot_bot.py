@@ -8,10 +8,11 @@ from bot.bot import Bot
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common.circuit_breaker import backoff_delay, get_circuit_breaker, get_retry_after, open_reply
 from common.log import logger
 from config import conf, load_config
 from .moonshot_session import MoonshotSession
-import requests
+from common import http_client
 
 
 # ZhipuAI对话模型API
@@ -72,6 +73,7 @@ class MoonshotBot(Bot):
             if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
                 reply = Reply(ReplyType.ERROR, reply_content["content"])
             elif reply_content["completion_tokens"] > 0:
+                self.report_usage(context, reply_content["total_tokens"], reply_content["completion_tokens"])
                 self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
                 reply = Reply(ReplyType.TEXT, reply_content["content"])
             else:
@@ -90,20 +92,14 @@ class MoonshotBot(Bot):
         :param retry_count: retry count
         :return: {}
         """
+        if not get_circuit_breaker("moonshot").allow():
+            return {"completion_tokens": 0, "content": open_reply()}
         try:
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": "Bearer " + self.api_key
-            }
             body = args
-            body["messages"] = session.messages
+            body["messages"] = session.request_messages()
             # logger.debug("[MOONSHOT_AI] response={}".format(response))
             # logger.info("[MOONSHOT_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            res = requests.post(
-                self.base_url,
-                headers=headers,
-                json=body
-            )
+            res = self._post(json=body)
             if res.status_code == 200:
                 response = res.json()
                 return {
@@ -125,14 +121,16 @@ class MoonshotBot(Bot):
                     need_retry = retry_count < 2
                 elif res.status_code == 401:
                     result["content"] = "授权失败，请检查API Key是否正确"
+                    need_retry = retry_count < 2 and bool(conf().get("moonshot_api_keys"))  # 配置了key池时换一个key重试
                 elif res.status_code == 429:
                     result["content"] = "请求过于频繁，请稍后再试"
                     need_retry = retry_count < 2
                 else:
                     need_retry = False
 
-                if need_retry:
-                    time.sleep(3)
+                delay = backoff_delay(retry_count, get_retry_after(res)) if need_retry else None
+                if delay is not None:
+                    time.sleep(delay)
                     return self.reply_text(session, args, retry_count + 1)
                 else:
                     return result
@@ -141,6 +139,11 @@ class MoonshotBot(Bot):
             need_retry = retry_count < 2
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             if need_retry:
+                time.sleep(backoff_delay(retry_count))
                 return self.reply_text(session, args, retry_count + 1)
             else:
                 return result
+
+    def _post(self, **kwargs):
+        """发送对话请求，配置了moonshot_api_keys时使用key池"""
+        return http_client.post_upstream("moonshot", self.base_url, self.api_key, conf().get("moonshot_api_keys", []), **kwargs)
@@ -11,6 +11,7 @@ from bot.openai.open_ai_session import OpenAISession
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common.circuit_breaker import backoff_delay, get_circuit_breaker, get_retry_after, is_server_failure, open_reply
 from common.log import logger
 from config import conf
 
@@ -69,6 +70,7 @@ class OpenAIBot(Bot, OpenAIImage):
                     if total_tokens == 0:
                         reply = Reply(ReplyType.ERROR, reply_content)
                     else:
+                        self.report_usage(context, total_tokens, completion_tokens)
                         self.sessions.session_reply(reply_content, session_id, total_tokens)
                         reply = Reply(ReplyType.TEXT, reply_content)
                 return reply
@@ -82,8 +84,12 @@ class OpenAIBot(Bot, OpenAIImage):
                 return reply
 
     def reply_text(self, session: OpenAISession, retry_count=0):
+        breaker = get_circuit_breaker("openai")
+        if not breaker.allow():
+            return {"completion_tokens": 0, "content": open_reply()}
         try:
             response = openai.Completion.create(prompt=str(session), **self.args)
+            breaker.record_success()
             res_content = response.choices[0]["text"].strip().replace("<|endoftext|>", "")
             total_tokens = response["usage"]["total_tokens"]
             completion_tokens = response["usage"]["completion_tokens"]
@@ -96,16 +102,21 @@ class OpenAIBot(Bot, OpenAIImage):
         except Exception as e:
             need_retry = retry_count < 2
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+            status_code = getattr(e, "http_status", None)
+            retry_after = get_retry_after(e)
+            if isinstance(e, (openai.error.Timeout, openai.error.APIConnectionError)) or is_server_failure(status_code):
+                breaker.record_failure(retry_after)
+            elif status_code:
+                breaker.record_success()
+            delay = 0
             if isinstance(e, openai.error.RateLimitError):
                 logger.warn("[OPEN_AI] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
+                delay = backoff_delay(retry_count, retry_after)
             elif isinstance(e, openai.error.Timeout):
                 logger.warn("[OPEN_AI] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
+                delay = backoff_delay(retry_count)
             elif isinstance(e, openai.error.APIConnectionError):
                 logger.warn("[OPEN_AI] APIConnectionError: {}".format(e))
                 need_retry = False
@@ -115,6 +126,10 @@ class OpenAIBot(Bot, OpenAIImage):
                 need_retry = False
                 self.sessions.clear_session(session.session_id)
 
+            if delay is None:
+                need_retry = False
+            elif need_retry and delay:
+                time.sleep(delay)
             if need_retry:
                 logger.warn("[OPEN_AI] 第{}次重试".format(retry_count + 1))
                 return self.reply_text(session, retry_count + 1)
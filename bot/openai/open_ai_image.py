@@ -4,7 +4,7 @@ import openai
 import openai.error
 
 from common.log import logger
-from common.token_bucket import TokenBucket
+from common.token_bucket import TokenBucketGroup
 from config import conf
 
 
@@ -13,11 +13,11 @@ class OpenAIImage(object):
     def __init__(self):
         openai.api_key = conf().get("open_ai_api_key")
         if conf().get("rate_limit_dalle"):
-            self.tb4dalle = TokenBucket(conf().get("rate_limit_dalle", 50))
+            self.tb4dalle = TokenBucketGroup(conf().get("rate_limit_dalle", 50))  # 按api key分别限流
 
     def create_img(self, query, retry_count=0, api_key=None, api_base=None):
         try:
-            if conf().get("rate_limit_dalle") and not self.tb4dalle.get_token():
+            if conf().get("rate_limit_dalle") and not self.tb4dalle.acquire(api_key or openai.api_key):
                 return False, "请求太快了，请休息一下再问我吧"
             logger.info("[OPEN_AI] image_query={}".format(query))
             response = openai.Image.create(
@@ -0,0 +1,161 @@
+"""
+回复缓存：相同人设、相同的最近几轮对话下问到相同或相近的问题时，直接返回之前的回复，不再调用模型
+
+- 精确匹配：按规范化后的(bot, 模型, 人设, 最近reply_cache_turns轮对话, 问题)缓存，有效期reply_cache_ttl秒，超出reply_cache_max_size时按LRU淘汰
+- 语义匹配(可选)：在同一(bot, 模型, 人设, 最近几轮对话)下，按问题的字符二元组向量计算余弦相似度，
+  超过reply_cache_semantic_threshold时命中，向量和倒排索引都在本地内存中，不依赖外部的embedding服务
+"""
+import hashlib
+import json
+import math
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from common.expired_dict import ExpiredDict
+from common.log import logger
+from common.metrics import metrics
+from config import conf
+
+_PUNCTUATION = re.compile(r"[\s　，。！？、；：,.!?;:~～…\"'“”‘’（）()]+")
+
+
+def normalize(text):
+    """规范化问题：去掉空白和标点并转为小写，"你是谁？"与"你是谁"视为同一个问题"""
+    return _PUNCTUATION.sub("", text).lower()
+
+
+def embed(text):
+    """问题的字符二元组向量，返回(词频, 模长)"""
+    text = normalize(text)
+    grams = Counter(text[i : i + 2] for i in range(len(text) - 1)) if len(text) > 1 else Counter([text])
+    return grams, math.sqrt(sum(v * v for v in grams.values()))
+
+
+class SemanticIndex(object):
+    """按分区保存问题向量的倒排索引，只和同一分区中至少有一个相同二元组的问题计算相似度"""
+
+    def __init__(self):
+        self.entries = OrderedDict()  # entry_id -> (分区, 向量, 模长, 缓存值, 过期时间)，越靠前越久未命中
+        self.postings = {}  # (分区, 二元组) -> {entry_id}
+        self.next_id = 0
+
+    def add(self, partition, query, value, ttl, max_size):
+        vector, norm = embed(query)
+        if not norm:
+            return
+        entry_id = self.next_id
+        self.next_id += 1
+        self.entries[entry_id] = (partition, vector, norm, value, time.monotonic() + ttl)
+        for gram in vector:
+            self.postings.setdefault((partition, gram), set()).add(entry_id)
+        while len(self.entries) > max_size:
+            self._remove(next(iter(self.entries)))
+
+    def search(self, partition, query, threshold):
+        vector, norm = embed(query)
+        if not norm:
+            return None
+        candidates = set()
+        for gram in vector:
+            candidates.update(self.postings.get((partition, gram), ()))
+        now = time.monotonic()
+        best, best_id, best_score = None, None, threshold
+        for entry_id in candidates:
+            _, other, other_norm, value, expiry_time = self.entries[entry_id]
+            if expiry_time < now:
+                self._remove(entry_id)
+                continue
+            score = sum(count * other.get(gram, 0) for gram, count in vector.items()) / (norm * other_norm)
+            if score >= best_score:
+                best, best_id, best_score = value, entry_id, score
+        if best_id is not None:
+            self.entries.move_to_end(best_id)
+        return best
+
+    def _remove(self, entry_id):
+        partition, vector, _, _, _ = self.entries.pop(entry_id)
+        for gram in vector:
+            ids = self.postings.get((partition, gram))
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del self.postings[(partition, gram)]
+
+    def clear(self):
+        self.entries.clear()
+        self.postings.clear()
+
+
+class ReplyCache(object):
+    def __init__(self):
+        self.exact = None  # ExpiredDict，key -> ((回复文本, token数), 过期时间)，配置变化时重新创建
+        self.exact_conf = None
+        self.semantic = SemanticIndex()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.lookups = 0
+        metrics.set_gauge("reply_cache_hit_ratio", lambda: round(self.hits / self.lookups, 4) if self.lookups else 0)
+
+    def _exact_cache(self):
+        ttl, max_size = conf().get("reply_cache_ttl", 3600), conf().get("reply_cache_max_size", 1000)
+        if self.exact is None or self.exact_conf != (ttl, max_size):
+            self.exact = ExpiredDict(ttl, max_size)
+            self.exact_conf = (ttl, max_size)
+        return self.exact
+
+    @staticmethod
+    def make_key(bot_type, model, system_prompt, messages, query):
+        """
+        返回(分区, 精确匹配的key)，分区包含bot、模型、人设和最近reply_cache_turns轮对话
+        :param messages: 会话中不含system prompt的历史消息
+        """
+        turns = conf().get("reply_cache_turns", 1)
+        recent = [(m["role"], normalize(m["content"])) for m in messages[-2 * turns :]] if turns else []
+        raw = json.dumps([bot_type, model, system_prompt, recent], ensure_ascii=False, default=str)
+        partition = hashlib.md5(raw.encode("utf-8")).hexdigest()
+        return partition, (partition, normalize(query))
+
+    def get(self, partition, key, query):
+        """
+        查询缓存，命中时返回(回复文本, 原始调用消耗的token数, 命中的层级)
+        """
+        with self.lock:
+            self.lookups += 1
+            tier = "exact"
+            value = None
+            exact = self._exact_cache()
+            entry = exact.get(key)
+            if entry is not None:
+                if entry[1] > time.monotonic():
+                    value = entry[0]
+                else:
+                    del exact[key]
+            if value is None and conf().get("reply_cache_semantic", False):
+                tier = "semantic"
+                value = self.semantic.search(partition, query, conf().get("reply_cache_semantic_threshold", 0.8))
+            if value is None:
+                metrics.incr("reply_cache_miss")
+                return None
+            self.hits += 1
+        metrics.incr("reply_cache_hit", labels=(tier,))
+        metrics.incr("reply_cache_saved_tokens", value[1])
+        logger.debug("[ReplyCache] {} hit, query={}".format(tier, query))
+        return value + (tier,)
+
+    def put(self, partition, key, query, text, tokens):
+        value = (text, tokens)
+        with self.lock:
+            # 过期时间从写入时算起，ExpiredDict读取时会顺延有效期，这里只用它做LRU淘汰
+            self._exact_cache()[key] = (value, time.monotonic() + conf().get("reply_cache_ttl", 3600))
+            if conf().get("reply_cache_semantic", False):
+                self.semantic.add(partition, query, value, conf().get("reply_cache_ttl", 3600), conf().get("reply_cache_max_size", 1000))
+
+    def clear(self):
+        with self.lock:
+            self.exact = None
+            self.semantic.clear()
+
+
+reply_cache = ReplyCache()
@@ -0,0 +1,272 @@
+# encoding:utf-8
+"""
+多后端路由：按顺序包装多个OpenAI兼容的对话接口(如硅基流动的DeepSeek + 备用的OpenAI兼容接口)
+
+- 主后端超过对冲时间仍未返回第一段文本时，向下一个后端发出对冲请求，先返回文本的后端胜出，其余请求被取消
+- 对冲时间取该后端最近首字延迟的router_hedge_percentile分位数，限制在[router_hedge_min_delay, router_hedge_max_delay]之间
+- 后端请求失败或处于熔断状态时立即转到下一个后端
+- 所有后端共用一份会话历史
+"""
+import json
+import queue
+import threading
+import time
+from collections import deque
+
+from bot.bot import Bot
+from bot.chatgpt.chat_gpt_session import ChatGPTSession
+from bot.session_manager import SessionManager
+from bridge.context import ContextType
+from bridge.reply import Reply, ReplyType, TextStream
+from common import http_client
+from common.circuit_breaker import get_circuit_breaker, get_retry_after, is_server_failure
+from common.log import logger
+from common.metrics import metrics
+from common.tokenizer import get_tokenizer
+from config import conf, load_config
+
+LATENCY_WINDOW = 200  # 每个后端保留最近多少次的首字延迟用于计算对冲时间
+MIN_SAMPLES = 20  # 样本不足时使用router_hedge_max_delay作为对冲时间
+
+
+class Backend(object):
+    def __init__(self, name, api_base, api_key, model):
+        self.name = name
+        self.url = api_base.rstrip("/") + "/chat/completions"
+        self.api_key = api_key
+        self.model = model
+        self.latencies = deque(maxlen=LATENCY_WINDOW)  # 最近的首字延迟(秒)
+        self.lock = threading.Lock()
+        self.breaker = get_circuit_breaker("router_" + name)
+
+    def observe(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+        metrics.observe("router_first_token_ms", latency * 1000, labels=(self.name,))
+
+    def hedge_delay(self):
+        """发出对冲请求前等待的秒数"""
+        min_delay, max_delay = conf().get("router_hedge_min_delay", 0.5), conf().get("router_hedge_max_delay", 5)
+        with self.lock:
+            samples = sorted(self.latencies)
+        if len(samples) < MIN_SAMPLES:
+            return max_delay
+        index = min(len(samples) - 1, int(len(samples) * conf().get("router_hedge_percentile", 95) / 100))
+        return min(max(samples[index], min_delay), max_delay)
+
+
+class Attempt(object):
+    """对一个后端的一次流式请求，在后台线程中等待第一段文本，结果放入events队列"""
+
+    def __init__(self, backend, messages, events):
+        self.backend = backend
+        self.messages = messages
+        self.events = events
+        self.cancelled = threading.Event()
+        self.response = None
+        self.deltas = None  # 第一段文本之后的文本迭代器，由胜出方的调用线程继续消费
+        self.first_received = False
+
+    def start(self):
+        threading.Thread(target=self._run, name="router_" + self.backend.name, daemon=True).start()
+        return self
+
+    def _run(self):
+        backend = self.backend
+        body = {
+            "model": backend.model,
+            "messages": self.messages,
+            "temperature": conf().get("temperature", 0.9),
+            "stream": True,
+        }
+        headers = {"Content-Type": "application/json", "Authorization": "Bearer " + backend.api_key}
+        start = time.monotonic()
+        try:
+            res = http_client.post(backend.url, headers=headers, json=body, stream=True)
+        except Exception as e:
+            logger.warn("[ROUTER] {} request failed: {}".format(backend.name, e))
+            backend.breaker.record_failure()
+            self.events.put((self, None))
+            return
+        self.response = res
+        if res.status_code != 200:
+            logger.warn("[ROUTER] {} request failed, status_code={}, body={}".format(backend.name, res.status_code, res.text[:200]))
+            if is_server_failure(res.status_code):
+                backend.breaker.record_failure(get_retry_after(res))
+            else:
+                backend.breaker.record_success()
+            self.close()
+            self.events.put((self, None))
+            return
+        backend.breaker.record_success()
+        first = None
+        try:
+            self.deltas = _iter_deltas(res)
+            first = next(self.deltas, None)
+        except Exception as e:
+            logger.warn("[ROUTER] {} stream interrupted: {}".format(backend.name, e))
+        if first is not None:
+            backend.observe(time.monotonic() - start)
+            self.first_received = True
+        if first is None or self.cancelled.is_set():
+            self.close()
+            first = None
+        self.events.put((self, first))
+
+    def cancel(self):
+        """
+        取消请求：已收到第一段文本时立即断开连接，否则在收到第一段文本后断开，
+        这样落败的后端也能记下首字延迟，慢的后端不会因为总是被取消而低估对冲时间
+        """
+        self.cancelled.set()
+        if self.first_received:
+            self.close()
+
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+
+
+def _iter_deltas(res):
+    """逐段返回SSE响应中的文本"""
+    for line in res.iter_lines():
+        if not line or not line.startswith(b"data:"):
+            continue
+        data = line[5:].strip()
+        if data == b"[DONE]":
+            return
+        chunk = json.loads(data)
+        delta = chunk["choices"][0].get("delta", {}).get("content") if chunk.get("choices") else None
+        if delta:
+            yield delta
+
+
+class RouterBot(Bot):
+    def __init__(self):
+        super().__init__()
+        self.backends = []
+        self.backends_conf = None
+        primary = self._backends()[0]
+        self.sessions = SessionManager(ChatGPTSession, model=primary.model)
+
+    def _backends(self):
+        """按router_backends配置创建后端，未配置时使用open_ai_api_base和model作为唯一后端，配置变化时重新创建"""
+        backends_conf = conf().get("router_backends", []) or [
+            {
+                "name": "openai",
+                "api_base": conf().get("open_ai_api_base") or "https://api.openai.com/v1",
+                "api_key": conf().get("open_ai_api_key"),
+                "model": conf().get("model") or "gpt-3.5-turbo",
+            }
+        ]
+        if backends_conf != self.backends_conf:
+            self.backends = [Backend(item["name"], item["api_base"], item["api_key"], item["model"]) for item in backends_conf]
+            self.backends_conf = backends_conf
+            logger.info("[ROUTER] backends: {}".format([backend.name for backend in self.backends]))
+        return self.backends
+
+    def reply(self, query, context=None):
+        if context.type != ContextType.TEXT:
+            return Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
+        logger.info("[ROUTER] query={}".format(query))
+        session_id = context["session_id"]
+        clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
+        if query in clear_memory_commands:
+            self.sessions.clear_session(session_id)
+            return Reply(ReplyType.INFO, "记忆已清除")
+        elif query == "#清除所有":
+            self.sessions.clear_all_session()
+            return Reply(ReplyType.INFO, "所有人记忆已清除")
+        elif query == "#更新配置":
+            load_config()
+            return Reply(ReplyType.INFO, "配置已更新")
+
+        session = self.sessions.session_query(query, session_id)
+        attempt, first = self._race(session.request_messages())
+        if attempt is None:
+            return Reply(ReplyType.ERROR, "我现在有点累了，等会再来吧")
+        stream = TextStream(
+            self._stream_chunks(attempt, first),
+            on_close=lambda: self._close_stream(attempt, stream, session, context),
+        )
+        if context.get("stream"):
+            return Reply(ReplyType.TEXT_STREAM, stream)
+        return Reply(ReplyType.TEXT, stream.read())
+
+    def _race(self, messages):
+        """
+        按顺序向后端发出请求：等待超过当前后端的对冲时间时发出对冲请求，请求失败时立即转到下一个后端
+        :return: (胜出的Attempt, 第一段文本)，全部失败或超时返回(None, None)
+        """
+        events = queue.Queue()
+        pending = list(self._backends())
+        attempts = []
+
+        def launch():
+            while pending:
+                backend = pending.pop(0)
+                if backend.breaker.allow():
+                    attempts.append(Attempt(backend, messages, events).start())
+                    return attempts[-1]
+                metrics.incr("router_skipped", labels=(backend.name,))
+            return None
+
+        current = launch()
+        if current is None:
+            return None, None
+        running = 1
+        hedge = conf().get("router_hedge", True)
+        hedge_at = time.monotonic() + current.backend.hedge_delay()
+        end = time.monotonic() + conf().get("request_timeout", 180)
+        while running:
+            wait_until = min(hedge_at, end) if hedge and pending else end
+            try:
+                attempt, first = events.get(timeout=max(0.0, wait_until - time.monotonic()))
+            except queue.Empty:
+                if time.monotonic() >= end:
+                    break
+                current = launch()
+                if current is not None:
+                    running += 1
+                    metrics.incr("router_hedged", labels=(current.backend.name,))
+                    logger.info("[ROUTER] hedge request to {}".format(current.backend.name))
+                    hedge_at = time.monotonic() + current.backend.hedge_delay()
+                continue
+            running -= 1
+            if first is not None:
+                for other in attempts:
+                    if other is not attempt:
+                        other.cancel()
+                metrics.incr("router_won", labels=(attempt.backend.name,))
+                return attempt, first
+            current = launch()
+            if current is not None:
+                running += 1
+                metrics.incr("router_failover", labels=(current.backend.name,))
+                logger.warn("[ROUTER] {} failed, fail over to {}".format(attempt.backend.name, current.backend.name))
+                hedge_at = time.monotonic() + current.backend.hedge_delay()
+        for attempt in attempts:
+            attempt.cancel()
+        return None, None
+
+    def _stream_chunks(self, attempt, first):
+        """返回胜出后端生成的文本"""
+        try:
+            yield first
+            for delta in attempt.deltas:
+                yield delta
+        except Exception as e:
+            logger.warn("[ROUTER] {} stream interrupted: {}".format(attempt.backend.name, e))
+            attempt.backend.breaker.record_failure()
+
+    def _close_stream(self, attempt, stream, session, context):
+        """stream生成完毕、被提前关闭或未经迭代就被丢弃时调用一次：断开连接，把已发出的回复写入会话"""
+        attempt.close()
+        content = stream.text
+        if not content:
+            return
+        # 流式响应不返回用量，按tokenizer估算
+        completion_tokens = get_tokenizer(attempt.backend.model).count(content)
+        total_tokens = session.calc_tokens() + completion_tokens
+        self.report_usage(context, total_tokens, completion_tokens)
+        self.sessions.session_reply(content, session.session_id, total_tokens)
@@ -0,0 +1,122 @@
+import sys
+import threading
+import weakref
+from collections import OrderedDict
+
+from common.log import logger
+from common.metrics import metrics
+from config import conf
+
+
+def estimate_session_bytes(session):
+    """
+    估算会话历史占用的内存字节数
+    人设字符串已驻留，由所有会话共享同一个对象，只计入消息本身，不计入每个会话的预算
+    """
+    system_prompt = getattr(session, "system_prompt", None)
+    size = 0
+    for message in session.messages:
+        size += sys.getsizeof(message)
+        content = message.get("content", "")
+        if content is not system_prompt:
+            size += sys.getsizeof(content)
+    return size
+
+
+class SessionBudget(object):
+    """
+    所有SessionManager共享的会话内存预算，超出session_max_count或session_max_bytes时按LRU淘汰会话
+    配置了持久化存储时，被淘汰的会话在下次访问时会从存储中重新加载
+    """
+
+    def __init__(self):
+        self.lru = OrderedDict()  # (id(manager), session_id) -> [manager弱引用, 估算字节数, session弱引用]，越靠前越久未访问
+        self.total_bytes = 0
+        self.evicted_count = 0
+        self.managers = weakref.WeakSet()
+        self.lock = threading.Lock()
+        metrics.set_gauge("session_live", lambda: sum(len(manager.sessions) for manager in list(self.managers)))
+        metrics.set_gauge("session_history_bytes", lambda: self.total_bytes)
+
+    def touch(self, manager, session, resize=True):
+        """
+        会话被访问或修改后调用，更新LRU顺序和占用字节数，并淘汰超出预算的会话
+        :param resize: 会话内容没有变化时为False，已记录的会话只调整LRU顺序
+        """
+        key = (id(manager), session.session_id)
+        with self.lock:
+            entry = self.lru.get(key)
+            if entry is not None and not resize:
+                self.lru.move_to_end(key)
+                return
+        size = estimate_session_bytes(session)
+        with self.lock:
+            self.managers.add(manager)
+            entry = self.lru.get(key)
+            if entry is None:
+                self.lru[key] = [weakref.ref(manager), size, weakref.ref(session)]
+            else:
+                self.total_bytes -= entry[1]
+                entry[1] = size
+                entry[2] = weakref.ref(session)
+                self.lru.move_to_end(key)
+            self.total_bytes += size
+            victims = self._pick_victims()
+        for victim, session_id, victim_session in victims:
+            try:
+                victim.evict_session(session_id, victim_session)
+            finally:
+                victim_session.lock.release()
+
+    # 从最久未访问的会话开始选出需要淘汰的会话，调用方需持有self.lock
+    # 当前访问的会话和正在被其他线程修改的会话(session.lock被占用)不会被淘汰，选中的会话返回时已持有其session.lock
+    def _pick_victims(self):
+        max_count = conf().get("session_max_count", 0)
+        max_bytes = conf().get("session_max_bytes", 0)
+        count, total_bytes = len(self.lru), self.total_bytes
+        current = next(reversed(self.lru), None)
+        picked = []
+        for key, (manager_ref, size, session_ref) in self.lru.items():
+            if key == current or not ((max_count and count > max_count) or (max_bytes and total_bytes > max_bytes)):
+                break
+            session = session_ref()
+            if session is not None and not session.lock.acquire(blocking=False):
+                continue
+            picked.append((key, manager_ref(), session))
+            count -= 1
+            total_bytes -= size
+        victims = []
+        for key, manager, session in picked:
+            del self.lru[key]
+            if manager is not None and session is not None:
+                victims.append((manager, key[1], session))
+            elif session is not None:
+                session.lock.release()
+        self.total_bytes = total_bytes
+        if victims:
+            self.evicted_count += len(victims)
+            metrics.incr("session_evicted", len(victims))
+            logger.debug("[SessionBudget] evict {} sessions, live={}, bytes={}".format(len(victims), len(self.lru), self.total_bytes))
+        return victims
+
+    def remove(self, manager, session_id, session=None):
+        """
+        会话被删除或过期时调用
+        :param session: 不为None时只在记录的是同一个会话对象时删除，避免误删同一session_id新建的会话
+        """
+        key = (id(manager), session_id)
+        with self.lock:
+            entry = self.lru.get(key)
+            if entry is None or (session is not None and entry[2]() not in (None, session)):
+                return
+            del self.lru[key]
+            self.total_bytes -= entry[1]
+
+    def remove_manager(self, manager):
+        with self.lock:
+            for key in [key for key in self.lru if key[0] == id(manager)]:
+                self.total_bytes -= self.lru.pop(key)[1]
+
+
+# 进程内所有SessionManager共享
+session_budget = SessionBudget()
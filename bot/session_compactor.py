@@ -0,0 +1,100 @@
+"""
+会话滚动摘要：历史超过高水位时，在后台把最早的若干轮对话总结成摘要，追加在system prompt之后，代替直接丢弃
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bridge.context import Context, ContextType
+from bridge.reply import ReplyType
+from common.log import logger
+from common.metrics import metrics
+from config import conf
+
+SUMMARY_PREFIX = "\n\n以下是你与用户之前对话的摘要：\n"
+SUMMARY_PROMPT = (
+    "请将下面的对话历史压缩成一段简洁的摘要，保留用户的身份信息、目标、偏好、已达成的结论和待跟进的事项，"
+    "不要编造内容，直接输出摘要。\n\n{previous}对话历史：\n{transcript}"
+)
+
+
+class SessionCompactor(object):
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="compaction")
+        self.running = set()  # 正在摘要的(id(manager), session_id)，同一会话同时只有一个任务
+        self.lock = threading.Lock()
+
+    def maybe_compact(self, manager, session, cur_tokens):
+        """
+        session_reply之后调用，token数超过高水位时提交后台摘要任务，不阻塞回复流程
+        """
+        if not conf().get("conversation_compaction", False) or cur_tokens is None or session.session_id is None:
+            return
+        if not session.messages or session.messages[0].get("role") != "system":  # 没有system prompt的模型无处存放摘要
+            return
+        high_water = conf().get("conversation_max_tokens", 1000) * conf().get("compaction_high_water", 0.8)
+        if cur_tokens < high_water:
+            return
+        keep = conf().get("compaction_keep_messages", 4)
+        with session.lock:
+            messages = session.messages
+            old_messages = messages[1:-keep] if keep else messages[1:]
+        if len(old_messages) < 2:
+            return
+        key = (id(manager), session.session_id)
+        with self.lock:
+            if key in self.running:
+                return
+            self.running.add(key)
+        self.executor.submit(self._compact, key, manager, session, messages, old_messages)
+
+    def _compact(self, key, manager, session, messages, old_messages):
+        from bot.session_manager import Message
+
+        try:
+            start = time.monotonic()
+            system_prompt = session.system_prompt
+            previous = ""
+            head = messages[0]["content"]
+            if head.startswith(system_prompt + SUMMARY_PREFIX):
+                previous = "已有摘要：\n{}\n\n".format(head[len(system_prompt + SUMMARY_PREFIX):])
+            transcript = "\n".join("{}: {}".format(m.get("role"), m.get("content")) for m in old_messages)
+            summary = self._summarize(SUMMARY_PROMPT.format(previous=previous, transcript=transcript))
+            if not summary:
+                return
+            with session.lock:
+                if session.messages is not messages or manager.sessions.get(session.session_id) is not session:
+                    return  # 摘要期间会话被清除、重置或淘汰，放弃本次结果
+                # 摘要期间会话可能已被追加或丢弃消息，只移除仍在会话中的旧消息，新消息不受影响
+                # 换成新列表而不是原地删除，token计数按消息对象重新对齐
+                old_ids = {id(m) for m in old_messages}
+                head = Message("system", system_prompt + SUMMARY_PREFIX + summary)
+                session.messages = [head] + [m for m in messages[1:] if id(m) not in old_ids]
+                manager.save_session(session)
+            elapsed = (time.monotonic() - start) * 1000
+            folded = len(previous) + len(transcript)
+            metrics.incr("session_compacted")
+            metrics.observe("session_compaction_ratio", folded / max(len(summary), 1))
+            metrics.observe("session_compaction_latency_ms", elapsed)
+            logger.info("[SessionCompactor] session {} folded {} messages, {} -> {} chars in {:.0f}ms".format(
+                session.session_id, len(old_messages), folded, len(summary), elapsed))
+        except Exception as e:
+            metrics.incr("session_compaction_failed")
+            logger.warning("[SessionCompactor] compact session {} error: {}".format(session.session_id, e))
+        finally:
+            with self.lock:
+                self.running.discard(key)
+
+    def _summarize(self, prompt):
+        from bridge.bridge import Bridge
+
+        # session_id为None时bot使用不带character_desc人设的临时会话，不会影响任何用户的历史，摘要也不受角色设定影响
+        context = Context(ContextType.TEXT, prompt, {"session_id": None})
+        reply = Bridge().get_bot("chat").reply(prompt, context)
+        if reply is None or reply.type != ReplyType.TEXT:
+            logger.warning("[SessionCompactor] summarize failed: {}".format(reply))
+            return None
+        return reply.content.strip()
+
+
+session_compactor = SessionCompactor()
@@ -1,34 +1,109 @@
+import sys
+import threading
+
+from bot.session_budget import session_budget
+from bot.session_compactor import session_compactor
+from bot.session_store import create_session_store
 from common.expired_dict import ExpiredDict
 from common.log import logger
 from config import conf
 
+NEUTRAL_SYSTEM_PROMPT = "你是一个乐于助人的助手。"  # 临时会话使用的中性人设，不带character_desc的角色设定
+
+
+class Message(object):
+    """
+    会话中的一条消息，使用__slots__比dict节省内存，角色字符串全局共享
+    支持message["role"]、message.get("content")等dict的读写方式，发送请求前通过to_dict转换为dict
+    """
+
+    __slots__ = ("role", "content")
+
+    def __init__(self, role, content):
+        self.role = sys.intern(role)
+        self.content = content
+
+    def __getitem__(self, key):
+        if key == "role":
+            return self.role
+        if key == "content":
+            return self.content
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == "role":
+            self.role = sys.intern(value)
+        elif key == "content":
+            self.content = value
+        else:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key == "role" or key == "content"
+
+    def keys(self):
+        return ("role", "content")
+
+    def items(self):
+        return (("role", self.role), ("content", self.content))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return 2
+
+    def __eq__(self, other):
+        if isinstance(other, (Message, dict)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def to_dict(self):
+        return {"role": self.role, "content": self.content}
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
 
 class Session(object):
     def __init__(self, session_id, system_prompt=None):
         self.session_id = session_id
         self.messages = []
+        self.lock = threading.RLock()  # 修改messages时持有，工作线程和后台摘要线程互斥
         if system_prompt is None:
             self.system_prompt = conf().get("character_desc", "")
         else:
-            self.system_prompt = system_prompt
+            self.system_prompt = sys.intern(system_prompt)  # 相同的人设在所有会话中共享同一个字符串
 
     # 重置会话
     def reset(self):
-        system_item = {"role": "system", "content": self.system_prompt}
+        system_item = Message("system", self.system_prompt)
         self.messages = [system_item]
 
     def set_system_prompt(self, system_prompt):
-        self.system_prompt = system_prompt
+        self.system_prompt = sys.intern(system_prompt)
         self.reset()
 
     def add_query(self, query):
-        user_item = {"role": "user", "content": query}
+        user_item = Message("user", query)
         self.messages.append(user_item)
 
     def add_reply(self, reply):
-        assistant_item = {"role": "assistant", "content": reply}
+        assistant_item = Message("assistant", reply)
         self.messages.append(assistant_item)
 
+    def request_messages(self):
+        """
+        返回发送请求时使用的dict格式消息列表
+        """
+        return [message.to_dict() if isinstance(message, Message) else message for message in self.messages]
+
     def discard_exceeding(self, max_tokens=None, cur_tokens=None):
         raise NotImplementedError
 
@@ -39,53 +114,120 @@ class Session(object):
 class SessionManager(object):
     def __init__(self, sessioncls, **session_args):
         if conf().get("expires_in_seconds"):
-            sessions = ExpiredDict(conf().get("expires_in_seconds"))
+            sessions = ExpiredDict(conf().get("expires_in_seconds"), on_expire=self._on_session_expired)
         else:
             sessions = dict()
         self.sessions = sessions
         self.sessioncls = sessioncls
         self.session_args = session_args
+        self.store = create_session_store(sessioncls.__name__)  # 会话持久化存储，memory模式为None
 
     def build_session(self, session_id, system_prompt=None):
         """
         如果session_id不在sessions中，创建一个新的session并添加到sessions中
         如果system_prompt不会空，会更新session的system_prompt并重置session
         """
-        if session_id is None:
+        if session_id is None:  # 不保存的临时会话(如后台摘要)，默认使用中性人设
+            if system_prompt is None:
+                system_prompt = NEUTRAL_SYSTEM_PROMPT
             return self.sessioncls(session_id, system_prompt, **self.session_args)
 
         if session_id not in self.sessions:
-            self.sessions[session_id] = self.sessioncls(session_id, system_prompt, **self.session_args)
+            session = self._load_session(session_id)
+            if session is None:
+                session = self.sessioncls(session_id, system_prompt, **self.session_args)
+            elif system_prompt is not None:
+                session.set_system_prompt(system_prompt)
+                self.save_session(session)
+            self.sessions[session_id] = session
         elif system_prompt is not None:  # 如果有新的system_prompt，更新并重置session
             self.sessions[session_id].set_system_prompt(system_prompt)
+            self.save_session(self.sessions[session_id])
         session = self.sessions[session_id]
+        session_budget.touch(self, session, resize=False)
         return session
 
+    def _load_session(self, session_id):
+        """
+        从持久化存储中恢复会话，首次访问时才加载
+        """
+        if self.store is None:
+            return None
+        data = self.store.load(session_id)
+        if not data:
+            return None
+        session = self.sessioncls(session_id, data["system_prompt"], **self.session_args)
+        messages = [Message(m["role"], m["content"]) if m.keys() == {"role", "content"} else m for m in data["messages"]]
+        if messages and messages[0].get("content") == session.system_prompt:
+            messages[0]["content"] = session.system_prompt  # 与其他会话共享同一个人设字符串
+        session.messages = messages
+        return session
+
+    def save_session(self, session):
+        """
+        会话修改后调用，由后台线程批量写入持久化存储
+        """
+        if session.session_id is None:
+            return
+        if self.store is not None:
+            self.store.save(session)
+        session_budget.touch(self, session)
+
+    def evict_session(self, session_id, session=None):
+        """
+        超出全局会话预算时由session_budget调用，配置了持久化存储时会话会在下次访问时重新加载
+        :param session: 不为None时只在当前保存的是同一个会话对象时淘汰
+        """
+        current = self.sessions.get(session_id)
+        if current is None or (session is not None and current is not session):  # 已被同一session_id新建的会话替换
+            return
+        self.sessions.pop(session_id, None)
+        if self.store is not None:
+            self.store.save(current)
+
+    def _on_session_expired(self, session_id, session):
+        """
+        会话在sessions中过期时调用，同步从全局会话预算中删除
+        """
+        session_budget.remove(self, session_id, session)
+
     def session_query(self, query, session_id):
         session = self.build_session(session_id)
-        session.add_query(query)
-        try:
-            max_tokens = conf().get("conversation_max_tokens", 1000)
-            total_tokens = session.discard_exceeding(max_tokens, None)
-            logger.debug("prompt tokens used={}".format(total_tokens))
-        except Exception as e:
-            logger.warning("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+        with session.lock:
+            session.add_query(query)
+            try:
+                max_tokens = conf().get("conversation_max_tokens", 1000)
+                total_tokens = session.discard_exceeding(max_tokens, None)
+                logger.debug("prompt tokens used={}".format(total_tokens))
+            except Exception as e:
+                logger.warning("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+            self.save_session(session)
         return session
 
     def session_reply(self, reply, session_id, total_tokens=None):
         session = self.build_session(session_id)
-        session.add_reply(reply)
-        try:
-            max_tokens = conf().get("conversation_max_tokens", 1000)
-            tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
-            logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
-        except Exception as e:
-            logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        tokens_cnt = None
+        with session.lock:
+            session.add_reply(reply)
+            try:
+                max_tokens = conf().get("conversation_max_tokens", 1000)
+                tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
+                logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
+            except Exception as e:
+                logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+            self.save_session(session)
+        session_compactor.maybe_compact(self, session, tokens_cnt)
         return session
 
     def clear_session(self, session_id):
         if session_id in self.sessions:
             del self.sessions[session_id]
+        session_budget.remove(self, session_id)
+        if self.store is not None:
+            self.store.delete(session_id)
 
     def clear_all_session(self):
         self.sessions.clear()
+        session_budget.remove_manager(self)
+        if self.store is not None:
+            self.store.clear()
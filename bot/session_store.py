@@ -0,0 +1,193 @@
+"""
+会话持久化存储，SessionManager通过write-behind方式写入，回复流程不会等待磁盘或网络
+
+session_store配置项：
+    memory: 只保存在内存中(默认)，重启后会话丢失
+    sqlite: 保存到本地SQLite文件，路径为session_store_path，默认为appdata目录下的sessions.db
+    redis: 保存到Redis或兼容Redis协议的服务，地址为session_store_redis_url，需要安装redis库
+"""
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from common.log import logger
+from config import conf, get_appdata_dir
+
+
+class SessionStore(object):
+    """
+    存储后端接口，数据为{"system_prompt": ..., "messages": [...]}
+    """
+
+    def load(self, key):
+        raise NotImplementedError
+
+    def save_batch(self, items):
+        """
+        批量写入，items为[(key, data)]，data为None表示删除
+        """
+        raise NotImplementedError
+
+    def clear(self, prefix):
+        raise NotImplementedError
+
+
+class SqliteSessionStore(SessionStore):
+    def __init__(self, path, expires_in_seconds=None):
+        self.expires_in_seconds = expires_in_seconds
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, data TEXT, updated_at REAL)")
+        self.conn.commit()
+
+    def load(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT data, updated_at FROM sessions WHERE key = ?", (key,)).fetchone()
+        if row is None or (self.expires_in_seconds and row[1] + self.expires_in_seconds < time.time()):
+            return None
+        return json.loads(row[0])
+
+    def save_batch(self, items):
+        now = time.time()
+        with self.lock:
+            with self.conn:
+                self.conn.executemany("DELETE FROM sessions WHERE key = ?", [(key,) for key, data in items if data is None])
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO sessions (key, data, updated_at) VALUES (?, ?, ?)",
+                    [(key, json.dumps(data, ensure_ascii=False), now) for key, data in items if data is not None],
+                )
+                if self.expires_in_seconds:
+                    self.conn.execute("DELETE FROM sessions WHERE updated_at < ?", (now - self.expires_in_seconds,))
+
+    def clear(self, prefix):
+        with self.lock:
+            with self.conn:
+                self.conn.execute("DELETE FROM sessions WHERE substr(key, 1, ?) = ?", (len(prefix), prefix))
+
+
+class RedisSessionStore(SessionStore):
+    def __init__(self, url, expires_in_seconds=None):
+        import redis
+
+        self.expires_in_seconds = expires_in_seconds
+        self.client = redis.Redis.from_url(url)
+
+    def load(self, key):
+        data = self.client.get(key)
+        return json.loads(data) if data else None
+
+    def save_batch(self, items):
+        pipe = self.client.pipeline(transaction=False)
+        for key, data in items:
+            if data is None:
+                pipe.delete(key)
+            elif self.expires_in_seconds:
+                pipe.set(key, json.dumps(data, ensure_ascii=False), ex=int(self.expires_in_seconds))
+            else:
+                pipe.set(key, json.dumps(data, ensure_ascii=False))
+        pipe.execute()
+
+    def clear(self, prefix):
+        keys = list(self.client.scan_iter(match=prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+
+class WriteBehindStore(object):
+    """
+    在后端存储前加一层写缓冲：save/delete只记录最新数据，由后台线程每隔flush_interval秒批量写入
+    同一个会话在一个周期内的多次修改只会写入一次，读取时优先返回还未写入的数据
+    """
+
+    def __init__(self, store: SessionStore, prefix, flush_interval=1):
+        self.store = store
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self.pending = {}  # key -> 待写入的数据，None表示删除
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()  # 保证同一时间只有一个线程在写入
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def _key(self, session_id):
+        return "{}:{}".format(self.prefix, session_id)
+
+    def load(self, session_id):
+        key = self._key(session_id)
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+        try:
+            return self.store.load(key)
+        except Exception as e:
+            logger.warning("[SessionStore] load session {} error: {}".format(session_id, e))
+            return None
+
+    def save(self, session):
+        # 复制为dict格式的消息列表，避免后台线程序列化时会话正在被修改
+        data = {"system_prompt": session.system_prompt, "messages": session.request_messages()}
+        with self.lock:
+            self.pending[self._key(session.session_id)] = data
+
+    def delete(self, session_id):
+        with self.lock:
+            self.pending[self._key(session_id)] = None
+
+    def clear(self):
+        self.flush()
+        try:
+            self.store.clear(self.prefix + ":")
+        except Exception as e:
+            logger.warning("[SessionStore] clear sessions error: {}".format(e))
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending:
+                    return
+                items = list(self.pending.items())
+                self.pending = {}
+            try:
+                self.store.save_batch(items)
+            except Exception as e:
+                logger.warning("[SessionStore] save {} sessions error: {}".format(len(items), e))
+                with self.lock:  # 写入失败的数据放回缓冲区，下个周期重试，期间的新数据优先
+                    for key, data in items:
+                        self.pending.setdefault(key, data)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+
+_backends = {}  # 同一进程内的SessionManager共用后端连接
+_backends_lock = threading.Lock()
+
+
+def create_session_store(prefix):
+    """
+    根据配置创建会话存储，memory模式返回None
+    """
+    backend_type = conf().get("session_store", "memory")
+    if backend_type not in ["sqlite", "redis"]:
+        return None
+    with _backends_lock:
+        backend = _backends.get(backend_type)
+        if backend is None:
+            expires_in_seconds = conf().get("expires_in_seconds")
+            try:
+                if backend_type == "sqlite":
+                    path = conf().get("session_store_path") or os.path.join(get_appdata_dir(), "sessions.db")
+                    backend = SqliteSessionStore(path, expires_in_seconds)
+                else:
+                    backend = RedisSessionStore(conf().get("session_store_redis_url", "redis://localhost:6379/0"), expires_in_seconds)
+            except Exception as e:
+                logger.error("[SessionStore] create {} session store failed, sessions will only be kept in memory: {}".format(backend_type, e))
+                return None
+            _backends[backend_type] = backend
+    return WriteBehindStore(backend, prefix, conf().get("session_store_flush_interval", 1))
@@ -0,0 +1,157 @@
+"""
+token用量账本：所有bot的调用用量在内存中汇总，按批写入SQLite，并在调用模型前检查用户的每日token额度
+
+bot在回复时将本次调用的用量写入context["usage"] = {"prompt_tokens": .., "completion_tokens": ..}，
+未上报用量的bot按字符数估算
+"""
+import atexit
+import os
+import sqlite3
+import threading
+import time
+
+from common.log import logger
+from common.metrics import metrics
+from config import conf, get_appdata_dir
+
+
+def get_usage_user(context):
+    """返回用量归属的用户：群聊中为实际发送者，私聊为对方，没有消息对象时为session_id"""
+    msg = context.get("msg")
+    if msg is not None:
+        user = msg.actual_user_id if context.get("isgroup", False) else msg.from_user_id
+        if user:
+            return user
+    return context.get("session_id")
+
+
+class UsageLedger(object):
+    def __init__(self):
+        self.daily = {}  # (日期, user) -> 当天已用token数
+        self.loaded_users = set()  # 已从数据库加载当天用量的(日期, user)
+        self.pending = []  # 待写入数据库的用量记录
+        self.lock = threading.Lock()
+        self.conn = None
+        self.db_lock = threading.Lock()
+        self.thread = None
+
+    @staticmethod
+    def _today():
+        return time.strftime("%Y-%m-%d")
+
+    def _db(self):
+        """开启usage_ledger时返回数据库连接，首次调用时建表并启动后台写入线程"""
+        if not conf().get("usage_ledger", False):
+            return None
+        with self.db_lock:
+            if self.conn is None:
+                path = conf().get("usage_db_path") or os.path.join(get_appdata_dir(), "usage.db")
+                self.conn = sqlite3.connect(path, check_same_thread=False)
+                self.conn.execute(
+                    "CREATE TABLE IF NOT EXISTS usage (ts REAL, day TEXT, user TEXT, session_id TEXT, bot TEXT, model TEXT, "
+                    "prompt_tokens INTEGER, completion_tokens INTEGER, latency_ms REAL)"
+                )
+                self.conn.execute("CREATE INDEX IF NOT EXISTS idx_usage_day_user ON usage (day, user)")
+                self.conn.commit()
+                self.thread = threading.Thread(target=self._run, name="usage_ledger", daemon=True)
+                self.thread.start()
+                atexit.register(self.flush)
+            return self.conn
+
+    def _used_today(self, day, user):
+        """
+        返回用户当天已用token数，内存中的汇总在self.lock内读写，调用方不能持有self.lock
+        首次查询时在锁外从数据库加载重启前的用量，避免SQLite读写阻塞其他用户的额度检查和记账
+        """
+        key = (day, user)
+        with self.lock:
+            if key in self.loaded_users:
+                return self.daily.get(key, 0)
+        stored = self._load_used(day, user)
+        with self.lock:
+            if key not in self.loaded_users:  # 并发加载时只合并第一份结果，之后记入内存的用量不会在数据库中重复计算
+                self.loaded_users.add(key)
+                self.daily[key] = self.daily.get(key, 0) + stored
+            return self.daily.get(key, 0)
+
+    def _load_used(self, day, user):
+        """从数据库读取用户当天已持久化的用量，未开启usage_ledger或读取失败时返回0"""
+        conn = self._db()
+        if conn is None:
+            return 0
+        try:
+            with self.db_lock:
+                row = conn.execute(
+                    "SELECT SUM(prompt_tokens + completion_tokens) FROM usage WHERE day = ? AND user = ?", (day, user)
+                ).fetchone()
+            return row[0] or 0
+        except Exception as e:
+            logger.warning("[UsageLedger] load usage of {} error: {}".format(user, e))
+            return 0
+
+    def check_quota(self, context):
+        """
+        调用模型前检查用户当天的token额度，未超出或未配置额度时返回True
+        """
+        quota = conf().get("user_daily_token_quota", 0)
+        if not quota:
+            return True
+        user = get_usage_user(context)
+        used = self._used_today(self._today(), user)
+        if used < quota:
+            return True
+        metrics.incr("usage_quota_rejected")
+        logger.info("[UsageLedger] user {} exceeded daily token quota, used={}, quota={}".format(user, used, quota))
+        return False
+
+    def record(self, context, bot_type, query, reply, latency_ms):
+        """
+        记录一次模型调用的用量，bot未上报用量时按字符数估算
+        """
+        usage = context.get("usage")
+        if usage:
+            prompt_tokens = usage.get("prompt_tokens", 0)
+            completion_tokens = usage.get("completion_tokens", 0)
+        else:
+            prompt_tokens = len(query) if isinstance(query, str) else 0
+            completion_tokens = len(reply.content) if reply is not None and isinstance(reply.content, str) else 0
+        model = context.get("gpt_model") or conf().get("model")
+        user = get_usage_user(context)
+        day = self._today()
+        self._used_today(day, user)
+        with self.lock:
+            key = (day, user)
+            if len(self.daily) > 1 and next(iter(self.daily))[0] != day:  # 跨天后清理前一天的汇总
+                self.daily = {k: v for k, v in self.daily.items() if k[0] == day}
+                self.loaded_users = {k for k in self.loaded_users if k[0] == day}
+            self.daily[key] = self.daily.get(key, 0) + prompt_tokens + completion_tokens
+            if conf().get("usage_ledger", False):
+                self.pending.append((time.time(), day, user, context.get("session_id"), bot_type, model, prompt_tokens, completion_tokens, latency_ms))
+        metrics.incr("usage_prompt_tokens", prompt_tokens, labels=(bot_type,))
+        metrics.incr("usage_completion_tokens", completion_tokens, labels=(bot_type,))
+        metrics.observe("usage_latency_ms", latency_ms, labels=(bot_type,))
+
+    def flush(self):
+        with self.lock:
+            records, self.pending = self.pending, []
+        if not records:
+            return
+        conn = self._db()
+        if conn is None:
+            return
+        try:
+            with self.db_lock:
+                with conn:
+                    conn.executemany("INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", records)
+        except Exception as e:
+            logger.warning("[UsageLedger] save {} usage records error: {}".format(len(records), e))
+            with self.lock:
+                self.pending = records + self.pending
+
+    def _run(self):
+        while True:
+            time.sleep(conf().get("usage_flush_interval", 5))
+            self.flush()
+
+
+usage_ledger = UsageLedger()
@@ -63,7 +63,7 @@ class XunFeiBot(Bot):
             reply_map[request_id] = ""
             session = self.sessions.session_query(query, session_id)
             threading.Thread(target=self.create_web_socket,
-                             args=(session.messages, request_id)).start()
+                             args=(session.request_messages(), request_id)).start()
             depth = 0
             time.sleep(0.1)
             t1 = time.time()
@@ -10,9 +10,10 @@ from bot.zhipuai.zhipu_ai_image import ZhipuAIImage
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common.circuit_breaker import backoff_delay, get_circuit_breaker, get_retry_after, is_server_failure, open_reply
 from common.log import logger
 from config import conf, load_config
-from zhipuai import ZhipuAI
+from zhipuai import APITimeoutError, ZhipuAI
 
 
 # ZhipuAI对话模型API
@@ -71,6 +72,7 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
             if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
                 reply = Reply(ReplyType.ERROR, reply_content["content"])
             elif reply_content["completion_tokens"] > 0:
+                self.report_usage(context, reply_content["total_tokens"], reply_content["completion_tokens"])
                 self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
                 reply = Reply(ReplyType.TEXT, reply_content["content"])
             else:
@@ -98,6 +100,9 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
         :param retry_count: retry count
         :return: {}
         """
+        breaker = get_circuit_breaker("zhipuai")
+        if not breaker.allow():
+            return {"completion_tokens": 0, "content": open_reply()}
         try:
             # if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
             #     raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
@@ -105,7 +110,8 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
             if args is None:
                 args = self.args
             # response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
-            response = self.client.chat.completions.create(messages=session.messages, **args)
+            response = self.client.chat.completions.create(messages=session.request_messages(), **args)
+            breaker.record_success()
             # logger.debug("[ZHIPU_AI] response={}".format(response))
             # logger.info("[ZHIPU_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
 
@@ -117,31 +123,39 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
         except Exception as e:
             need_retry = retry_count < 2
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
+            status_code = getattr(e, "status_code", None)  # zhipuai的APIStatusError带有http状态码
+            retry_after = get_retry_after(e)
+            timeout = isinstance(e, (openai.error.Timeout, APITimeoutError))
+            if timeout or isinstance(e, openai.error.APIConnectionError) or is_server_failure(status_code):
+                breaker.record_failure(retry_after)
+            elif status_code:
+                breaker.record_success()
+            delay = 0
+            if isinstance(e, openai.error.RateLimitError) or status_code == 429:
                 logger.warn("[ZHIPU_AI] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
+                delay = backoff_delay(retry_count, retry_after)
+            elif timeout:
                 logger.warn("[ZHIPU_AI] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIError):
+                delay = backoff_delay(retry_count)
+            elif isinstance(e, openai.error.APIError) or is_server_failure(status_code):
                 logger.warn("[ZHIPU_AI] Bad Gateway: {}".format(e))
                 result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
+                delay = backoff_delay(retry_count, retry_after)
             elif isinstance(e, openai.error.APIConnectionError):
                 logger.warn("[ZHIPU_AI] APIConnectionError: {}".format(e))
                 result["content"] = "我连接不到你的网络"
-                if need_retry:
-                    time.sleep(5)
+                delay = backoff_delay(retry_count)
             else:
                 logger.exception("[ZHIPU_AI] Exception: {}".format(e), e)
                 need_retry = False
                 self.sessions.clear_session(session.session_id)
 
+            if delay is None:
+                need_retry = False
+            elif need_retry and delay:
+                time.sleep(delay)
             if need_retry:
                 logger.warn("[ZHIPU_AI] 第{}次重试".format(retry_count + 1))
                 return self.reply_text(session, api_key, args, retry_count + 1)
@@ -1,8 +1,18 @@
+import copy
+import hashlib
+import json
+import time
+
 from bot.bot_factory import create_bot
-from bridge.context import Context
-from bridge.reply import Reply
+from bot.reply_cache import reply_cache
+from bot.session_manager import SessionManager
+from bot.usage_ledger import usage_ledger
+from bridge.context import Context, ContextType
+from bridge.reply import Reply, ReplyType
 from common import const
 from common.log import logger
+from common.metrics import metrics
+from common.single_flight import SingleFlight
 from common.singleton import singleton
 from config import conf
 from translate.factory import create_translator
@@ -64,6 +74,7 @@ class Bridge(object):
 
         self.bots = {}
         self.chat_bots = {}
+        self.single_flight = SingleFlight()
 
     # 模型对应的接口
     def get_bot(self, typename):
@@ -83,7 +94,164 @@ class Bridge(object):
         return self.btype[typename]
 
     def fetch_reply_content(self, query, context: Context) -> Reply:
-        return self.get_bot("chat").reply(query, context)
+        if not self._check_quota(query, context):
+            return Reply(ReplyType.INFO, conf().get("usage_quota_reply", "今日的使用额度已用完，请明天再来"))
+        bot = self.get_bot("chat")
+        cached = self._cached_reply(bot, query, context)
+        if cached is not None:
+            return cached
+        key = self._single_flight_key(bot, query, context)
+        if key is None:
+            return self._call_bot(bot, query, context)
+        reply, shared = self.single_flight.do(key, self._call_bot, bot, query, context, snapshot=copy.copy)
+        return self._share_reply(bot, query, context, reply) if shared else reply
+
+    async def fetch_reply_content_async(self, query, context: Context) -> Reply:
+        if not self._check_quota(query, context):
+            return Reply(ReplyType.INFO, conf().get("usage_quota_reply", "今日的使用额度已用完，请明天再来"))
+        bot = self.get_bot("chat")
+        cached = self._cached_reply(bot, query, context)
+        if cached is not None:
+            return cached
+        key = self._single_flight_key(bot, query, context)
+        if key is None:
+            return await self._call_bot_async(bot, query, context)
+        reply, shared = await self.single_flight.do_async(key, self._call_bot_async, bot, query, context, snapshot=copy.copy)
+        return self._share_reply(bot, query, context, reply) if shared else reply
+
+    @staticmethod
+    def _need_accounting(query, context: Context):
+        """只有文本对话计入用量，指令类消息不受额度限制"""
+        return context is not None and context.type == ContextType.TEXT and not (isinstance(query, str) and query.startswith("#"))
+
+    def _check_quota(self, query, context: Context):
+        return not self._need_accounting(query, context) or usage_ledger.check_quota(context)
+
+    def _call_bot(self, bot, query, context: Context) -> Reply:
+        start = time.monotonic()
+        reply = bot.reply(query, context)
+        self._record_usage(query, context, reply, start)
+        self._store_reply_cache(query, context, reply)
+        return reply
+
+    async def _call_bot_async(self, bot, query, context: Context) -> Reply:
+        start = time.monotonic()
+        reply = await bot.reply_async(query, context)
+        self._record_usage(query, context, reply, start)
+        self._store_reply_cache(query, context, reply)
+        return reply
+
+    def _record_usage(self, query, context: Context, reply: Reply, start):
+        if not self._need_accounting(query, context):
+            return
+        bot_type = self.btype["chat"]
+        if reply is not None and reply.type == ReplyType.TEXT_STREAM:
+            # 流式回复的用量在内容全部生成后才能确定
+            reply.content.add_done_callback(
+                lambda text: usage_ledger.record(context, bot_type, query, Reply(ReplyType.TEXT, text), (time.monotonic() - start) * 1000)
+            )
+        else:
+            usage_ledger.record(context, bot_type, query, reply, (time.monotonic() - start) * 1000)
+
+    def _cached_reply(self, bot, query, context: Context):
+        """
+        查询回复缓存，命中时把问答写入会话历史并返回回复；未命中时在context中记下缓存key，调用模型后写入缓存
+        bot的REPLY_CACHE为False或context中设置了no_reply_cache时不使用缓存
+        """
+        if not conf().get("reply_cache", False) or context is None or context.type != ContextType.TEXT:
+            return None
+        if not getattr(bot, "REPLY_CACHE", True) or context.get("no_reply_cache"):
+            return None
+        if not isinstance(query, str) or query.startswith("#") or query in conf().get("clear_memory_commands", ["#清除记忆"]):
+            return None
+        session = self._current_session(bot, context)
+        if session is None:
+            system_prompt, messages = conf().get("character_desc", ""), []
+        elif session.messages and session.messages[0]["role"] == "system":
+            system_prompt, messages = session.messages[0]["content"], session.messages[1:]
+        else:
+            system_prompt, messages = session.system_prompt, session.messages
+        partition, key = reply_cache.make_key(self.btype["chat"], context.get("gpt_model") or conf().get("model"), system_prompt, messages, query)
+        cached = reply_cache.get(partition, key, query)
+        if cached is None:
+            context["reply_cache_key"] = (partition, key)
+            return None
+        reply = Reply(ReplyType.TEXT, cached[0])
+        self._append_to_session(bot, query, context, reply)
+        return reply
+
+    def _store_reply_cache(self, query, context: Context, reply: Reply):
+        cache_key = context.get("reply_cache_key") if context is not None else None
+        if cache_key is None or reply is None:
+            return
+
+        def store(text):
+            usage = context.get("usage") or {}
+            reply_cache.put(cache_key[0], cache_key[1], query, text, usage.get("prompt_tokens", 0) + usage.get("completion_tokens", 0))
+
+        if reply.type == ReplyType.TEXT and reply.content:
+            store(reply.content)
+        elif reply.type == ReplyType.TEXT_STREAM:
+            stream = reply.content
+            stream.add_done_callback(lambda text: None if stream.aborted else store(text))  # 被截断的回复不缓存
+
+    @staticmethod
+    def _current_session(bot, context: Context):
+        """
+        返回bot中该会话当前的历史，不在内存中时通过SessionManager从持久化存储加载(被预算淘汰或重启后未访问过的会话)，
+        这样缓存和合并的key与bot实际使用的历史一致；bot没有使用SessionManager时返回None
+        """
+        session_manager = getattr(bot, "sessions", None)
+        if not isinstance(session_manager, SessionManager) or context.get("session_id") is None:
+            return None
+        return session_manager.build_session(context.get("session_id"))
+
+    def _single_flight_key(self, bot, query, context: Context):
+        """
+        相同的问题、人设、模型和会话历史会得到等价的回复，并发的此类请求只需要调用一次模型
+        返回None表示该请求不参与合并
+        """
+        if not conf().get("single_flight", True) or context is None or context.type != ContextType.TEXT:
+            return None
+        if context.get("stream"):
+            return None  # 流式回复只能被消费一次，无法共享给其他请求
+        if not isinstance(query, str) or query.startswith("#") or query in conf().get("clear_memory_commands", ["#清除记忆"]):
+            return None  # 指令类消息会修改会话状态，不能合并
+        session = self._current_session(bot, context)
+        if session is not None:
+            system_prompt = session.system_prompt
+            history = hashlib.md5(json.dumps(session.messages, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+        else:
+            system_prompt = conf().get("character_desc", "")
+            history = None
+        return (
+            self.btype["chat"],
+            context.get("gpt_model") or conf().get("model"),
+            context.get("openai_api_key"),
+            system_prompt,
+            history,
+            " ".join(query.split()),
+        )
+
+    def _share_reply(self, bot, query, context: Context, reply: Reply) -> Reply:
+        """
+        将共享到的回复写入本会话的历史，并返回回复的副本，避免后续装饰回复时相互影响
+        共享的回复是调用方装饰前复制的快照，写入历史的是未经装饰的原文
+        """
+        metrics.incr("single_flight_collapsed", labels=(self.btype["chat"],))
+        if reply is None:
+            return None
+        self._append_to_session(bot, query, context, reply)
+        return copy.copy(reply)
+
+    @staticmethod
+    def _append_to_session(bot, query, context: Context, reply: Reply):
+        """没有调用模型得到的回复，同样要把这一轮问答写入会话历史"""
+        session_manager = getattr(bot, "sessions", None)
+        if reply.type == ReplyType.TEXT and isinstance(session_manager, SessionManager):
+            session_id = context.get("session_id")
+            session_manager.session_query(query, session_id)
+            session_manager.session_reply(reply.content, session_id)
 
     def fetch_voice_to_text(self, voiceFile) -> Reply:
         return self.get_bot("voice_to_text").voiceToText(voiceFile)
@@ -1,7 +1,10 @@
 # encoding:utf-8
 
+import time
 from enum import Enum
 
+from common.log import logger
+
 
 class ReplyType(Enum):
     TEXT = 1  # 文本
@@ -17,6 +20,7 @@ class ReplyType(Enum):
     TEXT_ = 11  # 强制文本
     VIDEO = 12
     MINIAPP = 13  # 小程序
+    TEXT_STREAM = 14  # 流式文本，content为TextStream
 
     def __str__(self):
         return self.name
@@ -29,3 +33,127 @@ class Reply:
 
     def __str__(self):
         return "Reply(type={}, content={})".format(self.type, self.content)
+
+
+SENTENCE_ENDINGS = "。！？!?；;\n"
+
+
+class TextStream(object):
+    """
+    流式文本回复的内容，迭代时逐段返回模型生成的文本，迭代结束后text为完整回复
+    底层迭代器只会被消费一次，中途停止后再次迭代会从停止的位置继续；全部消费完或调用close后依次调用done回调
+    """
+
+    def __init__(self, chunks, on_close=None):
+        """
+        :param on_close: 全部消费完或被close时调用一次的无参函数，用于释放生成方持有的资源(断开连接、归还key、写入会话)，
+            stream从未被迭代就被丢弃时也会调用，不依赖生成器的finally
+        """
+        self.chunks = iter(chunks)
+        self.on_close = on_close
+        self.parts = []
+        self.done = False
+        self.aborted = False  # 是否在生成完毕前被close，此时text只是已生成的部分
+        self.first_chunk_time = None  # 收到第一段文本时的单调时间，用于统计首字延迟
+        self.callbacks = []
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            if not chunk:
+                continue
+            if self.first_chunk_time is None:
+                self.first_chunk_time = time.monotonic()
+            self.parts.append(chunk)
+            yield chunk
+        self._finish()
+
+    def _finish(self):
+        if self.done:
+            return
+        self.done = True
+        if self.on_close is not None:
+            try:
+                self.on_close()
+            except Exception as e:
+                logger.exception("[TextStream] on_close error: {}".format(e))
+        for callback in self.callbacks:
+            try:
+                callback(self.text)
+            except Exception as e:
+                logger.exception("[TextStream] done callback error: {}".format(e))
+
+    def close(self):
+        """
+        不再消费剩余内容：关闭底层迭代器，调用on_close，再以已生成的部分调用done回调
+        已消费完的stream调用无影响
+        """
+        if self.done:
+            return
+        self.aborted = True
+        close = getattr(self.chunks, "close", None)
+        if close is not None:
+            close()
+        self._finish()
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+    def add_done_callback(self, callback):
+        """注册完整回复生成后的回调，参数为完整回复文本"""
+        if self.done:
+            callback(self.text)
+        else:
+            self.callbacks.append(callback)
+
+    def read(self):
+        """消费剩余内容，返回完整回复"""
+        for _ in self:
+            pass
+        return self.text
+
+    def sentences(self, min_chars=0, strip=True):
+        """
+        按句子边界聚合文本，每段至少min_chars个字符，用于只能发送完整消息的channel
+        :param strip: 是否去掉每段首尾的空白，为False时各段拼接后与原文一致
+        """
+        buffer = ""
+        for chunk in self:
+            buffer += chunk
+            end = max(buffer.rfind(c) for c in SENTENCE_ENDINGS)
+            if end >= 0 and end + 1 >= min_chars:
+                segment, buffer = buffer[: end + 1], buffer[end + 1 :]
+                if not strip:
+                    yield segment
+                elif segment.strip():
+                    yield segment.strip()
+        if not strip and buffer:
+            yield buffer
+        elif buffer.strip():
+            yield buffer.strip()
+
+    def wrap(self, prefix="", suffix=""):
+        """返回在内容前后加上前后缀的新TextStream，原stream的done回调不受影响"""
+        if not prefix and not suffix:
+            return self
+
+        def chunks():
+            first = True
+            for chunk in self:
+                yield prefix + chunk if first else chunk
+                first = False
+            yield suffix
+
+        return TextStream(chunks(), on_close=self.close)  # 新stream被关闭时一并关闭原stream
+
+    def map_sentences(self, func):
+        """返回按句子转换内容的新TextStream，func返回None时截断后续内容并关闭原stream"""
+
+        def chunks():
+            for sentence in self.sentences(strip=False):
+                sentence = func(sentence)
+                if sentence is None:
+                    return
+                yield sentence
+
+        return TextStream(chunks(), on_close=self.close)
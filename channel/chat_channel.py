@@ -1,15 +1,25 @@
+import asyncio
+import heapq
 import os
-import re
+import pickle
+import random
 import threading
 import time
 from asyncio import CancelledError
 from concurrent.futures import Future, ThreadPoolExecutor
 
+from bridge.bridge import Bridge
 from bridge.context import *
 from bridge.reply import *
 from channel.channel import Channel
+from channel.chat_message import ChatMessage
+from common.delay_queue import DelayQueue
 from common.dequeue import Dequeue
+from common.fair_scheduler import FairScheduler
+from common.metrics import StageTimer, mark_stage, metrics
+from common.trigger_matcher import get_trigger_matcher, mention_pattern
 from common import memory
+from config import get_appdata_dir
 from plugins import *
 
 try:
@@ -17,7 +27,21 @@ try:
 except Exception as e:
     pass
 
-handler_pool = ThreadPoolExecutor(max_workers=8)  # 处理消息的线程池
+handler_pool_size = conf().get("handler_pool_size", 8)
+handler_pool = ThreadPoolExecutor(max_workers=handler_pool_size)  # 处理消息的线程池
+pending_lock = threading.Lock()  # 保护停机时保存的未处理消息文件
+send_retry_queue = DelayQueue(name="send_retry")  # 发送失败的消息在这里等待重试
+async_loop = None  # async_pipeline模式下处理消息的事件循环，在单独的线程中运行
+
+
+def get_async_loop():
+    global async_loop
+    if async_loop is None:
+        async_loop = asyncio.new_event_loop()
+        async_loop.set_default_executor(ThreadPoolExecutor(max_workers=conf().get("async_executor_workers", 32)))
+        _thread = threading.Thread(target=async_loop.run_forever, daemon=True)
+        _thread.start()
+    return async_loop
 
 
 # 抽象类, 它包含了与消息通道无关的通用处理逻辑
@@ -26,7 +50,18 @@ class ChatChannel(Channel):
     user_id = None  # 登录的用户id
     futures = {}  # 记录每个session_id提交到线程池的future对象, 用于重置会话时把没执行的future取消掉，正在执行的不会被取消
     sessions = {}  # 用于控制并发，每个session_id同时只能有一个context在处理
-    lock = threading.Lock()  # 用于控制对sessions的访问
+    lock = threading.RLock()  # 用于控制对sessions的访问，可重入：cancel future时回调会在当前线程同步执行
+    cond = threading.Condition(lock)  # 有新消息或worker处理完毕时通知consume线程
+    scheduler = FairScheduler(lambda receiver: conf().get("schedule_weights", {}).get(receiver, 1))  # 有待处理消息的session_id，按receiver分组轮询
+    busy_workers = 0  # 已提交到线程池且未结束的任务数
+    queued_count = 0  # 所有会话中排队等待处理的消息数
+    shed_counter = {"drop_oldest": 0, "reject": 0, "merge": 0}  # 队列超出上限时各策略的触发次数
+    deferred = []  # 等待合并窗口结束的session，堆中元素为(可调度时间, session_id)
+    deferred_sessions = set()  # deferred中的session_id
+    coalesced_count = 0  # 被合并到其他消息中的消息数，即节省的模型调用次数
+    draining = False  # 停机排空中，不再调度排队的消息
+    replayed = False  # 是否已回放上次停机时保存的消息
+    STREAM_REPLY = False  # 能否增量展示流式回复，不支持的channel把流式回复按句子分段发送
 
     def __init__(self):
         _thread = threading.Thread(target=self.consume)
@@ -45,6 +80,7 @@ class ChatChannel(Channel):
         # context首次传入时，receiver是None，根据类型设置receiver
         first_in = "receiver" not in context
         # 群名匹配过程，设置session_id和receiver
+        matcher = get_trigger_matcher()
         if first_in:  # context首次传入时，receiver是None，根据类型设置receiver
             config = conf()
             cmsg = context["msg"]
@@ -55,23 +91,9 @@ class ChatChannel(Channel):
                 group_name = cmsg.other_user_nickname
                 group_id = cmsg.other_user_id
 
-                group_name_white_list = config.get("group_name_white_list", [])
-                group_name_keyword_white_list = config.get("group_name_keyword_white_list", [])
-                if any(
-                    [
-                        group_name in group_name_white_list,
-                        "ALL_GROUP" in group_name_white_list,
-                        check_contain(group_name, group_name_keyword_white_list),
-                    ]
-                ):
-                    group_chat_in_one_session = conf().get("group_chat_in_one_session", [])
+                if matcher.is_group_in_white_list(group_name):
                     session_id = cmsg.actual_user_id
-                    if any(
-                        [
-                            group_name in group_chat_in_one_session,
-                            "ALL_GROUP" in group_chat_in_one_session,
-                        ]
-                    ):
+                    if matcher.is_group_in_one_session(group_name):
                         session_id = group_id
                 else:
                     logger.debug(f"No need reply, groupName not in whitelist, group_name={group_name}")
@@ -96,11 +118,10 @@ class ChatChannel(Channel):
                 logger.debug("[chat_channel]reference query skipped")
                 return None
 
-            nick_name_black_list = conf().get("nick_name_black_list", [])
             if context.get("isgroup", False):  # 群聊
                 # 校验关键字
-                match_prefix = check_prefix(content, conf().get("group_chat_prefix"))
-                match_contain = check_contain(content, conf().get("group_chat_keyword"))
+                match_prefix = matcher.group_chat_prefix.match(content)
+                match_contain = matcher.group_chat_keyword.search(content)
                 flag = False
                 if context["msg"].to_user_id != context["msg"].actual_user_id:
                     if match_prefix is not None or match_contain is not None:
@@ -109,7 +130,7 @@ class ChatChannel(Channel):
                             content = content.replace(match_prefix, "", 1).strip()
                     if context["msg"].is_at:
                         nick_name = context["msg"].actual_user_nickname
-                        if nick_name and nick_name in nick_name_black_list:
+                        if matcher.is_nick_name_blocked(nick_name):
                             # 黑名单过滤
                             logger.warning(f"[chat_channel] Nickname {nick_name} in In BlackList, ignore")
                             return None
@@ -118,16 +139,13 @@ class ChatChannel(Channel):
                         if not conf().get("group_at_off", False):
                             flag = True
                         self.name = self.name if self.name is not None else ""  # 部分渠道self.name可能没有赋值
-                        pattern = f"@{re.escape(self.name)}(\u2005|\u0020)"
-                        subtract_res = re.sub(pattern, r"", content)
+                        subtract_res = mention_pattern(self.name).sub(r"", content)
                         if isinstance(context["msg"].at_list, list):
                             for at in context["msg"].at_list:
-                                pattern = f"@{re.escape(at)}(\u2005|\u0020)"
-                                subtract_res = re.sub(pattern, r"", subtract_res)
+                                subtract_res = mention_pattern(at).sub(r"", subtract_res)
                         if subtract_res == content and context["msg"].self_display_name:
                             # 前缀移除后没有变化，使用群昵称再次移除
-                            pattern = f"@{re.escape(context['msg'].self_display_name)}(\u2005|\u0020)"
-                            subtract_res = re.sub(pattern, r"", content)
+                            subtract_res = mention_pattern(context["msg"].self_display_name).sub(r"", content)
                         content = subtract_res
                 if not flag:
                     if context["origin_ctype"] == ContextType.VOICE:
@@ -135,12 +153,12 @@ class ChatChannel(Channel):
                     return None
             else:  # 单聊
                 nick_name = context["msg"].from_user_nickname
-                if nick_name and nick_name in nick_name_black_list:
+                if matcher.is_nick_name_blocked(nick_name):
                     # 黑名单过滤
                     logger.warning(f"[chat_channel] Nickname '{nick_name}' in In BlackList, ignore")
                     return None
 
-                match_prefix = check_prefix(content, conf().get("single_chat_prefix", [""]))
+                match_prefix = matcher.single_chat_prefix.match(content)
                 if match_prefix is not None:  # 判断如果匹配到自定义前缀，则返回过滤掉前缀+空格后的内容
                     content = content.replace(match_prefix, "", 1).strip()
                 elif context["origin_ctype"] == ContextType.VOICE:  # 如果源消息是私聊的语音消息，允许不匹配前缀，放宽条件
@@ -149,7 +167,7 @@ class ChatChannel(Channel):
                     logger.info("[chat_channel]receive single chat msg, but checkprefix didn't match")
                     return None
             content = content.strip()
-            img_match_prefix = check_prefix(content, conf().get("image_create_prefix",[""]))
+            img_match_prefix = matcher.image_create_prefix.match(content)
             if img_match_prefix:
                 content = content.replace(img_match_prefix, "", 1)
                 context.type = ContextType.IMAGE_CREATE
@@ -166,18 +184,89 @@ class ChatChannel(Channel):
     def _handle(self, context: Context):
         if context is None or not context.content:
             return
+        mark_stage(context, "dispatch")
         logger.debug("[chat_channel] ready to handle context: {}".format(context))
         # reply的构建步骤
         reply = self._generate_reply(context)
 
         logger.debug("[chat_channel] ready to decorate reply: {}".format(reply))
 
-        # reply的包装步骤
-        if reply and reply.content:
-            reply = self._decorate_reply(context, reply)
+        stream = self._stream_of(reply)
+        try:
+            # reply的包装步骤
+            if reply and reply.content:
+                reply = self._decorate_reply(context, reply)
+                mark_stage(context, "decorate")
+
+                # reply的发送步骤
+                self._send_reply(context, reply)
+        finally:
+            self._close_streams(stream, self._stream_of(reply))
+        self._record_stage_timing(context)
+
+    @staticmethod
+    def _stream_of(reply):
+        return reply.content if reply and reply.type == ReplyType.TEXT_STREAM else None
+
+    # 流式回复可能被插件替换或BREAK_PASS、被channel拒绝发送或因类型未知被丢弃，从未被迭代的stream
+    # 需要显式关闭才会释放bot持有的连接和key并写入会话，已消费完的stream关闭无影响
+    def _close_streams(self, *streams):
+        for stream in streams:
+            if stream is not None:
+                stream.close()
+
+    # 将各阶段耗时计入按channel和bot类型区分的直方图
+    def _record_stage_timing(self, context: Context):
+        if "timing" not in context:
+            return
+        timing = context["timing"]
+        labels = (self.channel_type, Bridge().get_bot_type("chat"))
+        for stage, cost in timing.durations():
+            metrics.observe("stage_latency_ms", cost, labels + (stage,))
+        metrics.observe("stage_latency_ms", timing.total(), labels + ("total",))
+
+    # asyncio模式下的处理流程，各阶段为协程，阻塞的插件和发送调用在事件循环的线程池中执行
+    async def _handle_async(self, context: Context):
+        if context is None or not context.content:
+            return
+        mark_stage(context, "dispatch")
+        logger.debug("[chat_channel] ready to handle context async: {}".format(context))
+        loop = asyncio.get_running_loop()
+        reply = await self._generate_reply_async(context)
+
+        logger.debug("[chat_channel] ready to decorate reply: {}".format(reply))
 
-            # reply的发送步骤
-            self._send_reply(context, reply)
+        stream = self._stream_of(reply)
+        try:
+            if reply and reply.content:
+                reply = await loop.run_in_executor(None, self._decorate_reply, context, reply)
+                mark_stage(context, "decorate")
+                await loop.run_in_executor(None, self._send_reply, context, reply)
+        finally:
+            self._close_streams(stream, self._stream_of(reply))
+        self._record_stage_timing(context)
+
+    async def _generate_reply_async(self, context: Context) -> Reply:
+        loop = asyncio.get_running_loop()
+        if context.type not in [ContextType.TEXT, ContextType.IMAGE_CREATE]:  # 语音等消息沿用同步流程
+            return await loop.run_in_executor(None, self._generate_reply, context)
+        e_context = await loop.run_in_executor(
+            None,
+            PluginManager().emit_event,
+            EventContext(
+                Event.ON_HANDLE_CONTEXT,
+                {"channel": self, "context": context, "reply": Reply()},
+            ),
+        )
+        reply = e_context["reply"]
+        if not e_context.is_pass():
+            logger.debug("[chat_channel] ready to handle context: type={}, content={}".format(context.type, context.content))
+            context["channel"] = e_context["channel"]
+            if self._want_stream(context):
+                context["stream"] = True
+            reply = await super().build_reply_content_async(context.content, context)
+            mark_stage(context, "bot_reply")
+        return reply
 
     def _generate_reply(self, context: Context, reply: Reply = Reply()) -> Reply:
         e_context = PluginManager().emit_event(
@@ -191,7 +280,10 @@ class ChatChannel(Channel):
             logger.debug("[chat_channel] ready to handle context: type={}, content={}".format(context.type, context.content))
             if context.type == ContextType.TEXT or context.type == ContextType.IMAGE_CREATE:  # 文字和图片消息
                 context["channel"] = e_context["channel"]
+                if self._want_stream(context):
+                    context["stream"] = True
                 reply = super().build_reply_content(context.content, context)
+                mark_stage(context, "bot_reply")
             elif context.type == ContextType.VOICE:  # 语音消息
                 cmsg = context["msg"]
                 cmsg.prepare()
@@ -204,6 +296,7 @@ class ChatChannel(Channel):
                     wav_path = file_path
                 # 语音识别
                 reply = super().build_voice_to_text(wav_path)
+                mark_stage(context, "voice_to_text")
                 # 删除临时文件
                 try:
                     os.remove(file_path)
@@ -233,6 +326,10 @@ class ChatChannel(Channel):
                 return
         return reply
 
+    # 开启stream_reply时文本对话以流式返回，需要语音回复时仍等待完整文本
+    def _want_stream(self, context: Context):
+        return conf().get("stream_reply", False) and context.type == ContextType.TEXT and context.get("desire_rtype") is None
+
     def _decorate_reply(self, context: Context, reply: Reply) -> Reply:
         if reply and reply.type:
             e_context = PluginManager().emit_event(
@@ -261,6 +358,14 @@ class ChatChannel(Channel):
                     else:
                         reply_text = conf().get("single_chat_reply_prefix", "") + reply_text + conf().get("single_chat_reply_suffix", "")
                     reply.content = reply_text
+                elif reply.type == ReplyType.TEXT_STREAM:
+                    if context.get("isgroup", False):
+                        prefix = conf().get("group_chat_reply_prefix", "")
+                        if not context.get("no_need_at", False):
+                            prefix += "@" + context["msg"].actual_user_nickname + "\n"
+                        reply.content = reply.content.wrap(prefix, conf().get("group_chat_reply_suffix", ""))
+                    else:
+                        reply.content = reply.content.wrap(conf().get("single_chat_reply_prefix", ""), conf().get("single_chat_reply_suffix", ""))
                 elif reply.type == ReplyType.ERROR or reply.type == ReplyType.INFO:
                     reply.content = "[" + str(reply.type) + "]\n" + reply.content
                 elif reply.type == ReplyType.IMAGE_URL or reply.type == ReplyType.VOICE or reply.type == ReplyType.IMAGE or reply.type == ReplyType.FILE or reply.type == ReplyType.VIDEO or reply.type == ReplyType.VIDEO_URL:
@@ -283,7 +388,24 @@ class ChatChannel(Channel):
             reply = e_context["reply"]
             if not e_context.is_pass() and reply and reply.type:
                 logger.debug("[chat_channel] ready to send reply: {}, context: {}".format(reply, context))
-                self._send(reply, context)
+                if reply.type == ReplyType.TEXT_STREAM and not self.STREAM_REPLY:
+                    # 只能发送完整消息的channel，每凑够一段完整的句子就发送一条
+                    first_send_time = None
+                    for sentence in reply.content.sentences(conf().get("stream_min_chars", 50)):
+                        first_send_time = first_send_time or time.monotonic()
+                        self._send(Reply(ReplyType.TEXT, sentence), context)
+                    self._record_first_token(context, first_send_time)
+                else:
+                    self._send(reply, context)
+                    if reply.type == ReplyType.TEXT_STREAM:
+                        self._record_first_token(context, reply.content.first_chunk_time)
+                mark_stage(context, "send")
+
+    # 流式回复时用户实际感受到的延迟为收到消息到看到第一段回复的时间
+    def _record_first_token(self, context: Context, first_time):
+        if first_time is not None and "produce_time" in context:
+            labels = (self.channel_type, Bridge().get_bot_type("chat"))
+            metrics.observe("first_token_latency_ms", (first_time - context["produce_time"]) * 1000, labels)
 
     def _send(self, reply: Reply, context: Context, retry_cnt=0):
         try:
@@ -293,9 +415,17 @@ class ChatChannel(Channel):
             if isinstance(e, NotImplementedError):
                 return
             logger.exception(e)
-            if retry_cnt < 2:
-                time.sleep(3 + 3 * retry_cnt)
-                self._send(reply, context, retry_cnt + 1)
+            if reply.type == ReplyType.TEXT_STREAM:  # 流式发送中断后，重试时发送完整的文本
+                reply = Reply(ReplyType.TEXT, reply.content.read())
+            if retry_cnt < conf().get("send_retry_times", 2):
+                # 指数退避加随机抖动，交给重试队列后立即释放当前worker和会话并发额度
+                delay = conf().get("send_retry_base_delay", 3) * (2**retry_cnt)
+                delay = random.uniform(delay / 2, delay)
+                logger.info("[chat_channel] retry sending in {:.1f}s, retry_cnt={}".format(delay, retry_cnt + 1))
+                metrics.incr("send_retry", labels=(self.channel_type,))
+                send_retry_queue.schedule(delay, self._send, reply, context, retry_cnt + 1)
+            else:
+                metrics.incr("send_failed", labels=(self.channel_type,))
 
     def _success_callback(self, session_id, **kwargs):  # 线程正常结束时的回调函数
         logger.debug("Worker return success, session_id = {}".format(session_id))
@@ -315,71 +445,294 @@ class ChatChannel(Channel):
                 logger.info("Worker cancelled, session_id = {}".format(session_id))
             except Exception as e:
                 logger.exception("Worker raise exception: {}".format(e))
-            with self.lock:
+            with self.cond:
+                if session_id in self.futures and worker in self.futures[session_id]:
+                    self.futures[session_id].remove(worker)
+                self.busy_workers -= 1
                 self.sessions[session_id][1].release()
+                self._mark_ready(session_id, self._is_priority(session_id))  # 同时唤醒consume线程调度空闲的worker
 
         return func
 
     def produce(self, context: Context):
+        if ChatChannel.draining:  # 停机排空中不再接收新消息，能保存的留到下次启动后回放，其余的直接回复
+            record = self._dump_context(context)
+            if record is not None:
+                self._save_pending([record])
+            else:
+                drain_reply = conf().get("drain_reply", "服务正在重启，请稍后再试")
+                if drain_reply:
+                    self._send_reply(context, Reply(ReplyType.TEXT, drain_reply))
+            return
+        with self.cond:
+            replay = not ChatChannel.replayed
+            ChatChannel.replayed = True
+        if replay:  # 收到第一条消息说明渠道已可用，先回放上次停机时未处理的消息
+            self._replay_pending()
         session_id = context["session_id"]
-        with self.lock:
+        context["produce_time"] = time.monotonic()
+        if conf().get("stage_timing", False):
+            context["timing"] = StageTimer()
+        is_admin_cmd = context.type == ContextType.TEXT and context.content.startswith("#")
+        with self.cond:
             if session_id not in self.sessions:
-                self.sessions[session_id] = [
-                    Dequeue(),
-                    threading.BoundedSemaphore(conf().get("concurrency_in_session", 4)),
-                ]
-            if context.type == ContextType.TEXT and context.content.startswith("#"):
-                self.sessions[session_id][0].putleft(context)  # 优先处理管理命令
+                max_sessions = conf().get("queue_max_sessions", 0)
+                if max_sessions and len(self.sessions) >= max_sessions and not is_admin_cmd:
+                    shed = "reject"
+                    self.shed_counter[shed] += 1
+                    metrics.incr("load_shed", labels=(shed,))
+                    logger.warning("[chat_channel] too many sessions in queue, reject context of session {}".format(session_id))
+                else:
+                    shed = None
+                    self.sessions[session_id] = [
+                        Dequeue(),
+                        threading.BoundedSemaphore(conf().get("concurrency_in_session", 4)),
+                        context.get("receiver", session_id),  # 调度分组，同一个群的所有session共享调度额度
+                    ]
             else:
-                self.sessions[session_id][0].put(context)
+                shed = None if is_admin_cmd else self._shed_load(session_id, context)  # 管理命令不受队列上限限制
+            if shed is None:
+                if is_admin_cmd:
+                    self.sessions[session_id][0].putleft(context)  # 优先处理管理命令
+                else:
+                    self.sessions[session_id][0].put(context)
+                self.queued_count += 1
+                self._mark_ready(session_id, self._is_priority(session_id))
+        busy_reply = conf().get("queue_busy_reply", "我正在忙着处理其他消息，请稍后再试")
+        if shed == "reject" and busy_reply:
+            self._send_reply(context, Reply(ReplyType.TEXT, busy_reply))
+
+    # 排队的消息超出上限时按queue_overflow_policy卸载负载，返回触发的策略，未超出上限时返回None，调用方需持有self.cond
+    def _shed_load(self, session_id, context):
+        context_queue = self.sessions[session_id][0]
+        max_size_in_session = conf().get("queue_max_size_in_session", 0)
+        max_size = conf().get("queue_max_size", 0)
+        if not (max_size_in_session and context_queue.qsize() >= max_size_in_session) and not (max_size and self.queued_count >= max_size):
+            return None
+        policy = conf().get("queue_overflow_policy", "drop_oldest")
+        # 管理命令不会被丢弃或合并
+        pending = [c for c in context_queue.queue if not (c.type == ContextType.TEXT and c.content.startswith("#"))]
+        shed = "reject"
+        if policy == "drop_oldest" and pending:
+            context_queue.queue.remove(pending[0])
+            context_queue.put(context)
+            shed = "drop_oldest"
+        elif policy == "merge" and context.type == ContextType.TEXT and pending and pending[-1].type == ContextType.TEXT:
+            pending[-1].content = pending[-1].content + "\n" + context.content
+            shed = "merge"
+        self.shed_counter[shed] += 1
+        metrics.incr("load_shed", labels=(shed,))
+        logger.warning("[chat_channel] queue of session {} is full, policy={}, shed={}".format(session_id, policy, shed))
+        return shed
+
+    # 队首是管理命令或session在vip列表中时优先调度，调用方需持有self.cond
+    def _is_priority(self, session_id):
+        if session_id in conf().get("schedule_vip_list", []):
+            return True
+        context_queue = self.sessions[session_id][0]
+        if context_queue.empty():
+            return False
+        context = context_queue.queue[0]
+        return context.type == ContextType.TEXT and context.content.startswith("#")
+
+    # 将session交给调度器并唤醒consume线程和等待排空的drain，调用方需持有self.cond
+    def _mark_ready(self, session_id, priority=False):
+        self.scheduler.push(session_id, self.sessions[session_id][2], priority)
+        self.cond.notify_all()
+
+    # 从就绪的session中取出一条待处理的context，调用方需持有self.cond
+    def _take_context(self, session_id):
+        context_queue, semaphore, _ = self.sessions[session_id]
+        if context_queue.empty():
+            if semaphore._initial_value == semaphore._value:  # 队列为空且没有任务在处理，说明所有任务都处理完毕
+                self.futures[session_id] = [t for t in self.futures.get(session_id, []) if not t.done()]
+                assert len(self.futures[session_id]) == 0, "thread pool error"
+                del self.futures[session_id]
+                del self.sessions[session_id]
+            self.scheduler.forget(session_id)
+            return None
+        window = conf().get("coalesce_window_seconds", 0)
+        if window and self._can_coalesce(context_queue.queue[0]):
+            ready_at = context_queue.queue[0]["produce_time"] + window
+            if ready_at > time.monotonic():  # 等待合并窗口内的后续消息
+                self.scheduler.forget(session_id)
+                if session_id not in self.deferred_sessions:
+                    self.deferred_sessions.add(session_id)
+                    heapq.heappush(self.deferred, (ready_at, session_id))
+                return None
+        if not semaphore.acquire(blocking=False):  # 会话并发已满，等worker处理完毕后由回调重新标记就绪
+            self.scheduler.forget(session_id)
+            return None
+        context = context_queue.get()
+        self.queued_count -= 1
+        mark_stage(context, "queue")
+        if window and self._can_coalesce(context):
+            merged = 0
+            while not context_queue.empty() and self._can_coalesce(context_queue.queue[0]):
+                context.content = context.content + "\n" + context_queue.get().content
+                merged += 1
+            if merged:
+                self.queued_count -= merged
+                self.coalesced_count += merged
+                metrics.incr("messages_coalesced", merged)
+                logger.info("[chat_channel] coalesce {} messages of session {}".format(merged + 1, session_id))
+        if not context_queue.empty():
+            self._mark_ready(session_id, self._is_priority(session_id))
+        return context
 
-    # 消费者函数，单独线程，用于从消息队列中取出消息并处理
+    # 普通文本消息才能合并，管理命令、插件指令和keyword插件的关键词需要单独处理
+    def _can_coalesce(self, context):
+        if context.type != ContextType.TEXT or context.content.startswith("#"):
+            return False
+        plugin_trigger_prefix = conf().get("plugin_trigger_prefix", "$")
+        if plugin_trigger_prefix and context.content.startswith(plugin_trigger_prefix):
+            return False
+        plugin_manager = PluginManager()
+        keyword = plugin_manager.instances.get("KEYWORD")  # keyword插件按整条消息精确匹配，合并后就匹配不上了
+        if keyword is not None and plugin_manager.plugins["KEYWORD"].enabled and context.content.strip() in keyword.keyword:
+            return False
+        return True
+
+    # 将合并窗口已结束的session重新交给调度器，返回距离下一个窗口结束的秒数，调用方需持有self.cond
+    def _wake_deferred(self):
+        now = time.monotonic()
+        while self.deferred and self.deferred[0][0] <= now:
+            _, session_id = heapq.heappop(self.deferred)
+            self.deferred_sessions.discard(session_id)
+            if session_id in self.sessions:
+                self._mark_ready(session_id, self._is_priority(session_id))
+        return self.deferred[0][0] - now if self.deferred else None
+
+    # 消费者函数，单独线程，由produce和worker回调唤醒，在有空闲worker时按调度器顺序取出消息并处理
     def consume(self):
+        use_async = conf().get("async_pipeline", False)
+        max_inflight = conf().get("async_max_inflight", 1000) if use_async else handler_pool_size
         while True:
-            with self.lock:
-                session_ids = list(self.sessions.keys())
-            for session_id in session_ids:
-                with self.lock:
-                    context_queue, semaphore = self.sessions[session_id]
-                if semaphore.acquire(blocking=False):  # 等线程处理完毕才能删除
-                    if not context_queue.empty():
-                        context = context_queue.get()
-                        logger.debug("[chat_channel] consume context: {}".format(context))
-                        future: Future = handler_pool.submit(self._handle, context)
-                        future.add_done_callback(self._thread_pool_callback(session_id, context=context))
-                        with self.lock:
-                            if session_id not in self.futures:
-                                self.futures[session_id] = []
-                            self.futures[session_id].append(future)
-                    elif semaphore._initial_value == semaphore._value + 1:  # 除了当前，没有任务再申请到信号量，说明所有任务都处理完毕
-                        with self.lock:
-                            self.futures[session_id] = [t for t in self.futures[session_id] if not t.done()]
-                            assert len(self.futures[session_id]) == 0, "thread pool error"
-                            del self.sessions[session_id]
-                    else:
-                        semaphore.release()
-            time.sleep(0.2)
+            with self.cond:
+                timeout = self._wake_deferred()
+                while not len(self.scheduler) or self.busy_workers >= max_inflight or self.draining:
+                    self.cond.wait(timeout)
+                    timeout = self._wake_deferred()
+                session_id = self.scheduler.pop()
+                if session_id not in self.sessions:
+                    self.scheduler.forget(session_id)
+                    continue
+                context = self._take_context(session_id)
+                if context is None:
+                    continue
+                if session_id not in self.futures:
+                    self.futures[session_id] = []
+                self.busy_workers += 1
+            logger.debug("[chat_channel] consume context: {}".format(context))
+            if use_async:
+                future: Future = asyncio.run_coroutine_threadsafe(self._handle_async(context), get_async_loop())
+            else:
+                future: Future = handler_pool.submit(self._handle, context)
+            with self.cond:
+                self.futures[session_id].append(future)
+            future.add_done_callback(self._thread_pool_callback(session_id, context=context))
+
+    # 停机前排空：不再调度排队的消息，等待处理中的消息在timeout秒内完成，然后将排队的消息保存到磁盘，下次启动后回放
+    def drain(self, timeout=None):
+        if timeout is None:
+            timeout = conf().get("drain_timeout_seconds", 30)
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            ChatChannel.draining = True
+            logger.info("[chat_channel] draining, {} in flight, {} queued".format(self.busy_workers, self.queued_count))
+            while self.busy_workers > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            if self.busy_workers > 0:
+                logger.warning("[chat_channel] drain timeout, {} contexts still in flight".format(self.busy_workers))
+            pending = [context for context_queue, _, _ in self.sessions.values() for context in context_queue.queue]
+        pending.sort(key=lambda context: context.get("produce_time", 0))
+        records = []
+        for context in pending:
+            record = self._dump_context(context)
+            if record is not None:
+                records.append(record)
+        if len(records) < len(pending):
+            logger.warning("[chat_channel] {} queued contexts can not be saved".format(len(pending) - len(records)))
+        if records:
+            self._save_pending(records, prepend=True)
+
+    # 将未处理的消息追加到磁盘文件，排空期间新到的消息也会写入，prepend为True时放在已保存的消息之前
+    def _save_pending(self, records, prepend=False):
+        path = os.path.join(get_appdata_dir(), "pending_contexts.pkl")
+        with pending_lock:
+            try:
+                try:
+                    with open(path, "rb") as f:
+                        saved = pickle.load(f)
+                except FileNotFoundError:
+                    saved = []
+                with open(path, "wb") as f:
+                    pickle.dump(records + saved if prepend else saved + records, f)
+                logger.info("[chat_channel] {} queued contexts saved".format(len(records)))
+            except Exception as e:
+                logger.error("[chat_channel] save queued contexts error: {}".format(e))
+
+    # 返回可以持久化的context副本，只保存文本类消息，原始消息对象和准备函数等无法序列化的字段会被去掉
+    def _dump_context(self, context: Context):
+        if context.type not in [ContextType.TEXT, ContextType.IMAGE_CREATE]:
+            return None
+        kwargs = {k: v for k, v in context.kwargs.items() if k not in ["timing", "produce_time"]}
+        cmsg = kwargs.get("msg")
+        if cmsg is not None:
+            msg = ChatMessage(None)
+            msg.__dict__.update({k: v for k, v in cmsg.__dict__.items() if not k.startswith("_")})
+            kwargs["msg"] = msg
+        record = Context(context.type, context.content, kwargs)
+        try:
+            pickle.dumps(record)
+        except Exception as e:
+            logger.warning("[chat_channel] context can not be saved: {}, error: {}".format(context, e))
+            return None
+        return record
+
+    def _replay_pending(self):
+        path = os.path.join(get_appdata_dir(), "pending_contexts.pkl")
+        try:
+            with pending_lock:
+                with open(path, "rb") as f:
+                    records = pickle.load(f)
+                os.remove(path)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error("[chat_channel] load queued contexts error: {}".format(e))
+            return
+        logger.info("[chat_channel] replay {} contexts saved before last shutdown".format(len(records)))
+        for context in records:
+            self.produce(context)
 
     # 取消session_id对应的所有任务，只能取消排队的消息和已提交线程池但未执行的任务
     def cancel_session(self, session_id):
-        with self.lock:
+        with self.cond:
             if session_id in self.sessions:
-                for future in self.futures[session_id]:
+                for future in self.futures.get(session_id, []):
                     future.cancel()
                 cnt = self.sessions[session_id][0].qsize()
                 if cnt > 0:
                     logger.info("Cancel {} messages in session {}".format(cnt, session_id))
+                self.queued_count -= cnt
                 self.sessions[session_id][0] = Dequeue()
+                self._mark_ready(session_id)  # 由consume线程清理空闲的session
 
     def cancel_all_session(self):
-        with self.lock:
+        with self.cond:
             for session_id in self.sessions:
-                for future in self.futures[session_id]:
+                for future in self.futures.get(session_id, []):
                     future.cancel()
                 cnt = self.sessions[session_id][0].qsize()
                 if cnt > 0:
                     logger.info("Cancel {} messages in session {}".format(cnt, session_id))
+                self.queued_count -= cnt
                 self.sessions[session_id][0] = Dequeue()
+                self._mark_ready(session_id)
 
 
 def check_prefix(content, prefix_list):
@@ -83,6 +83,7 @@ def _check(func):
 
 @singleton
 class DingTalkChanel(ChatChannel, dingtalk_stream.ChatbotHandler):
+    STREAM_REPLY = True
     dingtalk_client_id = conf().get('dingtalk_client_id')
     dingtalk_client_secret = conf().get('dingtalk_client_secret')
 
@@ -177,6 +178,10 @@ class DingTalkChanel(ChatChannel, dingtalk_stream.ChatbotHandler):
         isgroup = context.kwargs['msg'].is_group
         incoming_message = context.kwargs['msg'].incoming_message
 
+        if reply.type == ReplyType.TEXT_STREAM:
+            self.send_stream(reply, incoming_message, isgroup)
+            return
+
         if conf().get("dingtalk_card_enabled"):
             logger.info("[Dingtalk] sendMsg={}, receiver={}".format(reply, receiver))
             def reply_with_text():
@@ -200,6 +205,31 @@ class DingTalkChanel(ChatChannel, dingtalk_stream.ChatbotHandler):
             self.reply_text(reply.content, incoming_message)
 
 
+    def send_stream(self, reply: Reply, incoming_message, isgroup):
+        """
+        开启AI卡片时在卡片中增量展示流式回复，两次更新至少间隔stream_update_interval秒，避免触发钉钉接口限流
+        未开启AI卡片时按句子分段发送文本消息
+        """
+        if not conf().get("dingtalk_card_enabled"):
+            for sentence in reply.content.sentences(conf().get("stream_min_chars", 50)):
+                self.reply_text(sentence, incoming_message)
+            return
+        card = self.ai_markdown_card_start(incoming_message, "📌 内容由AI生成", "", [incoming_message.sender_staff_id])
+        interval = conf().get("stream_update_interval", 0.5)
+        last_update = 0
+        try:
+            for _ in reply.content:
+                if time.monotonic() - last_update >= interval:
+                    card.ai_streaming(markdown=reply.content.text, append=False)
+                    last_update = time.monotonic()
+        except Exception as e:
+            logger.error("[Dingtalk] stream reply error: {}".format(e))
+            card.ai_fail()
+            raise
+        card.ai_finish(markdown=reply.content.text)
+        if isgroup:
+            self.reply_text("📢 您有一条新的消息，请查看。", incoming_message)
+
     def generate_button_markdown_content(self, context, reply):
         image_url = context.kwargs.get("image_url")
         promptEn = context.kwargs.get("promptEn")
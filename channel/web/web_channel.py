@@ -8,6 +8,7 @@ from bridge.context import *
 from bridge.reply import Reply, ReplyType
 from channel.chat_channel import ChatChannel, check_prefix
 from channel.chat_message import ChatMessage
+from common.expired_dict import ExpiredDict
 from common.log import logger
 from common.singleton import singleton
 from config import conf
@@ -37,6 +38,7 @@ class WebMessage(ChatMessage):
 @singleton
 class WebChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = [ReplyType.VOICE]
+    STREAM_REPLY = True
     _instance = None
     
     # def __new__(cls):
@@ -49,6 +51,7 @@ class WebChannel(ChatChannel):
         self.msg_id_counter = 0  # 添加消息ID计数器
         self.session_queues = {}  # 存储session_id到队列的映射
         self.request_to_session = {}  # 存储request_id到session_id的映射
+        self.streams = ExpiredDict(600)  # 存储request_id到流式回复进度的映射，前端按request_id轮询
 
     def _generate_msg_id(self):
         """生成唯一的消息ID"""
@@ -81,6 +84,10 @@ class WebChannel(ChatChannel):
                 logger.error(f"No session_id found for request {request_id}")
                 return
             
+            if reply.type == ReplyType.TEXT_STREAM:
+                self._send_stream(reply, request_id, session_id)
+                return
+
             # 检查是否有会话队列
             if session_id in self.session_queues:
                 # 创建响应数据，包含请求ID以区分不同请求的响应
@@ -98,6 +105,35 @@ class WebChannel(ChatChannel):
         except Exception as e:
             logger.error(f"Error in send method: {e}")
 
+    def _send_stream(self, reply: Reply, request_id, session_id):
+        """
+        流式回复：收到第一段文本时通知前端开始展示，之后的内容写入进度，由前端按request_id轮询增量渲染
+        """
+        state = {"content": "", "done": False}
+        try:
+            for chunk in reply.content:
+                self._start_stream(reply, request_id, session_id, state)
+                state["content"] += chunk
+        finally:
+            # 没有生成任何内容或被中止时同样通知前端，由前端轮询到空内容和done后结束等待
+            state["done"] = True
+            self._start_stream(reply, request_id, session_id, state)
+
+    def _start_stream(self, reply: Reply, request_id, session_id, state):
+        """登记流式回复的进度并通知前端开始轮询，每个request只通知一次"""
+        if state.get("started"):
+            return
+        state["started"] = True
+        self.streams[request_id] = state
+        if session_id in self.session_queues:
+            self.session_queues[session_id].put({
+                "type": str(reply.type),
+                "content": "",
+                "timestamp": time.time(),
+                "request_id": request_id,
+                "stream": True
+            })
+
     def post_message(self):
         """
         Handle incoming messages from users via POST request.
@@ -153,6 +189,16 @@ class WebChannel(ChatChannel):
             data = web.data()
             json_data = json.loads(data)
             session_id = json_data.get('session_id')
+
+            # 查询流式回复的进度
+            request_id = json_data.get('request_id')
+            if request_id:
+                state = self.streams.get(request_id)
+                if state is None:
+                    return json.dumps({"status": "error", "message": "Invalid request ID"})
+                if state["done"]:
+                    self.streams.pop(request_id, None)
+                return json.dumps({"status": "success", "content": state["content"], "done": state["done"]})
             
             if not session_id or session_id not in self.session_queues:
                 return json.dumps({"status": "error", "message": "Invalid session ID"})
@@ -168,7 +214,8 @@ class WebChannel(ChatChannel):
                     "has_content": True,
                     "content": response["content"],
                     "request_id": response["request_id"],
-                    "timestamp": response["timestamp"]
+                    "timestamp": response["timestamp"],
+                    "stream": response.get("stream", False)
                 })
                 
             except Empty:
@@ -0,0 +1,143 @@
+"""
+上游服务的熔断和重试退避
+
+- 熔断器按服务(openai、moonshot等)区分，连续circuit_failure_threshold次超时、连接失败或5xx后熔断，
+  熔断期间的请求直接返回circuit_open_reply，不再占用工作线程等待重试
+- 熔断circuit_open_seconds秒后进入半开状态，放行一个探测请求：成功则恢复，失败则再次熔断且熔断时间翻倍
+- 重试间隔按指数退避加随机抖动计算，响应带Retry-After时按其等待，超过retry_backoff_max时不再重试
+"""
+import email.utils
+import random
+import threading
+import time
+
+from common.log import logger
+from common.metrics import metrics
+from config import conf
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}  # circuit_state指标的取值
+MAX_OPEN_FACTOR = 8  # 连续熔断时熔断时间最多翻倍到的倍数
+
+
+class CircuitBreaker(object):
+    def __init__(self, name):
+        self.name = name
+        self.state = CLOSED
+        self.failures = 0  # 连续失败次数
+        self.trips = 0  # 未恢复前的连续熔断次数，用于计算熔断时间
+        self.open_until = 0.0
+        self.lock = threading.Lock()
+        metrics.set_gauge("circuit_state", lambda: _STATE_CODES[self.state], labels=(name,))
+
+    def allow(self):
+        """
+        请求前调用，返回False时应直接失败
+        半开状态下放行一个探测请求，探测结果未上报前的其它请求仍被拒绝，探测请求超过熔断时间未上报时再放行一个
+        """
+        if not conf().get("circuit_breaker", True):
+            return True
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            now = time.monotonic()
+            if now < self.open_until:
+                rejected = True
+            else:
+                rejected = False
+                self.state = HALF_OPEN
+                self.open_until = now + conf().get("circuit_open_seconds", 30)
+        if rejected:
+            metrics.incr("circuit_rejected", labels=(self.name,))
+            return False
+        logger.info("[CircuitBreaker] {} half open, probing".format(self.name))
+        return True
+
+    def record_success(self):
+        """上游正常响应(包括4xx等请求本身的错误)时调用"""
+        with self.lock:
+            recovered = self.state != CLOSED
+            self.state = CLOSED
+            self.failures = 0
+            self.trips = 0
+        if recovered:
+            logger.info("[CircuitBreaker] {} recovered".format(self.name))
+
+    def record_failure(self, retry_after=None):
+        """
+        上游不可用(超时、连接失败、5xx)时调用
+        :param retry_after: 响应中Retry-After的秒数，熔断时间不小于该值
+        """
+        with self.lock:
+            if self.state == OPEN:  # 熔断前已发出的请求陆续失败，不重复计算
+                return
+            self.failures += 1
+            if self.state == CLOSED and self.failures < conf().get("circuit_failure_threshold", 5):
+                return
+            self.trips += 1
+            duration = conf().get("circuit_open_seconds", 30) * min(2 ** (self.trips - 1), MAX_OPEN_FACTOR)
+            if retry_after:
+                duration = max(duration, retry_after)
+            self.state = OPEN
+            self.failures = 0
+            self.open_until = time.monotonic() + duration
+        metrics.incr("circuit_opened", labels=(self.name,))
+        logger.warning("[CircuitBreaker] {} circuit open for {}s".format(self.name, duration))
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(name):
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                breaker = _breakers[name] = CircuitBreaker(name)
+    return breaker
+
+
+def open_reply():
+    return conf().get("circuit_open_reply", "服务暂时不可用，请稍后再试")
+
+
+def is_server_failure(status_code):
+    """5xx为服务端错误，说明上游不可用，应计入熔断；4xx是请求本身的问题，说明上游可用"""
+    return bool(status_code) and status_code >= 500
+
+
+def get_retry_after(obj):
+    """
+    从异常或响应的headers中解析Retry-After，支持秒数和HTTP日期两种格式
+    :param obj: openai.error.OpenAIError、requests.Response或带response属性的异常
+    :return: 秒数，没有该header时返回None
+    """
+    headers = getattr(obj, "headers", None)
+    if headers is None and getattr(obj, "response", None) is not None:
+        headers = getattr(obj.response, "headers", None)
+    value = headers.get("Retry-After") or headers.get("retry-after") if headers else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(retry_count, retry_after=None):
+    """
+    第retry_count次重试(从0开始)前的等待秒数：retry_backoff_base * 2^retry_count以内的随机值，
+    不超过retry_backoff_max；有Retry-After时至少等待该时间
+    :return: 等待秒数，Retry-After超过retry_backoff_max时返回None，表示不应重试
+    """
+    cap = conf().get("retry_backoff_max", 20)
+    if retry_after is not None and retry_after > cap:
+        return None
+    delay = random.uniform(0, min(cap, conf().get("retry_backoff_base", 1) * 2 ** retry_count))
+    return max(delay, retry_after or 0)
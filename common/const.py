@@ -16,6 +16,7 @@ ZHIPU_AI = "glm-4"
 MOONSHOT = "moonshot"
 MiniMax = "minimax"
 MODELSCOPE = "modelscope"
+ROUTER = "router"  # 多后端路由，按router_backends配置对冲请求和故障转移
 
 # model
 CLAUDE3 = "claude-3-opus-20240229"
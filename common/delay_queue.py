@@ -0,0 +1,43 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common.log import logger
+
+
+# 延迟任务队列，所有任务共用一个计时线程，到期后交给线程池执行，不会占用调用方的线程
+class DelayQueue(object):
+    def __init__(self, max_workers=2, name="delay_queue"):
+        self.name = name
+        self.heap = []  # (到期时间, 序号, func, args, kwargs)
+        self.counter = itertools.count()  # 到期时间相同时按加入顺序执行
+        self.cond = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.thread = None
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, delay, func, *args, **kwargs):
+        """
+        delay秒后在线程池中执行func(*args, **kwargs)
+        """
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self.thread.start()
+            heapq.heappush(self.heap, (time.monotonic() + delay, next(self.counter), func, args, kwargs))
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    self.cond.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                _, _, func, args, kwargs = heapq.heappop(self.heap)
+            try:
+                self.executor.submit(func, *args, **kwargs)
+            except Exception as e:
+                logger.exception("[{}] submit task error: {}".format(self.name, e))
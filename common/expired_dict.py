@@ -1,22 +1,62 @@
-from datetime import datetime, timedelta
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
 
 
-class ExpiredDict(dict):
-    def __init__(self, expires_in_seconds):
-        super().__init__()
+class ExpiredDict(MutableMapping):
+    """
+    带过期时间的字典，读写都会刷新过期时间，线程安全
+    所有key的有效期相同，按最近访问顺序保存的数据同时也是按过期时间排序的，
+    过期清理和超出max_size时的LRU淘汰都只需要从队首弹出，均摊O(1)
+    """
+
+    def __init__(self, expires_in_seconds, max_size=0, on_expire=None):
         self.expires_in_seconds = expires_in_seconds
+        self.max_size = max_size  # 最多保存的key数量，超出时淘汰最久未访问的，0为不限制
+        self.on_expire = on_expire  # 过期或被LRU淘汰时的回调on_expire(key, value)，持有self.lock时调用，回调中不能访问本字典
+        self.data = OrderedDict()  # key -> (value, 过期时间)，越靠前越早过期
+        self.lock = threading.Lock()
+
+    # 清理队首已过期的数据，调用方需持有self.lock
+    def _evict(self):
+        now = time.monotonic()
+        data = self.data
+        while data:
+            key, (_, expiry_time) = next(iter(data.items()))
+            if expiry_time > now:
+                break
+            self._expire(key)
+        if self.max_size:
+            while len(data) > self.max_size:
+                self._expire(next(iter(data)))
+
+    # 删除过期或被淘汰的key并通知回调，调用方需持有self.lock
+    def _expire(self, key):
+        value, _ = self.data.pop(key)
+        if self.on_expire is not None:
+            self.on_expire(key, value)
 
     def __getitem__(self, key):
-        value, expiry_time = super().__getitem__(key)
-        if datetime.now() > expiry_time:
-            del self[key]
-            raise KeyError("expired {}".format(key))
-        self.__setitem__(key, value)
-        return value
+        with self.lock:
+            value, expiry_time = self.data[key]
+            now = time.monotonic()
+            if now > expiry_time:
+                self._expire(key)
+                raise KeyError("expired {}".format(key))
+            self.data[key] = (value, now + self.expires_in_seconds)
+            self.data.move_to_end(key)
+            return value
 
     def __setitem__(self, key, value):
-        expiry_time = datetime.now() + timedelta(seconds=self.expires_in_seconds)
-        super().__setitem__(key, (value, expiry_time))
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + self.expires_in_seconds)
+            self.data.move_to_end(key)
+            self._evict()
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.data[key]
 
     def get(self, key, default=None):
         try:
@@ -31,12 +71,29 @@ class ExpiredDict(dict):
         except KeyError:
             return False
 
+    def __len__(self):
+        with self.lock:
+            self._evict()
+            return len(self.data)
+
     def keys(self):
-        keys = list(super().keys())
-        return [key for key in keys if key in self]
+        with self.lock:
+            self._evict()
+            return list(self.data.keys())
+
+    def values(self):
+        with self.lock:
+            self._evict()
+            return [value for value, _ in self.data.values()]
 
     def items(self):
-        return [(key, self[key]) for key in self.keys()]
+        with self.lock:
+            self._evict()
+            return [(key, value) for key, (value, _) in self.data.items()]
 
     def __iter__(self):
         return self.keys().__iter__()
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
@@ -0,0 +1,88 @@
+from collections import deque
+
+_PRIORITY = object()  # 优先通道标记
+
+
+# 两级加权轮询(Deficit Round Robin)调度器，非线程安全，调用方需自行加锁
+# key按group分组，group之间按权重轮询，每个group每轮最多被连续调度weight次，group内的key依次轮询
+# 优先通道中的key不参与分组，总是先于普通key被调度
+class FairScheduler(object):
+    def __init__(self, weight_func=None):
+        self.weight_func = weight_func or (lambda group: 1)
+        self.priority_lane = deque()  # 优先通道中的key
+        self.group_lane = deque()  # 普通通道中group的轮询顺序
+        self.groups = {}  # group -> 组内待调度的key
+        self.keys = {}  # key -> 所属group或_PRIORITY，通道中与此不一致的条目视为已失效
+        self.deficits = {}  # group -> 本轮剩余可调度次数
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def push(self, key, group=None, priority=False):
+        """
+        将key加入待调度队列，已在队列中的key不会重复加入
+        :param group: key所属的分组，默认每个key单独一组
+        :param priority: 为True时key会被提升到优先通道
+        """
+        current = self.keys.get(key)
+        if current is _PRIORITY or (current is not None and not priority):
+            return
+        if priority:
+            self.keys[key] = _PRIORITY
+            self.priority_lane.append(key)
+            return
+        group = key if group is None else group
+        self.keys[key] = group
+        if group not in self.groups:
+            self.groups[group] = deque()
+            if self.deficits.get(group, 0) > 0:  # 本轮还有剩余额度，继续排在队首
+                self.group_lane.appendleft(group)
+            else:
+                self.group_lane.append(group)
+        self.groups[group].append(key)
+
+    def pop(self):
+        """
+        取出下一个应被调度的key，没有时返回None
+        """
+        while self.priority_lane:
+            key = self.priority_lane.popleft()
+            if self.keys.get(key) is _PRIORITY:
+                del self.keys[key]
+                return key
+        while self.group_lane:
+            group = self.group_lane[0]
+            members = self.groups[group]
+            while members and self.keys.get(members[0]) != group:
+                members.popleft()
+            if not members:
+                self.group_lane.popleft()
+                del self.groups[group]
+                continue
+            key = members.popleft()
+            del self.keys[key]
+            deficit = self.deficits.get(group, 0)
+            if deficit <= 0:
+                deficit = max(int(self.weight_func(group)), 1)
+            deficit -= 1
+            if deficit > 0:
+                self.deficits[group] = deficit
+            else:
+                self.deficits.pop(group, None)
+            if deficit <= 0 or not members:
+                self.group_lane.popleft()
+                if members:
+                    self.group_lane.append(group)
+                else:
+                    del self.groups[group]
+            return key
+        return None
+
+    def forget(self, key):
+        """
+        key暂时没有可调度的任务时调用，将其移出待调度队列
+        """
+        self.keys.pop(key, None)
@@ -0,0 +1,101 @@
+"""
+共享的HTTP客户端，所有基于REST接口的bot、语音和翻译服务通过它发送请求
+
+- 进程内共用一个requests.Session，按host维护keep-alive连接池，同一个host的请求复用TCP和TLS连接
+- 未指定timeout时使用(http_connect_timeout, request_timeout)
+- 连接失败时自动重试http_retries次；502/503/504只对GET等幂等请求重试，POST请求的重试由调用方决定
+- 未指定proxies时使用proxy配置
+- post_upstream在此基础上按服务名接入key池和熔断器，供OpenAI兼容接口的bot共用
+"""
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from common.circuit_breaker import get_circuit_breaker, get_retry_after, is_server_failure
+from common.key_pool import get_key_pool
+from config import conf
+
+_session = None
+_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                retries = conf().get("http_retries", 2)
+                retry = Retry(
+                    total=None,
+                    connect=retries,
+                    read=retries,
+                    status=retries,
+                    status_forcelist=(502, 503, 504),
+                    backoff_factor=0.5,
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=conf().get("http_pool_connections", 10),
+                    pool_maxsize=conf().get("http_pool_maxsize", 20),
+                    max_retries=retry,
+                )
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+
+def _proxies():
+    proxy = conf().get("proxy")
+    return {"http": proxy, "https": proxy} if proxy else None
+
+
+def request(method, url, **kwargs) -> requests.Response:
+    kwargs.setdefault("timeout", (conf().get("http_connect_timeout", 10), conf().get("request_timeout", 180)))
+    if "proxies" not in kwargs:
+        kwargs["proxies"] = _proxies()
+    return get_session().request(method, url, **kwargs)
+
+
+def get(url, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs) -> requests.Response:
+    return request("POST", url, **kwargs)
+
+
+def post_upstream(name, url, api_key, api_keys=None, **kwargs) -> requests.Response:
+    """
+    向模型服务发送请求：配置了api_keys时从名为name的key池中选择负载最低的健康key，
+    并按响应状态更新key的统计和冷却以及名为name的熔断器，调用方需先检查熔断器是否放行
+    :param api_key: 原有的单个key配置
+    :param api_keys: 额外配置的key列表，为空时始终使用api_key
+    """
+    pool = get_key_pool(name, api_key, api_keys or [])
+    request_key = pool.acquire() if pool else api_key
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": "Bearer " + request_key
+    }
+    start = time.monotonic()
+    breaker = get_circuit_breaker(name)
+    try:
+        res = post(url, headers=headers, **kwargs)
+    except Exception:
+        if pool:
+            pool.release(request_key, status_code=0)
+        breaker.record_failure()
+        raise
+    if is_server_failure(res.status_code):
+        breaker.record_failure(get_retry_after(res))
+    else:
+        breaker.record_success()
+    if pool:
+        pool.release(request_key, latency_ms=(time.monotonic() - start) * 1000,
+                     status_code=None if res.status_code == 200 else res.status_code)
+    return res
@@ -0,0 +1,147 @@
+"""
+API key池：同一个服务配置多个key时，每次请求选择当前负载最低的健康key，
+返回429(限流)或401/403(鉴权失败)的key会被自动冷却一段时间
+"""
+import threading
+import time
+
+from common.log import logger
+from common.metrics import metrics
+from common.token_bucket import TokenBucket
+from config import conf
+
+EWMA_ALPHA = 0.2  # 延迟和错误率的指数滑动平均系数
+MAX_BACKOFF = 16  # 连续限流时冷却时间最多翻倍到的倍数
+AUTH_COOLDOWN_FACTOR = 60  # 鉴权失败的key冷却时间为api_key_cooldown_seconds的倍数
+
+
+class PooledKey(object):
+    def __init__(self, key, rpm=0, tpm=0):
+        self.key = key
+        self.rpm_bucket = TokenBucket(rpm) if rpm else None
+        self.tpm_bucket = TokenBucket(tpm) if tpm else None
+        self.inflight = 0  # 正在进行的请求数
+        self.latency_ms = 0.0  # 成功请求延迟的滑动平均
+        self.error_rate = 0.0  # 错误率的滑动平均
+        self.failures = 0  # 连续限流次数，用于计算冷却时间
+        self.cooldown_until = 0.0
+
+    def score(self):
+        """负载分数，越小越优先：进行中的请求越多、延迟越高、错误越多分数越高"""
+        return (self.inflight + 1) * max(self.latency_ms, 1.0) * (1 + 4 * self.error_rate)
+
+    def try_acquire(self, tokens):
+        if self.rpm_bucket and not self.rpm_bucket.try_acquire(1):
+            return False
+        if self.tpm_bucket and tokens and not self.tpm_bucket.try_acquire(tokens):
+            if self.rpm_bucket:
+                self.rpm_bucket.refund(1)
+            return False
+        return True
+
+    def acquire(self, tokens, timeout=None):
+        if self.rpm_bucket and not self.rpm_bucket.acquire(1, timeout):
+            return False
+        if self.tpm_bucket and tokens and not self.tpm_bucket.acquire(tokens, timeout):
+            if self.rpm_bucket:
+                self.rpm_bucket.refund(1)
+            return False
+        return True
+
+    def masked(self):
+        return "{}***{}".format(self.key[:6], self.key[-4:]) if len(self.key) > 12 else "***"
+
+
+class KeyPool(object):
+    def __init__(self, name, keys, rpm=0, tpm=0):
+        """
+        :param name: 服务名，用于日志和指标
+        :param keys: api key列表
+        :param rpm: 每个key每分钟的请求数限制，0为不限制
+        :param tpm: 每个key每分钟的token数限制，0为不限制
+        """
+        self.name = name
+        self.keys = [PooledKey(key, rpm, tpm) for key in keys]
+        self.by_key = {pooled.key: pooled for pooled in self.keys}
+        self.lock = threading.Lock()
+        metrics.set_gauge("api_key_healthy", self.healthy_count, labels=(name,))
+
+    def healthy_count(self):
+        now = time.monotonic()
+        return sum(1 for pooled in self.keys if pooled.cooldown_until <= now)
+
+    def acquire(self, tokens=0, timeout=None):
+        """
+        选择一个key并占用，请求结束后必须调用release
+        优先选择未冷却且限额充足的key中负载最低的，都没有余量时在负载最低的健康key上等待，全部冷却时选择最早恢复的key
+        :param tokens: 预估的prompt token数，用于按token限流
+        :return: 选中的key，等待限额超时返回None
+        """
+        now = time.monotonic()
+        with self.lock:
+            healthy = [pooled for pooled in self.keys if pooled.cooldown_until <= now]
+            candidates = sorted(healthy, key=PooledKey.score) if healthy else [min(self.keys, key=lambda pooled: pooled.cooldown_until)]
+            chosen = next((pooled for pooled in candidates if pooled.try_acquire(tokens)), None)
+            need_wait = chosen is None
+            if need_wait:
+                chosen = candidates[0]
+            chosen.inflight += 1
+        if need_wait and not chosen.acquire(tokens, timeout):
+            with self.lock:
+                chosen.inflight -= 1
+            return None
+        return chosen.key
+
+    def release(self, key, latency_ms=None, status_code=None):
+        """
+        请求结束后归还key并记录结果
+        :param latency_ms: 请求耗时，请求失败时可以为None
+        :param status_code: 失败时的http状态码，成功时为None
+        """
+        pooled = self.by_key.get(key)
+        if pooled is None:
+            return
+        with self.lock:
+            pooled.inflight -= 1
+            failed = status_code is not None
+            pooled.error_rate += EWMA_ALPHA * ((1.0 if failed else 0.0) - pooled.error_rate)
+            if not failed:
+                pooled.failures = 0
+                if latency_ms is not None:
+                    pooled.latency_ms = latency_ms if not pooled.latency_ms else pooled.latency_ms + EWMA_ALPHA * (latency_ms - pooled.latency_ms)
+                return
+            cooldown = conf().get("api_key_cooldown_seconds", 30)
+            if status_code == 429:
+                pooled.failures += 1
+                cooldown *= min(2 ** (pooled.failures - 1), MAX_BACKOFF)
+            elif status_code in (401, 403):
+                cooldown *= AUTH_COOLDOWN_FACTOR
+            else:
+                return
+            pooled.cooldown_until = time.monotonic() + cooldown
+        metrics.incr("api_key_cooldown", labels=(self.name, status_code))
+        logger.warning("[KeyPool] {} key {} got status {}, cool down for {}s".format(self.name, pooled.masked(), status_code, cooldown))
+
+
+_pools = {}  # 服务名 -> KeyPool，配置中的key变化时重新创建
+_pools_lock = threading.Lock()
+
+
+def get_key_pool(name, primary_key, extra_keys, rpm=0, tpm=0):
+    """
+    返回服务的key池，primary_key为原有的单个key配置，extra_keys为额外配置的key列表
+    没有配置额外的key时返回None，调用方按原有方式使用单个key
+    """
+    if not extra_keys:
+        return None
+    keys = list(dict.fromkeys(key for key in [primary_key] + list(extra_keys) if key))
+    if not keys:
+        return None
+    signature = (tuple(keys), rpm, tpm)
+    with _pools_lock:
+        entry = _pools.get(name)
+        if entry is None or entry[0] != signature:
+            entry = (signature, KeyPool(name, keys, rpm, tpm))
+            _pools[name] = entry
+            logger.info("[KeyPool] {} key pool created with {} keys".format(name, len(keys)))
+        return entry[1]
@@ -0,0 +1,138 @@
+import bisect
+import threading
+import time
+
+
+class Histogram(object):
+    """按固定分桶统计的直方图，默认用于统计毫秒级耗时"""
+
+    BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 60000, 120000)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一个桶统计超出上限的值
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, p):
+        """返回p分位数所在桶的上界，超出最大分桶时返回观测到的最大值"""
+        with self.lock:
+            if self.count == 0:
+                return 0
+            rank = p / 100 * self.count
+            seen = 0
+            for i, cnt in enumerate(self.counts):
+                seen += cnt
+                if seen >= rank and cnt:
+                    return round(min(self.buckets[i], self.max) if i < len(self.buckets) else self.max, 2)
+            return round(self.max, 2)
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "avg": round(self.total / self.count, 2) if self.count else 0,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": round(self.max, 2),
+        }
+
+
+class Metrics(object):
+    """进程内的指标注册表，包含计数器、仪表和直方图，指标名可以带标签，如 name{web,chatGPT}"""
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return "{}{{{}}}".format(name, ",".join(str(label) for label in labels)) if labels else name
+
+    def incr(self, name, value=1, labels=()):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, labels=()):
+        """value可以是数值，也可以是查询时才计算的无参函数"""
+        self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, labels=()):
+        key = self._key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        histogram.observe(value)
+
+    def snapshot(self, prefix=""):
+        gauges = {}
+        for key, value in list(self.gauges.items()):
+            if key.startswith(prefix):
+                try:
+                    gauges[key] = value() if callable(value) else value
+                except Exception as e:
+                    gauges[key] = "error: {}".format(e)
+        return {
+            "counters": {k: v for k, v in list(self.counters.items()) if k.startswith(prefix)},
+            "gauges": gauges,
+            "histograms": {k: h.snapshot() for k, h in list(self.histograms.items()) if k.startswith(prefix)},
+        }
+
+    def format_text(self, prefix=""):
+        snapshot = self.snapshot(prefix)
+        lines = []
+        for key, value in sorted(snapshot["counters"].items()):
+            lines.append("{}: {}".format(key, value))
+        for key, value in sorted(snapshot["gauges"].items()):
+            lines.append("{}: {}".format(key, value))
+        for key, value in sorted(snapshot["histograms"].items()):
+            lines.append("{}: n={count} avg={avg} p50={p50} p90={p90} p99={p99} max={max}".format(key, **value))
+        return "\n".join(lines) if lines else "暂无统计数据"
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+class StageTimer(object):
+    """记录一条消息在处理流程中各阶段结束时刻的单调时间戳"""
+
+    __slots__ = ("marks",)
+
+    def __init__(self, stage="produce"):
+        self.marks = [(stage, time.monotonic())]
+
+    def mark(self, stage):
+        self.marks.append((stage, time.monotonic()))
+
+    def durations(self):
+        """返回[(阶段名, 耗时毫秒)]，每个阶段的耗时为与上一个时间戳的差值"""
+        return [(self.marks[i][0], (self.marks[i][1] - self.marks[i - 1][1]) * 1000) for i in range(1, len(self.marks))]
+
+    def total(self):
+        return (self.marks[-1][1] - self.marks[0][1]) * 1000
+
+
+def mark_stage(context, stage):
+    """context开启了计时时记录阶段时间戳，未开启时只有一次字典查找的开销"""
+    if context is not None and "timing" in context:
+        context["timing"].mark(stage)
+
+
+# 全局指标注册表
+metrics = Metrics()
@@ -0,0 +1,65 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+# 合并并发的相同调用：同一个key同时只有一个调用在执行，其余调用等待并共享它的结果
+# 同步调用和协程调用共用同一张表，可以相互合并
+class SingleFlight(object):
+    def __init__(self):
+        self.calls = {}  # key -> 正在执行的调用的Future
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.calls)
+
+    def _join(self, key):
+        """
+        返回(future, leader)，leader为True时调用方负责执行并设置结果
+        """
+        with self.lock:
+            future = self.calls.get(key)
+            if future is not None:
+                return future, False
+            future = Future()
+            self.calls[key] = future
+            return future, True
+
+    def _finish(self, key, future, result=None, exception=None):
+        with self.lock:
+            self.calls.pop(key, None)
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def do(self, key, func, *args, snapshot=None, **kwargs):
+        """
+        执行func(*args, **kwargs)，返回(结果, 是否共享了其他调用的结果)
+        :param snapshot: 结果可能被调用方原地修改时，用它复制一份结果共享给等待的调用
+        """
+        future, leader = self._join(key)
+        if not leader:
+            return future.result(), True
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            self._finish(key, future, exception=e)
+            raise
+        self._finish(key, future, snapshot(result) if snapshot else result)
+        return result, False
+
+    async def do_async(self, key, func, *args, snapshot=None, **kwargs):
+        """
+        协程版本的do，func为协程函数
+        """
+        future, leader = self._join(key)
+        if not leader:
+            return await asyncio.wrap_future(future), True
+        try:
+            result = await func(*args, **kwargs)
+        except BaseException as e:
+            self._finish(key, future, exception=e)
+            raise
+        self._finish(key, future, snapshot(result) if snapshot else result)
+        return result, False
@@ -1,45 +1,112 @@
+import asyncio
 import threading
 import time
 
 
 class TokenBucket:
+    """
+    令牌桶限流，不需要后台线程：每次获取令牌时按距上次补充经过的时间计算应补充的令牌数
+
+    获取时先预留令牌（令牌数可以为负），再在锁外等待欠下的令牌补齐，
+    等待者按预留顺序依次放行，每次获取只需一次加锁
+    """
+
     def __init__(self, tpm, timeout=None):
-        self.capacity = int(tpm)  # 令牌桶容量
-        self.tokens = 0  # 初始令牌数为0
+        self.capacity = int(tpm)  # 令牌桶容量，即每分钟可用的令牌数
         self.rate = int(tpm) / 60  # 令牌每秒生成速率
-        self.timeout = timeout  # 等待令牌超时时间
-        self.cond = threading.Condition()  # 条件变量
-        self.is_running = True
-        # 开启令牌生成线程
-        threading.Thread(target=self._generate_tokens).start()
-
-    def _generate_tokens(self):
-        """生成令牌"""
-        while self.is_running:
-            with self.cond:
-                if self.tokens < self.capacity:
-                    self.tokens += 1
-                self.cond.notify()  # 通知获取令牌的线程
-            time.sleep(1 / self.rate)
+        self.timeout = timeout  # 等待令牌超时时间，None为一直等待
+        self.tokens = self.capacity  # 初始为满桶
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
 
-    def get_token(self):
-        """获取令牌"""
-        with self.cond:
-            while self.tokens <= 0:
-                flag = self.cond.wait(self.timeout)
-                if not flag:  # 超时
-                    return False
-            self.tokens -= 1
+    def _reserve(self, amount, timeout):
+        """
+        预留amount个令牌，返回需要等待的秒数，等待时间超过timeout时不预留并返回None
+        超过桶容量的请求按容量计算，避免永远无法获取
+        """
+        amount = min(amount, self.capacity)
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+            self.last_time = now
+            wait = max(0.0, (amount - self.tokens) / self.rate)
+            if timeout is not None and wait > timeout:
+                return None
+            self.tokens -= amount
+            return wait
+
+    def try_acquire(self, amount=1):
+        """不等待，令牌足够时获取并返回True"""
+        return self._reserve(amount, 0) is not None
+
+    def acquire(self, amount=1, timeout=None):
+        """
+        获取amount个令牌，令牌不足时阻塞等待，超时返回False
+        :param amount: 令牌数，按token限流时为预估的prompt token数
+        :param timeout: 最长等待秒数，为None时使用创建时的timeout
+        """
+        wait = self._reserve(amount, self.timeout if timeout is None else timeout)
+        if wait is None:
+            return False
+        if wait > 0:
+            time.sleep(wait)
         return True
 
+    async def acquire_async(self, amount=1, timeout=None):
+        """acquire的协程版本，等待时不阻塞事件循环"""
+        wait = self._reserve(amount, self.timeout if timeout is None else timeout)
+        if wait is None:
+            return False
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return True
+
+    def refund(self, amount=1):
+        """归还已获取但未使用的令牌"""
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + min(amount, self.capacity))
+
+    def get_token(self):
+        """获取一个令牌"""
+        return self.acquire(1)
+
     def close(self):
-        self.is_running = False
+        """没有后台线程，保留该方法兼容旧的调用方式"""
+        pass
+
+
+class TokenBucketGroup:
+    """
+    按key分别限流的一组令牌桶，key通常为(api_key, model)，每个key的限额相同
+    """
+
+    def __init__(self, tpm, timeout=None):
+        self.tpm = tpm
+        self.timeout = timeout
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            with self.lock:
+                bucket = self.buckets.setdefault(key, TokenBucket(self.tpm, self.timeout))
+        return bucket
+
+    def acquire(self, key, amount=1, timeout=None):
+        return self.get(key).acquire(amount, timeout)
+
+    async def acquire_async(self, key, amount=1, timeout=None):
+        return await self.get(key).acquire_async(amount, timeout)
+
+    def refund(self, key, amount=1):
+        self.get(key).refund(amount)
 
 
 if __name__ == "__main__":
-    token_bucket = TokenBucket(20, None)  # 创建一个每分钟生产20个tokens的令牌桶
-    # token_bucket = TokenBucket(20, 0.1)
-    for i in range(3):
+    token_bucket = TokenBucket(20, 0.1)  # 创建一个每分钟生产20个tokens的令牌桶
+    for i in range(25):
         if token_bucket.get_token():
             print(f"第{i+1}次请求成功")
-    token_bucket.close()
+        else:
+            print(f"第{i+1}次请求被限流")
@@ -0,0 +1,99 @@
+import threading
+
+from common import const
+from common.log import logger
+
+
+class CharTokenizer(object):
+    """按字符数估算token，用于没有tiktoken编码的模型，或tiktoken不可用时"""
+
+    reply_tokens = 0
+
+    def count(self, text):
+        return len(text)
+
+    def count_message(self, message):
+        return len(message["content"])
+
+
+class TiktokenTokenizer(object):
+    """
+    tiktoken编码器，计算规则参考
+    https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+    """
+
+    reply_tokens = 3  # every reply is primed with <|start|>assistant<|message|>
+
+    def __init__(self, encoding, tokens_per_message, tokens_per_name):
+        self.encoding = encoding
+        self.tokens_per_message = tokens_per_message
+        self.tokens_per_name = tokens_per_name
+
+    def count(self, text):
+        return len(self.encoding.encode(text))
+
+    def count_message(self, message):
+        num_tokens = self.tokens_per_message
+        for key, value in message.items():
+            num_tokens += len(self.encoding.encode(value))
+            if key == "name":
+                num_tokens += self.tokens_per_name
+        return num_tokens
+
+
+# 模型别名，映射到计算规则相同的基础模型
+_GPT35_ALIASES = ["gpt-3.5-turbo-0301", "gpt-35-turbo", "gpt-3.5-turbo-1106", "moonshot", const.LINKAI_35]
+_GPT4_ALIASES = ["gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613",
+                 "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k", "gpt-4-turbo-preview",
+                 "gpt-4-1106-preview", const.GPT4_TURBO_PREVIEW, const.GPT4_VISION_PREVIEW, const.GPT4_TURBO_01_25,
+                 const.GPT_4o, const.GPT_4O_0806, const.GPT_4o_MINI, const.LINKAI_4o, const.LINKAI_4_TURBO]
+
+_tokenizers = {}  # 模型名 -> tokenizer，进程内共享
+_lock = threading.Lock()
+
+
+def resolve_model(model):
+    """返回模型对应的基础模型：gpt-3.5-turbo、gpt-4，按字符计数的模型返回None"""
+    if model in ["wenxin", "xunfei"] or model.startswith(const.GEMINI):
+        return None
+    if model in _GPT4_ALIASES or model == "gpt-4":
+        return "gpt-4"
+    if model not in _GPT35_ALIASES and not model.startswith("claude-3") and model != "gpt-3.5-turbo":
+        logger.debug(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
+    return "gpt-3.5-turbo"
+
+
+def _load(base_model):
+    if base_model is None:
+        return CharTokenizer()
+    try:
+        import tiktoken
+
+        encoding = tiktoken.encoding_for_model(base_model)
+    except Exception as e:
+        logger.warning("[tokenizer] load tiktoken encoding for {} failed, count tokens by character: {}".format(base_model, e))
+        return CharTokenizer()
+    if base_model == "gpt-4":
+        return TiktokenTokenizer(encoding, 3, 1)
+    return TiktokenTokenizer(encoding, 4, -1)  # every message follows <|start|>{role/name}\n{content}<|end|>\n, if there's a name, the role is omitted
+
+
+def get_tokenizer(model):
+    """返回模型对应的tokenizer，每个模型名只解析一次，每种编码只加载一次"""
+    tokenizer = _tokenizers.get(model)
+    if tokenizer is None:
+        base_model = resolve_model(model)
+        with _lock:
+            tokenizer = _tokenizers.get(base_model)
+            if tokenizer is None:
+                tokenizer = _load(base_model)
+                _tokenizers[base_model] = tokenizer
+            _tokenizers[model] = tokenizer
+    return tokenizer
+
+
+def warm_up(*models):
+    """提前加载编码，避免第一条消息等待BPE文件加载"""
+    for model in models:
+        if model:
+            get_tokenizer(model)
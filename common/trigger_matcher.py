@@ -0,0 +1,154 @@
+import re
+from collections import deque
+from functools import lru_cache
+
+from config import conf
+
+
+class PrefixTrie(object):
+    """前缀树，返回与check_prefix相同的结果：配置列表中最靠前的匹配前缀"""
+
+    def __init__(self, prefixes):
+        self.root = {}
+        self.empty_index = None  # 空前缀匹配所有内容
+        for index, prefix in enumerate(prefixes or []):
+            if not prefix:
+                if self.empty_index is None:
+                    self.empty_index = index
+                continue
+            node = self.root
+            for ch in prefix:
+                node = node.setdefault(ch, {})
+            if None not in node:  # None键保存前缀在列表中的位置和前缀本身
+                node[None] = (index, prefix)
+        self.empty = prefixes is None or len(prefixes) == 0
+
+    def match(self, content):
+        if self.empty:
+            return None
+        best = (self.empty_index, "") if self.empty_index is not None else None
+        node = self.root
+        for ch in content:
+            node = node.get(ch)
+            if node is None:
+                break
+            if None in node and (best is None or node[None][0] < best[0]):
+                best = node[None]
+        return best[1] if best else None
+
+
+class KeywordAutomaton(object):
+    """Aho-Corasick自动机，一次扫描判断内容是否包含任意关键词，与check_contain结果一致"""
+
+    def __init__(self, keywords):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [False]
+        self.match_all = False
+        for keyword in keywords or []:
+            if not keyword:
+                self.match_all = True
+                continue
+            state = 0
+            for ch in keyword:
+                nxt = self.goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(False)
+                    self.goto[state][ch] = nxt
+                state = nxt
+            self.output[state] = True
+        self.empty = len(self.goto) == 1 and not self.match_all
+        # 按层构建失配指针
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.output[nxt] = self.output[nxt] or self.output[self.fail[nxt]]
+
+    def search(self, content):
+        if self.empty:
+            return None
+        if self.match_all:
+            return True
+        state = 0
+        goto, fail, output = self.goto, self.fail, self.output
+        for ch in content:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                return True
+        return None
+
+
+class TriggerMatcher(object):
+    """根据配置预编译的消息触发匹配器，配置更新后自动重建"""
+
+    def __init__(self, config):
+        group_name_white_list = config.get("group_name_white_list", []) or []
+        group_chat_in_one_session = config.get("group_chat_in_one_session", []) or []
+        self.all_group = "ALL_GROUP" in group_name_white_list
+        self.group_name_white_list = set(group_name_white_list)
+        self.group_name_keyword_white_list = KeywordAutomaton(config.get("group_name_keyword_white_list", []))
+        self.all_group_in_one_session = "ALL_GROUP" in group_chat_in_one_session
+        self.group_chat_in_one_session = set(group_chat_in_one_session)
+        self.nick_name_black_list = set(config.get("nick_name_black_list", []) or [])
+        self.group_chat_prefix = PrefixTrie(config.get("group_chat_prefix"))
+        self.group_chat_keyword = KeywordAutomaton(config.get("group_chat_keyword"))
+        self.single_chat_prefix = PrefixTrie(config.get("single_chat_prefix", [""]))
+        self.image_create_prefix = PrefixTrie(config.get("image_create_prefix", [""]))
+
+    def is_group_in_white_list(self, group_name):
+        return self.all_group or group_name in self.group_name_white_list or bool(self.group_name_keyword_white_list.search(group_name))
+
+    def is_group_in_one_session(self, group_name):
+        return self.all_group_in_one_session or group_name in self.group_chat_in_one_session
+
+    def is_nick_name_blocked(self, nick_name):
+        return bool(nick_name) and nick_name in self.nick_name_black_list
+
+
+# 构建匹配器用到的配置项
+_TRIGGER_KEYS = (
+    "group_name_white_list",
+    "group_name_keyword_white_list",
+    "group_chat_in_one_session",
+    "nick_name_black_list",
+    "group_chat_prefix",
+    "group_chat_keyword",
+    "single_chat_prefix",
+    "image_create_prefix",
+)
+
+_matcher = None
+_matcher_values = None  # 构建_matcher时相关配置项的副本
+
+
+def _config_values(config):
+    """相关配置项的副本，列表会被复制，之后原地修改(如append)配置中的列表也能与副本比较出变化"""
+    return [list(value) if isinstance(value, list) else value for value in (dict.get(config, key) for key in _TRIGGER_KEYS)]
+
+
+def get_trigger_matcher() -> TriggerMatcher:
+    """返回当前配置对应的匹配器，相关配置项变化(如#更新配置、直接修改列表)时重新构建"""
+    global _matcher, _matcher_values
+    config = conf()
+    # 每条消息都会检查，_TRIGGER_KEYS都在available_setting中，直接用dict.get跳过Config.get的校验
+    if _matcher is None or any(dict.get(config, key) != value for key, value in zip(_TRIGGER_KEYS, _matcher_values)):
+        _matcher = TriggerMatcher(config)
+        _matcher_values = _config_values(config)
+    return _matcher
+
+
+@lru_cache(maxsize=1024)
+def mention_pattern(nick_name):
+    """@昵称 的预编译正则，按昵称缓存"""
+    return re.compile(f"@{re.escape(nick_name)}(\u2005|\u0020)")
@@ -13,9 +13,10 @@ from common.log import logger
 available_setting = {
     # openai api配置
     "open_ai_api_key": "",  # openai api key
+    "open_ai_api_keys": [],  # 额外的openai api key列表，与open_ai_api_key组成key池，每次请求选择负载最低的健康key
     # openai apibase，当use_azure_chatgpt为true时，需要设置对应的api base
     "open_ai_api_base": "https://api.openai.com/v1",
-    "proxy": "",  # openai使用的代理
+    "proxy": "",  # openai及其它bot的HTTP请求使用的代理
     # chatgpt模型， 当use_azure_chatgpt为true时，其名称为Azure上model deployment名称
     "model": "gpt-3.5-turbo",  # 可选择: gpt-4o, pt-4o-mini, gpt-4-turbo, claude-3-sonnet, wenxin, moonshot, qwen-turbo, xunfei, glm-4, minimax, gemini等模型，全部可选模型详见common/const.py文件
     "bot_type": "",  # 可选配置，使用兼容openai格式的三方服务时候，需填"chatGPT"。bot具体名称详见common/const.py文件列出的bot_type，如不填根据model名称判断，
@@ -49,6 +50,63 @@ available_setting = {
     "image_proxy": True,  # 是否需要图片代理，国内访问LinkAI时需要
     "image_create_prefix": ["画", "看", "找"],  # 开启图片回复的前缀
     "concurrency_in_session": 1,  # 同一会话最多有多少条消息在处理中，大于1可能乱序
+    "handler_pool_size": 8,  # 处理消息的线程数，所有会话共享，按群聊/私聊对象加权轮询分配
+    "async_pipeline": False,  # 是否使用asyncio处理消息，开启后消息在事件循环中处理，不支持异步的插件和bot在线程池中执行
+    "async_max_inflight": 1000,  # asyncio模式下同时处理中的消息数上限
+    "async_executor_workers": 32,  # asyncio模式下执行阻塞调用的线程数
+    "schedule_vip_list": [],  # 优先调度的session_id列表，其消息会排在普通会话之前处理，管理命令(#开头)默认优先
+    "schedule_weights": {},  # 会话调度权重，key为回复对象id(群聊为群id，私聊为用户id)，value为每轮最多连续调度的消息数，默认为1
+    "queue_max_size_in_session": 0,  # 每个会话最多排队等待处理的消息数，0为不限制
+    "queue_max_size": 0,  # 所有会话排队等待处理的消息总数上限，0为不限制
+    "queue_max_sessions": 0,  # 同时排队的会话数上限，超出时新会话的消息直接拒绝，0为不限制
+    "queue_overflow_policy": "drop_oldest",  # 排队消息超出上限时的处理策略，可选 drop_oldest(丢弃最早的消息), reject(拒绝新消息并回复繁忙), merge(合并到最后一条排队的消息)
+    "queue_busy_reply": "我正在忙着处理其他消息，请稍后再试",  # 拒绝新消息时的回复内容，为空则不回复
+    "coalesce_window_seconds": 0,  # 合并同一会话连续发送的文本消息的等待窗口(秒)，窗口内排队的消息合并为一次提问，0为不合并，管理命令和插件指令不参与合并。web渠道每条消息需单独回复，不建议开启
+    "stage_timing": False,  # 是否统计消息在排队、插件、模型、装饰、发送等各阶段的耗时，管理员可通过#stats指令查看
+    "send_retry_times": 2,  # 发送消息失败后的最大重试次数，重试在后台延迟执行，不占用处理消息的线程
+    "send_retry_base_delay": 3,  # 发送重试的基础等待秒数，每次重试翻倍并加入随机抖动
+    "single_flight": True,  # 是否合并并发的相同提问(相同问题、人设、模型和会话历史)，只调用一次模型并共享回复
+    "drain_timeout_seconds": 30,  # 退出时等待处理中消息完成的最长秒数，未处理的排队消息会保存到磁盘，下次启动收到第一条消息时回放
+    "drain_reply": "服务正在重启，请稍后再试",  # 排空期间收到无法保存的消息(如图片、语音)时的回复，文本消息会保存到磁盘，下次启动后回放
+    "session_store": "memory",  # 会话历史的存储方式，可选 memory(仅内存), sqlite(本地文件), redis(需安装redis库)，持久化时后台批量写入，重启后首次访问时加载
+    "session_store_path": "",  # sqlite存储的文件路径，为空时使用appdata目录下的sessions.db
+    "session_store_redis_url": "redis://localhost:6379/0",  # redis存储的连接地址
+    "session_store_flush_interval": 1,  # 会话写入存储的间隔秒数
+    "session_max_count": 0,  # 所有模型在内存中保存的会话总数上限，超出时淘汰最久未访问的会话，0为不限制
+    "session_max_bytes": 0,  # 所有会话历史估算占用内存的字节数上限，超出时淘汰最久未访问的会话，0为不限制。配置了session_store时被淘汰的会话会在下次访问时重新加载
+    "conversation_compaction": False,  # 历史超过高水位时是否在后台将最早的对话总结成摘要保存在system prompt中，代替直接丢弃，需要模型支持system prompt
+    "compaction_high_water": 0.8,  # 触发摘要的高水位，为conversation_max_tokens的比例
+    "compaction_keep_messages": 4,  # 摘要时保留的最近消息条数
+    "usage_ledger": False,  # 是否将每次模型调用的token用量持久化到SQLite，用于统计和重启后恢复当天的额度
+    "usage_db_path": "",  # 用量数据库的文件路径，为空时使用appdata目录下的usage.db
+    "usage_flush_interval": 5,  # 用量记录批量写入数据库的间隔秒数
+    "user_daily_token_quota": 0,  # 每个用户每天可用的token数，超出后当天不再调用模型，0为不限制
+    "usage_quota_reply": "今日的使用额度已用完，请明天再来",  # 超出额度时的回复
+    "api_key_cooldown_seconds": 30,  # key池中返回429的key的冷却秒数，连续限流时翻倍，鉴权失败(401/403)的key冷却该时间的60倍
+    "stream_reply": False,  # 是否以流式返回文本回复，网页和钉钉AI卡片会逐字展示，其它channel每凑够一段完整的句子就发送一条消息。目前仅chatGPT模型支持
+    "stream_min_chars": 50,  # 按句子分段发送流式回复时每条消息的最少字符数
+    "stream_update_interval": 0.5,  # 钉钉AI卡片流式更新的最小间隔秒数
+    "http_pool_connections": 10,  # bot共享的HTTP客户端最多保持连接池的host数
+    "http_pool_maxsize": 20,  # 每个host最多保持的keep-alive连接数，建议不小于handler_pool_size
+    "http_connect_timeout": 10,  # 建立连接的超时秒数，读取超时使用request_timeout
+    "http_retries": 2,  # 连接失败时的重试次数，502/503/504只对GET请求重试
+    "reply_cache": False,  # 是否缓存回复，相同人设和最近对话下的相同问题直接返回缓存的回复，不再调用模型
+    "reply_cache_ttl": 3600,  # 缓存回复的有效期秒数
+    "reply_cache_max_size": 1000,  # 最多缓存的回复数，超出时淘汰最久未命中的
+    "reply_cache_turns": 1,  # 缓存key包含的最近对话轮数，0为只按人设和问题匹配
+    "reply_cache_semantic": False,  # 是否开启语义匹配，问题与缓存中的问题足够相似时也视为命中
+    "reply_cache_semantic_threshold": 0.8,  # 语义匹配的相似度阈值，越大越严格
+    "circuit_breaker": True,  # 是否开启熔断，上游服务连续失败后一段时间内直接返回circuit_open_reply，不再等待重试
+    "circuit_failure_threshold": 5,  # 连续多少次超时、连接失败或5xx后熔断
+    "circuit_open_seconds": 30,  # 熔断秒数，之后放行一个探测请求，探测失败时熔断时间翻倍，最多8倍
+    "circuit_open_reply": "服务暂时不可用，请稍后再试",  # 熔断期间的回复
+    "retry_backoff_base": 1,  # 重试退避的基数秒数，第n次重试前随机等待0到base*2^n秒
+    "retry_backoff_max": 20,  # 重试前最多等待的秒数，Retry-After超过该值时不再重试
+    "router_backends": [],  # bot_type为router时按顺序使用的OpenAI兼容后端，如[{"name": "siliconflow", "api_base": "https://api.siliconflow.cn/v1", "api_key": "", "model": "deepseek-ai/DeepSeek-V3"}]，为空时使用open_ai_api_base和model
+    "router_hedge": True,  # 主后端超过对冲时间未返回时是否向下一个后端发出对冲请求，先返回的后端胜出
+    "router_hedge_percentile": 95,  # 对冲时间取后端最近首字延迟的该分位数
+    "router_hedge_min_delay": 0.5,  # 对冲时间的下限秒数
+    "router_hedge_max_delay": 5,  # 对冲时间的上限秒数，首字延迟样本不足时使用该值
     "image_create_size": "256x256",  # 图片大小,可选有 256x256, 512x512, 1024x1024 (dall-e-3默认为1024x1024)
     "group_chat_exit_group": False,
     # chatgpt会话参数
@@ -58,6 +116,7 @@ available_setting = {
     "conversation_max_tokens": 1000,  # 支持上下文记忆的最多字符数
     # chatgpt限流配置
     "rate_limit_chatgpt": 20,  # chatgpt的调用频率限制
+    "rate_limit_chatgpt_tpm": 0,  # chatgpt每分钟可用的token数，按每次请求预估的prompt token数扣减，0为不限制
     "rate_limit_dalle": 50,  # openai dalle的调用频率限制
     # chatgpt api参数 参考https://platform.openai.com/docs/api-reference/chat/create
     "temperature": 0.9,
@@ -170,9 +229,11 @@ available_setting = {
     "zhipu_ai_api_key": "",
     "zhipu_ai_api_base": "https://open.bigmodel.cn/api/paas/v4",
     "moonshot_api_key": "",
+    "moonshot_api_keys": [],  # 额外的moonshot api key列表，与moonshot_api_key组成key池
     "moonshot_base_url": "https://api.moonshot.cn/v1/chat/completions",
     #魔搭社区 平台配置
     "modelscope_api_key": "",
+    "modelscope_api_keys": [],  # 额外的modelscope api key列表，与modelscope_api_key组成key池
     "modelscope_base_url": "https://api-inference.modelscope.cn/v1/chat/completions",
     # LinkAI平台配置
     "use_linkai": False,
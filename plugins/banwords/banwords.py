@@ -77,6 +77,11 @@ class Banwords(Plugin):
                 return
 
     def on_decorate_reply(self, e_context: EventContext):
+        if e_context["reply"].type == ReplyType.TEXT_STREAM:
+            # 流式回复按句子过滤，ignore模式下遇到敏感词时截断后续内容
+            reply = e_context["reply"]
+            reply.content = reply.content.map_sentences(self._filter_sentence)
+            return
         if e_context["reply"].type not in [ReplyType.TEXT]:
             return
 
@@ -96,5 +101,15 @@ class Banwords(Plugin):
                 e_context.action = EventAction.CONTINUE
                 return
 
+    def _filter_sentence(self, sentence):
+        if self.reply_action == "ignore":
+            f = self.searchr.FindFirst(sentence)
+            if f:
+                logger.info("[Banwords] %s in reply" % f["Keyword"])
+                return None
+        elif self.reply_action == "replace":
+            return self.searchr.Replace(sentence)
+        return sentence
+
     def get_help_text(self, **kwargs):
         return "过滤消息中的敏感词。"
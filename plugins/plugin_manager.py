@@ -7,6 +7,7 @@ import os
 import sys
 
 from common.log import logger
+from common.metrics import mark_stage
 from common.singleton import singleton
 from common.sorted_dict import SortedDict
 from config import conf, remove_plugin_config, write_plugin_config
@@ -197,6 +198,7 @@ class PluginManager:
                     if e_context.is_break():
                         e_context["breaked_by"] = name
                         logger.debug("Plugin %s breaked event %s" % (name, e_context.event))
+        mark_stage(e_context.econtext.get("context"), "plugin_" + e_context.event.name.lower())
         return e_context
 
     def set_plugin_priority(self, name: str, priority: int):
@@ -103,7 +103,7 @@ class Tool(Plugin):
 
                 # Don't modify bot name
                 all_sessions = Bridge().get_bot("chat").sessions
-                user_session = all_sessions.session_query(query, e_context["context"]["session_id"]).messages
+                user_session = all_sessions.session_query(query, e_context["context"]["session_id"]).request_messages()
 
                 logger.debug("[tool]: just-go")
                 try:
@@ -0,0 +1,59 @@
+"""
+ChatChannel调度延迟基准：大量session各发一条消息，统计从produce到_handle开始执行的p50/p99延迟
+
+用法(在项目根目录执行)：
+    python scripts/bench_dispatch.py [session数，默认10000]
+每连续produce BENCH_BATCH条消息(默认50)休眠1ms，调小可降低到达速率，调大则模拟突发流量
+对比轮询调度器时，将脚本复制到替换调度器之前的提交(git worktree)中运行，脚本只会导入所在目录上一级的代码
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import config  # noqa: E402
+
+config.config = config.Config({})
+
+from bridge.context import Context, ContextType  # noqa: E402
+from channel.chat_channel import ChatChannel  # noqa: E402
+
+
+BATCH = int(os.environ.get("BENCH_BATCH", 50))
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    latencies = []
+    lock = threading.Lock()
+    done = threading.Event()
+
+    class BenchChannel(ChatChannel):
+        channel_type = "bench"
+
+        def _handle(self, context):
+            latency = time.monotonic() - context["bench_start"]
+            with lock:
+                latencies.append(latency)
+                if len(latencies) == n:
+                    done.set()
+
+    channel = BenchChannel()
+    for i in range(n):
+        context = Context(ContextType.TEXT, "hi", kwargs={"session_id": "s%d" % i, "receiver": "s%d" % i})
+        context["bench_start"] = time.monotonic()
+        channel.produce(context)
+        if i % BATCH == 0:
+            time.sleep(0.001)  # 模拟消息分批到达
+    if not done.wait(120):
+        print("timeout, {} of {} handled".format(len(latencies), n))
+    latencies.sort()
+    print("sessions={} p50={:.2f}ms p99={:.2f}ms".format(
+        len(latencies), latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000))
+    os._exit(0)  # consume线程不会退出
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+HTTP连接复用基准：在本地启动一个模拟上游的HTTP服务，对比每次调用requests.post(新建连接)与通过common.http_client共享连接池的单次调用耗时
+
+用法(在项目根目录执行)：
+    python scripts/bench_http_client.py [调用次数，默认300]
+设置BENCH_CERT和BENCH_KEY(自签名证书和私钥路径)时额外测试HTTPS，此时省去的TLS握手开销更明显，例如：
+    openssl req -x509 -newkey rsa:2048 -nodes -days 1 -subj /CN=127.0.0.1 -keyout key.pem -out cert.pem
+"""
+import json
+import os
+import ssl
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import requests  # noqa: E402
+import urllib3  # noqa: E402
+
+from common import http_client  # noqa: E402
+
+urllib3.disable_warnings()
+
+BODY = {"model": "bench", "messages": [{"role": "user", "content": "hi" * 200}]}
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 支持keep-alive
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        body = json.dumps({"choices": [{"message": {"content": "ok"}}]}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(cert=None, key=None):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), UpstreamHandler)
+    scheme = "http"
+    if cert and key:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        scheme = "https"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "{}://127.0.0.1:{}/v1/chat/completions".format(scheme, server.server_address[1])
+
+
+def bench(post, url, n):
+    post(url, json=BODY, verify=False).json()  # 预热，连接池在此建立连接
+    start = time.perf_counter()
+    for _ in range(n):
+        post(url, json=BODY, verify=False).json()
+    return (time.perf_counter() - start) / n * 1000
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    urls = [serve()]
+    if os.environ.get("BENCH_CERT") and os.environ.get("BENCH_KEY"):
+        urls.append(serve(os.environ["BENCH_CERT"], os.environ["BENCH_KEY"]))
+    for url in urls:
+        bare = bench(requests.post, url, n)
+        pooled = bench(http_client.post, url, n)
+        print("{} calls={} requests.post={:.2f}ms/call http_client={:.2f}ms/call saved={:.2f}ms".format(
+            url.split(":")[0], n, bare, pooled, bare - pooled))
+
+
+if __name__ == "__main__":
+    main()
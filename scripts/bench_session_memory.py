@@ -0,0 +1,57 @@
+"""
+会话内存基准：对比用dict保存消息(原实现)与使用__slots__的Message保存消息时，大量会话常驻的内存占用(tracemalloc统计)
+
+用法(在项目根目录执行)：
+    python scripts/bench_session_memory.py [session数，默认50000] [每个会话的对话轮数，默认3]
+"""
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import config  # noqa: E402
+
+config.config = config.Config({"character_desc": "你是一位专业的成长教练。" * 200})
+
+from bot.chatgpt.chat_gpt_session import ChatGPTSession  # noqa: E402
+
+
+class DictSession(ChatGPTSession):
+    """原实现：每条消息是一个dict"""
+
+    def reset(self):
+        self.messages = [{"role": "system", "content": self.system_prompt}]
+
+    def add_query(self, query):
+        self.messages.append({"role": "user", "content": query})
+
+    def add_reply(self, reply):
+        self.messages.append({"role": "assistant", "content": reply})
+
+
+def measure(session_cls, count, turns):
+    tracemalloc.start()
+    sessions = []
+    for i in range(count):
+        session = session_cls("u%d" % i)
+        for t in range(turns):
+            session.add_query("q%d-%d" % (i, t))
+            session.add_reply("a%d-%d" % (i, t))
+        sessions.append(session)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current, [s.request_messages() for s in sessions[:10]]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    turns = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    old, old_sample = measure(DictSession, count, turns)
+    new, new_sample = measure(ChatGPTSession, count, turns)
+    print("sessions={} messages_per_session={} dict={:.1f}MB message={:.1f}MB same_result={}".format(
+        count, 1 + turns * 2, old / 1e6, new / 1e6, old_sample == new_sample))
+
+
+if __name__ == "__main__":
+    main()
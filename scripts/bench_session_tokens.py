@@ -0,0 +1,60 @@
+"""
+会话token计数基准：对比每次都重新编码全部历史(原实现)与按消息缓存token数的增量计数，每轮对话调用两次discard_exceeding
+
+用法(在项目根目录执行)：
+    python scripts/bench_session_tokens.py [对话轮数，默认200] [max_tokens，默认3000]
+需要安装tiktoken才有意义：未安装时使用按字符计数的分词器，计数本身几乎没有开销，两种实现耗时接近
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bot.chatgpt.chat_gpt_session import ChatGPTSession, num_tokens_for_reply, num_tokens_from_messages  # noqa: E402
+
+WORDS = ["hello", "world", "token", "session", "，", "模型", "历史", "history"]
+
+
+class FullRecountSession(ChatGPTSession):
+    """原实现：每删除一条消息后重新计算全部消息的token数"""
+
+    def calc_tokens(self):
+        return num_tokens_from_messages(self.messages, self.model)
+
+    def _pop_message(self, index, precise=True):
+        self.messages.pop(index)
+        if precise:
+            self.message_tokens = self.calc_tokens() - num_tokens_for_reply(self.model)
+
+
+def run(session_cls, turns, max_tokens):
+    rand = random.Random(0)
+
+    def text(n):
+        return " ".join(rand.choice(WORDS) for _ in range(n))
+
+    session = session_cls("bench", "你是一个乐于助人的助手。")
+    totals = []
+    start = time.perf_counter()
+    for _ in range(turns):
+        session.add_query(text(60))
+        query_tokens = session.discard_exceeding(max_tokens)
+        session.add_reply(text(120))
+        totals.append((query_tokens, session.discard_exceeding(max_tokens)))
+    elapsed = time.perf_counter() - start
+    return elapsed / turns * 1000, totals, [m["content"] for m in session.messages]
+
+
+def main():
+    turns = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    max_tokens = int(sys.argv[2]) if len(sys.argv) > 2 else 3000
+    old = run(FullRecountSession, turns, max_tokens)
+    new = run(ChatGPTSession, turns, max_tokens)
+    print("turns={} max_tokens={} full_recount={:.3f}ms/turn incremental={:.3f}ms/turn same_result={}".format(
+        turns, max_tokens, old[0], new[0], old[1:] == new[1:]))
+
+
+if __name__ == "__main__":
+    main()